@@ -0,0 +1,183 @@
+'''Polling clients against the WSGI and the ASGI app at rising concurrency
+
+Each server runs in its own process on a seeded file database with the
+production profile: the WSGI app on werkzeug's threaded server (a thread
+per connection) and the ASGI app on uvicorn. An asyncio client keeps
+--clients persistent connections open. Each connection repeatedly polls a
+page of open tasks, and the script reports throughput and latency
+percentiles per server and concurrency level. Needs aiosqlite and uvicorn.
+
+    python benchmarks/bench_asgi_vs_wsgi.py --clients 50 500 5000
+'''
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+POLL_PATH = "/api/tasks?status=Pending&limit=20"
+
+
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(kind, port):
+    raise_open_file_limit()
+    from config import create_app
+    app = create_app('production')
+    if kind == "wsgi":
+        from werkzeug.serving import WSGIRequestHandler, make_server
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        # Keep-alive, like the ASGI server, instead of a connection per poll
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+        server = make_server("127.0.0.1", port, app, threaded=True)
+        server.socket.listen(4096)
+        server.serve_forever()
+    else:
+        import uvicorn
+        from task_asgi import TaskAsgiApp
+        uvicorn.run(TaskAsgiApp(app), host="127.0.0.1", port=port,
+                    log_level="warning", backlog=4096)
+
+
+def seed(db_path, rows):
+    os.environ.update({
+        "FLASK_SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}",
+        "FLASK_GENERATION_COUNTER_FILE": db_path + ".generation",
+        "FLASK_LOG_QUEUE_ENABLED": "true",
+    })
+    from config import create_app, db
+    from datagen import seed_tasks
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        seed_tasks(rows)
+        db.engine.dispose()
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+async def poll(port, deadline, latencies, counts):
+    request = (f"GET {POLL_PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+               .encode())
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1",
+                                                               port)
+            start = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            status = int(head.split(b" ", 2)[1])
+            length = 0
+            close = False
+            for line in head.split(b"\r\n")[1:]:
+                name, _, value = line.partition(b":")
+                name = name.strip().lower()
+                if name == b"content-length":
+                    length = int(value)
+                elif name == b"connection" and \
+                        value.strip().lower() == b"close":
+                    close = True
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            counts["errors" if status >= 500 else "ok"] += 1
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            counts["errors"] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+async def drive(port, clients, seconds):
+    latencies = []
+    counts = {"ok": 0, "errors": 0}
+    start = time.perf_counter()
+    deadline = start + seconds
+    await asyncio.gather(*(poll(port, deadline, latencies, counts)
+                           for _ in range(clients)))
+    # Requests in flight at the deadline still complete, count their time
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(pct):
+        if not latencies:
+            return None
+        index = min(int(len(latencies) * pct / 100), len(latencies) - 1)
+        return round(latencies[index] * 1000, 2)
+
+    return {
+        "clients": clients,
+        "requests_per_sec": round(counts["ok"] / elapsed, 1),
+        "errors": counts["errors"],
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+",
+                        default=[50, 500, 5000])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    db_path = os.path.join(tempfile.mkdtemp(prefix="bench-asgi-"), "task.db")
+    seed(db_path, args.rows)
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for kind in ("wsgi", "asgi"):
+        port = free_port()
+        server = context.Process(target=serve, args=(kind, port),
+                                 daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            for clients in args.clients:
+                result = asyncio.run(drive(port, clients, args.seconds))
+                results.append({"server": kind, **result})
+        finally:
+            server.terminate()
+            server.join()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+'''Payload size and time of GET /api/tasks per format, fieldset and coding
+
+Requests a full listing through the Flask test client in every
+combination of response format (Accept), ?fields= and Accept-Encoding,
+and reports the body size in bytes and the best request time. MessagePack
+and brotli rows are skipped when the optional packages are missing.
+
+    python benchmarks/bench_formats.py --rows 10000
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import create_app, db  # noqa: E402
+from datagen import seed_tasks  # noqa: E402
+from task_compression import available_encodings  # noqa: E402
+from task_serializer import listing_mimetypes  # noqa: E402
+
+FIELDSETS = [None, "id,name,status"]
+
+
+def best_of(client, url, headers, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        timings.append(time.perf_counter() - start)
+    assert response.status_code == 200, response.status_code
+    return min(timings), len(response.get_data())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    results = []
+    with app.app_context():
+        db.create_all()
+        seed_tasks(args.rows)
+        client = app.test_client()
+        for mimetype in listing_mimetypes():
+            for fields in FIELDSETS:
+                url = "/api/tasks" + (f"?fields={fields}" if fields else "")
+                for encoding in ["identity"] + available_encodings():
+                    seconds, size = best_of(
+                        client, url, {"Accept": mimetype,
+                                      "Accept-Encoding": encoding},
+                        args.repeat)
+                    results.append({"format": mimetype,
+                                    "fields": fields or "all",
+                                    "encoding": encoding, "bytes": size,
+                                    "ms": round(seconds * 1000, 2)})
+        db.drop_all()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
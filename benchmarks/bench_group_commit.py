@@ -0,0 +1,97 @@
+'''Create throughput of POST /api/tasks with and without write batching
+
+Runs client threads against one app, the way a threaded server handles
+concurrent requests, once committing every create on its own and once
+through the group commit writer (WRITE_BATCHING_ENABLED). Reports
+creates and commits per second. Batching pays off as far as commits
+wait on the disk, the default --synchronous FULL makes each one wait
+for an fsync.
+
+    python benchmarks/bench_group_commit.py --threads 32 --seconds 10
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import PRODUCTION_SQLITE_PRAGMAS, create_app, db  # noqa: E402
+
+MODES = {"per_request": "false", "batched": "true"}
+
+
+def configure(directory, batching, synchronous):
+    os.environ.update({
+        "FLASK_SQLALCHEMY_DATABASE_URI":
+            f"sqlite:///{os.path.join(directory, 'task.db')}",
+        "FLASK_SQLITE_PRAGMAS": json.dumps(
+            {**PRODUCTION_SQLITE_PRAGMAS, "synchronous": synchronous}),
+        "FLASK_WRITE_BATCHING_ENABLED": batching,
+        "FLASK_GENERATION_COUNTER_FILE": os.path.join(directory,
+                                                      "generation"),
+        "FLASK_LOG_QUEUE_ENABLED": "false",
+        "FLASK_RESPONSE_CACHE_ENABLED": "false",
+    })
+
+
+def client_thread(app, thread_id, deadline, counts):
+    client = app.test_client()
+    op = 0
+    while time.time() < deadline:
+        op += 1
+        response = client.post('/api/tasks',
+                               json={"name": f"t{thread_id}-{op}"})
+        counts[thread_id] += response.status_code == 201
+
+
+def run(mode, threads, seconds, synchronous):
+    directory = tempfile.mkdtemp(prefix=f"bench-group-commit-{mode}-")
+    configure(directory, MODES[mode], synchronous)
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+
+    counts = [0] * threads
+    deadline = time.time() + seconds
+    workers = [threading.Thread(target=client_thread,
+                                args=(app, index, deadline, counts))
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    creates = sum(counts)
+    writer = app.extensions.get("task_writer")
+    commits = writer.stats()["batches"] if writer is not None else creates
+    if writer is not None:
+        writer.close()
+    return {
+        "mode": mode,
+        "threads": threads,
+        "synchronous": synchronous,
+        "seconds": seconds,
+        "creates_per_sec": round(creates / seconds, 1),
+        "commits_per_sec": round(commits / seconds, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--synchronous", default="FULL",
+                        choices=["OFF", "NORMAL", "FULL"])
+    args = parser.parse_args()
+
+    results = [run(mode, args.threads, args.seconds, args.synchronous)
+               for mode in MODES]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+'''Rows/sec of the marshmallow and column-tuple read paths of GET /api/tasks
+
+The marshmallow path is what get_tasks used to do: load ORM objects, run
+tasks_schema.dump and jsonify. The fast path selects column tuples and
+encodes them with task_serializer. Both produce the same bytes, checked
+before timing.
+
+    python benchmarks/bench_serialization.py --sizes 1000 100000 1000000
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify  # noqa: E402
+from sqlalchemy import insert, select  # noqa: E402
+from config import create_app, db  # noqa: E402
+from task_models import Task, tasks_schema  # noqa: E402
+from task_serializer import task_serializer, to_json_bytes  # noqa: E402
+
+
+def seed(count):
+    db.session.execute(insert(Task), [
+        {"name": f"task {i}",
+         "priority": ("Low", "Medium", "High")[i % 3],
+         "status": ("Pending", "In Progress", "Completed")[i % 3],
+         "due_on": date(2030, 1, 1) + timedelta(days=i % 365),
+         "created_on": date(2029, 1, 1)}
+        for i in range(count)])
+    db.session.commit()
+
+
+def marshmallow_path():
+    tasks = db.session.execute(select(Task)).scalars().all()
+    body = jsonify(tasks_schema.dump(tasks)).get_data()
+    db.session.expunge_all()
+    return body
+
+
+def fast_path():
+    rows = db.session.execute(select(*task_serializer.columns)).all()
+    return to_json_bytes(task_serializer.dump(rows))
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        app = create_app('testing')
+        with app.app_context():
+            db.create_all()
+            seed(size)
+            assert marshmallow_path() == fast_path()
+            repeat = args.repeat if size < 1000000 else 1
+            for name, func in (("marshmallow", marshmallow_path),
+                               ("fast", fast_path)):
+                seconds = best_of(func, repeat)
+                results.append({"path": name, "rows": size,
+                                "seconds": round(seconds, 4),
+                                "rows_per_sec": round(size / seconds)})
+            db.drop_all()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
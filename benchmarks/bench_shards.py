@@ -0,0 +1,91 @@
+'''Write throughput of POST /api/tasks by number of TASK_SHARDS databases
+
+Each run creates fresh shard files and lets several worker processes,
+each with its own production app like a gunicorn worker, create tasks
+as fast as they can. With one shard every commit queues for the same
+database lock. With more shards commits to different files proceed in
+parallel, so throughput grows with the shard count until the CPU or the
+disk is saturated. The lock is held the longest with
+--synchronous FULL, where each commit waits for an fsync.
+
+    python benchmarks/bench_shards.py --shards 1 2 4 8 --workers 8
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import PRODUCTION_SQLITE_PRAGMAS, create_app  # noqa: E402
+
+
+def configure(directory, shard_count, synchronous):
+    os.environ.update({
+        "FLASK_SQLALCHEMY_DATABASE_URI":
+            f"sqlite:///{os.path.join(directory, 'task.db')}",
+        "FLASK_TASK_SHARDS": json.dumps([
+            f"sqlite:///{os.path.join(directory, f'shard{index}.db')}"
+            for index in range(shard_count)]),
+        "FLASK_SQLITE_PRAGMAS": json.dumps(
+            {**PRODUCTION_SQLITE_PRAGMAS, "synchronous": synchronous}),
+        "FLASK_GENERATION_COUNTER_FILE": os.path.join(directory,
+                                                      "generation"),
+        "FLASK_LOG_QUEUE_ENABLED": "false",
+        "FLASK_RESPONSE_CACHE_ENABLED": "false",
+    })
+
+
+def worker(worker_id, deadline):
+    client = create_app('production').test_client()
+    counts = {"writes": 0, "errors": 0}
+    op = 0
+    while time.time() < deadline:
+        op += 1
+        response = client.post('/api/tasks',
+                               json={"name": f"w{worker_id}-{op}"})
+        counts["writes" if response.status_code == 201 else "errors"] += 1
+    return counts
+
+
+def run(shard_count, workers, seconds, synchronous):
+    directory = tempfile.mkdtemp(prefix=f"bench-shards-{shard_count}-")
+    configure(directory, shard_count, synchronous)
+    app = create_app('production')
+    app.extensions["task_shards"].create_all()
+
+    deadline = time.time() + seconds + 1
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        results = pool.starmap(worker, [(i, deadline)
+                                        for i in range(workers)])
+
+    writes = sum(result["writes"] for result in results)
+    return {
+        "shards": shard_count,
+        "workers": workers,
+        "synchronous": synchronous,
+        "seconds": seconds,
+        "writes_per_sec": round(writes / seconds, 1),
+        "errors": sum(result["errors"] for result in results)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--synchronous", default="NORMAL",
+                        choices=["OFF", "NORMAL", "FULL"])
+    args = parser.parse_args()
+
+    results = [run(count, args.workers, args.seconds, args.synchronous)
+               for count in args.shards]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+'''Read/write throughput of the task API under concurrent workers
+
+Runs the same mixed workload against a file-backed database twice: once
+with SQLite defaults (rollback journal, no pragmas, default pool) and
+once with the production profile from config.py (WAL, pragmas, pool
+sizing and the read engine). Every worker is a separate process with its
+own app, like a gunicorn worker, so they contend on the database lock
+rather than on the GIL.
+
+    python benchmarks/bench_sqlite_concurrency.py --workers 8 --seconds 10
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import create_app, db  # noqa: E402
+
+PROFILES = {
+    "baseline": {
+        "FLASK_SQLITE_PRAGMAS": "{}",
+        "FLASK_SQLALCHEMY_ENGINE_OPTIONS": "{}",
+        "FLASK_READ_ENGINE_ENABLED": "false"
+    },
+    "production": {}
+}
+
+
+def configure_profile(name, db_path):
+    for profile_env in PROFILES.values():
+        for key in profile_env:
+            os.environ.pop(key, None)
+    os.environ.update({
+        "FLASK_SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}",
+        "FLASK_LOG_QUEUE_ENABLED": "false",
+        **PROFILES[name]
+    })
+
+
+def worker(worker_id, deadline, write_ratio):
+    app = create_app('production')
+    client = app.test_client()
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    op = 0
+    while time.time() < deadline:
+        op += 1
+        if (op * write_ratio) % 1 < write_ratio:
+            response = client.post('/api/tasks', json={
+                "name": f"w{worker_id}-{op}"})
+            kind = "writes"
+        else:
+            response = client.get('/api/tasks?status=Pending&limit=50')
+            kind = "reads"
+        if response.status_code >= 500:
+            counts["errors"] += 1
+        else:
+            counts[kind] += 1
+    return counts
+
+
+def run_profile(name, workers, seconds, seed_rows, write_ratio):
+    db_path = os.path.join(tempfile.mkdtemp(prefix=f"bench-{name}-"),
+                           "task.db")
+    configure_profile(name, db_path)
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        app.test_client().post('/api/tasks/bulk', json=[
+            {"name": f"seed {i}",
+             "status": ["Pending", "In Progress", "Completed"][i % 3]}
+            for i in range(seed_rows)])
+        db.engine.dispose()
+
+    deadline = time.time() + seconds + 1
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        results = pool.starmap(worker, [(i, deadline, write_ratio)
+                                        for i in range(workers)])
+
+    totals = {key: sum(result[key] for result in results)
+              for key in ("reads", "writes", "errors")}
+    return {
+        "profile": name,
+        "workers": workers,
+        "seconds": seconds,
+        "reads_per_sec": round(totals["reads"] / seconds, 1),
+        "writes_per_sec": round(totals["writes"] / seconds, 1),
+        "errors": totals["errors"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--seed-rows", type=int, default=5000)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = [run_profile(name, args.workers, args.seconds,
+                           args.seed_rows, args.write_ratio)
+               for name in PROFILES]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
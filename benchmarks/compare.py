@@ -0,0 +1,66 @@
+'''Diff two benchmark result files and flag regressions
+
+Understands the JSON written by load_driver.py and by pytest-benchmark's
+--benchmark-json. Exits with status 1 when any metric got worse by more
+than the threshold, so it can gate a CI job.
+
+    python benchmarks/compare.py results/load-abc123.json \
+        results/load-def456.json --threshold 0.1
+'''
+import argparse
+import json
+import sys
+
+
+def load_metrics(path):
+    '''Return {name: value} of lower-is-better metrics in a result file'''
+    with open(path) as results_file:
+        results = json.load(results_file)
+
+    metrics = {}
+    if "operations" in results:
+        for operation, stats in results["operations"].items():
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if stats.get(key) is not None:
+                    metrics[f"{operation} {key}"] = stats[key]
+    elif "benchmarks" in results:
+        for benchmark in results["benchmarks"]:
+            metrics[f"{benchmark['fullname']} median_ms"] = \
+                benchmark["stats"]["median"] * 1000
+    else:
+        raise SystemExit(f"{path}: not a load_driver or pytest-benchmark "
+                         "result file")
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    baseline = load_metrics(args.baseline)
+    candidate = load_metrics(args.candidate)
+
+    regressions = 0
+    for name in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[name], candidate[name]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<70} {before:>10.3f} {after:>10.3f} "
+              f"{change:>+8.1%}{flag}")
+
+    for name in sorted(baseline.keys() ^ candidate.keys()):
+        side = "baseline" if name in baseline else "candidate"
+        print(f"{name:<70} only in {side}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+'''Seed the task table with a reproducible, realistic looking data set
+
+Priorities lean towards Medium, most tasks are still open, due dates
+bunch up in the next few weeks with a long tail and some tasks have none.
+The same count and seed always produce the same rows.
+
+    python benchmarks/datagen.py --rows 100000 --database /tmp/task.db
+'''
+import argparse
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from task_models import Task  # noqa: E402
+
+PRIORITY_WEIGHTS = {"Low": 30, "Medium": 50, "High": 20}
+STATUS_WEIGHTS = {"Pending": 45, "In Progress": 25, "Completed": 30}
+# Share of tasks created without a due date
+NO_DUE_DATE_RATIO = 0.15
+# Mean days until a task is due, the distribution has a long tail
+MEAN_DAYS_UNTIL_DUE = 21
+MAX_DAYS_UNTIL_DUE = 365
+MAX_TASK_AGE_DAYS = 180
+INSERT_BATCH_SIZE = 10000
+
+VERBS = ["Review", "Write", "Fix", "Plan", "Update", "Call", "Email",
+         "Deploy", "Test", "Clean", "Book", "Prepare", "Refactor", "Order"]
+NOUNS = ["report", "invoice", "roadmap", "release notes", "dentist",
+         "budget", "login page", "backups", "garage", "slides",
+         "onboarding doc", "flights", "database", "groceries"]
+
+
+def generate_tasks(count, seed=0, today=None):
+    '''Yield count task dicts ready for an INSERT into the task table'''
+    rng = random.Random(seed)
+    today = today or date.today()
+    priorities, priority_weights = zip(*PRIORITY_WEIGHTS.items())
+    statuses, status_weights = zip(*STATUS_WEIGHTS.items())
+
+    for i in range(count):
+        due_on = None
+        if rng.random() >= NO_DUE_DATE_RATIO:
+            days = min(int(rng.expovariate(1 / MEAN_DAYS_UNTIL_DUE)),
+                       MAX_DAYS_UNTIL_DUE)
+            due_on = today + timedelta(days=days)
+        yield {
+            "name": f"{rng.choice(VERBS)} {rng.choice(NOUNS)} {i}",
+            "priority": rng.choices(priorities, priority_weights)[0],
+            "status": rng.choices(statuses, status_weights)[0],
+            "due_on": due_on,
+            "created_on": today - timedelta(
+                days=rng.randint(0, MAX_TASK_AGE_DAYS))
+        }
+
+
+def seed_tasks(count, seed=0, today=None):
+    '''Insert generated tasks through the current app's session'''
+    batch = []
+    for task in generate_tasks(count, seed, today):
+        batch.append(task)
+        if len(batch) == INSERT_BATCH_SIZE:
+            db.session.execute(insert(Task), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(Task), batch)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", required=True,
+                        help="SQLite file to create the table in and fill")
+    args = parser.parse_args()
+
+    os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = \
+        f"sqlite:///{os.path.abspath(args.database)}"
+    os.environ.setdefault("FLASK_LOG_QUEUE_ENABLED", "false")
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        seed_tasks(args.rows, args.seed)
+    print(f"seeded {args.rows} tasks into {args.database}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+'''HTTP load driver reporting latency percentiles and throughput
+
+Without --url it seeds a temporary database with datagen, serves the app
+in production mode on a local port and drives that. With --url it drives
+an already running server (e.g. gunicorn), which keeps the client's
+threads from competing with the server for the GIL. Pass --rows to match
+the number of tasks that server was seeded with.
+
+    python benchmarks/load_driver.py --threads 8 --seconds 20
+    python benchmarks/load_driver.py --url http://127.0.0.1:8000 --rows 100000
+
+Results are written as JSON, by default to
+benchmarks/results/load-<commit>.json, compare two runs with compare.py.
+'''
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "results")
+PERCENTILES = (50, 95, 99)
+
+# Operation name -> relative weight in the request mix
+DEFAULT_MIX = {
+    "list_page": 30,
+    "list_filtered": 20,
+    "search": 10,
+    "get_task": 25,
+    "add_task": 10,
+    "update_task": 5,
+}
+
+
+def build_request(operation, rng, rows, sequence):
+    '''Return (method, path, json body) for one request of operation'''
+    if operation == "list_page":
+        sort = rng.choice(["name", "priority", "due_on", "status"])
+        return "GET", f"/api/tasks?{urlencode({'sort': sort, 'limit': 50})}", \
+            None
+    if operation == "list_filtered":
+        params = {"status": rng.choice(["Pending", "In Progress",
+                                        "Completed"]),
+                  "priority": rng.choice(["Low", "Medium", "High"]),
+                  "limit": 100}
+        return "GET", f"/api/tasks?{urlencode(params)}", None
+    if operation == "search":
+        term = rng.choice(["report", "invoice", "budget", "slides"])
+        return "GET", f"/api/tasks?{urlencode({'search': term, 'limit': 50})}", \
+            None
+    if operation == "get_task":
+        return "GET", f"/api/tasks/{rng.randint(1, rows)}", None
+    due_on = (date.today() + timedelta(days=rng.randint(0, 30))).isoformat()
+    if operation == "add_task":
+        return "POST", "/api/tasks", {"name": f"load add {sequence}",
+                                      "due_on": due_on}
+    if operation == "update_task":
+        return "PUT", f"/api/tasks/{rng.randint(1, rows)}", {
+            "name": f"load update {sequence}",
+            "status": rng.choice(["Pending", "In Progress", "Completed"])}
+    raise ValueError(f"unknown operation {operation}")
+
+
+def send(base_url, method, path, body):
+    data = None
+    headers = {}
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    request = urllib.request.Request(base_url + path, data=data,
+                                     headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as err:
+        return err.code
+
+
+def run_client(base_url, mix, rows, deadline, warmup_until, seed,
+               sequence, samples):
+    rng = random.Random(seed)
+    operations, weights = zip(*mix.items())
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            return
+        operation = rng.choices(operations, weights)[0]
+        method, path, body = build_request(operation, rng, rows,
+                                           next(sequence))
+        start = time.perf_counter()
+        try:
+            status = send(base_url, method, path, body)
+        except OSError:
+            status = None
+        elapsed = time.perf_counter() - start
+        if start >= warmup_until:
+            # list.append is atomic, no lock needed across client threads
+            samples.append((operation, elapsed,
+                            status is None or status >= 500))
+
+
+def percentile(sorted_values, pct):
+    '''Nearest-rank percentile of an already sorted list'''
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(samples, seconds):
+    by_operation = {}
+    for operation, elapsed, failed in samples:
+        by_operation.setdefault(operation, []).append((elapsed, failed))
+    by_operation["all"] = [(elapsed, failed)
+                           for _, elapsed, failed in samples]
+
+    summary = {}
+    for operation, values in sorted(by_operation.items()):
+        latencies = sorted(elapsed for elapsed, _ in values)
+        stats = {
+            "requests": len(values),
+            "errors": sum(failed for _, failed in values),
+            "throughput_rps": round(len(values) / seconds, 1),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3)
+            if latencies else None,
+        }
+        for pct in PERCENTILES:
+            value = percentile(latencies, pct)
+            stats[f"p{pct}_ms"] = round(value * 1000, 3) \
+                if value is not None else None
+        summary[operation] = stats
+    return summary
+
+
+def start_local_server(rows, seed):
+    '''Seed a temporary database and serve the app on a free port'''
+    from werkzeug.serving import make_server
+    from config import create_app, db
+    from datagen import seed_tasks
+
+    directory = tempfile.mkdtemp(prefix="task-load-")
+    os.environ.update({
+        "FLASK_SQLALCHEMY_DATABASE_URI":
+            f"sqlite:///{os.path.join(directory, 'task.db')}",
+        "FLASK_GENERATION_COUNTER_FILE": os.path.join(directory, "gen"),
+    })
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        seed_tasks(rows, seed)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="drive this server instead of "
+                        "starting one")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mix", type=json.loads, default=DEFAULT_MIX,
+                        help="JSON object of operation -> weight")
+    parser.add_argument("--output", help="where to write the JSON results")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        server, base_url = start_local_server(args.rows, args.seed)
+
+    samples = []
+    sequence = itertools.count()
+    warmup_until = time.perf_counter() + args.warmup
+    deadline = warmup_until + args.seconds
+    clients = [threading.Thread(target=run_client,
+                                args=(base_url, args.mix, args.rows,
+                                      deadline, warmup_until,
+                                      args.seed + i, sequence, samples))
+               for i in range(args.threads)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    if server:
+        server.shutdown()
+
+    commit = current_commit()
+    results = {
+        "commit": commit,
+        "url": args.url or "local",
+        "rows": args.rows,
+        "threads": args.threads,
+        "seconds": args.seconds,
+        "mix": args.mix,
+        "operations": summarize(samples, args.seconds),
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print(json.dumps(results["operations"], indent=2))
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,34 @@
-from flask import Flask
+import os
+from functools import partial
+from flask import Flask, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_migrate import Migrate
+from sqlalchemy import create_engine, event
 
 db = SQLAlchemy()
 ma = Marshmallow()
 migrate = Migrate()
 
+# Applied to every new SQLite connection in the production profile
+PRODUCTION_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -64000,  # negative means KiB, so 64 MB per connection
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY"
+}
+
+PRODUCTION_ENGINE_OPTIONS = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+    # Compiled SQL per statement shape. The listing alone keeps up to
+    # task_queries.MAX_CACHED_STATEMENTS shapes, the default is 500.
+    "query_cache_size": 1200
+}
+
 
 def create_app(config_type='development'):
     app = Flask(__name__)
@@ -14,17 +36,141 @@ def create_app(config_type='development'):
     if config_type == 'testing':
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         app.config['TESTING'] = True
+        # No other process can write an in-memory database
+        app.config["GENERATION_COUNTER_FILE"] = None
+
+    elif config_type == 'production':
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///task.db"
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+            PRODUCTION_ENGINE_OPTIONS)
+        app.config["SQLITE_PRAGMAS"] = dict(PRODUCTION_SQLITE_PRAGMAS)
+        # Readers get their own pool so they never queue behind writers
+        app.config["READ_ENGINE_ENABLED"] = True
+        app.config["LOG_QUEUE_ENABLED"] = True
+        app.config["RESPONSE_CACHE_ENABLED"] = True
+        # FLASK_* environment variables override the values above
+        app.config.from_prefixed_env()
 
     else:
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///task.db"
 
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Write logs.json from a background thread instead of the request
+    app.config.setdefault("LOG_QUEUE_ENABLED", False)
+    app.config.setdefault("LOG_QUEUE_OPTIONS", {})
+    app.config.setdefault("SQLITE_PRAGMAS", {})
+    app.config.setdefault("READ_ENGINE_ENABLED", False)
+    # Cache of serialized GET /api/tasks responses, see task_cache.py
+    app.config.setdefault("RESPONSE_CACHE_ENABLED", False)
+    app.config.setdefault("RESPONSE_CACHE_MAX_ENTRIES", 256)
+    app.config.setdefault("RESPONSE_CACHE_MAX_BYTES", 32 << 20)
+    app.config.setdefault("RESPONSE_CACHE_TTL", 5.0)
+    # Shared by every process using the database, so a write in any of
+    # them (a worker, flask tasks import) changes the ETags and
+    # invalidates the caches of all. None keeps it per process.
+    app.config.setdefault("GENERATION_COUNTER_FILE", os.path.join(
+        app.instance_path, "task_generation"))
+    # Serve GET /api/tasks/stats from the trigger maintained task_counts
+    app.config.setdefault("STATS_SUMMARY_ENABLED", True)
+    # Per-phase timings and SQL counts served at /metrics, see task_metrics
+    app.config.setdefault("METRICS_ENABLED", True)
+    # cProfile requests sent with X-Profile: 1 or picked at this rate
+    app.config.setdefault("PROFILING_ENABLED", False)
+    app.config.setdefault("PROFILE_SAMPLE_RATE", 0.0)
+    app.config.setdefault("PROFILE_DIR", None)
+    # gzip/brotli bodies of at least this many bytes, None disables it
+    app.config.setdefault("COMPRESSION_MIN_SIZE", 1024)
+    # flask tasks archive: Completed tasks older than this move to
+    # task_archive, in chunks with a pause for waiting writers
+    app.config.setdefault("ARCHIVE_AFTER_DAYS", 90)
+    app.config.setdefault("ARCHIVE_BATCH_SIZE", 500)
+    app.config.setdefault("ARCHIVE_PAUSE", 0.01)
+    # flask tasks prune-changes: change feed rows before the last this
+    # many sequence numbers are removed, see task_archive.py
+    app.config.setdefault("CHANGES_RETAINED", 100000)
+    # Database URIs to split tasks across, see task_shards.py. Empty keeps
+    # them all in SQLALCHEMY_DATABASE_URI.
+    app.config.setdefault("TASK_SHARDS", [])
+    # Commit creates and replacements in groups from one writer thread,
+    # see task_writer.py
+    app.config.setdefault("WRITE_BATCHING_ENABLED", False)
+    app.config.setdefault("WRITE_BATCH_SIZE", 256)
+    app.config.setdefault("WRITE_BATCH_DELAY", 0.002)
+    app.config.setdefault("WRITE_TIMEOUT", 10.0)
 
     db.init_app(app)
     ma.init_app(app)
     migrate.init_app(app, db)
 
-    from routes import api_bp
+    with app.app_context():
+        if app.config["READ_ENGINE_ENABLED"]:
+            # Defaults to the same database file through a separate pool
+            read_url = app.config.get("READ_DATABASE_URI") or db.engine.url
+            app.extensions["read_engine"] = create_engine(
+                read_url, **app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        _register_sqlite_pragmas(app)
+
+    import task_cache
+    task_cache.init_app(app)
+
+    import task_shards
+    task_shards.init_app(app)
+
+    import task_writer
+    task_writer.init_app(app)
+
+    import task_metrics
+    if app.config["METRICS_ENABLED"]:
+        task_metrics.init_app(app)
+
+    from routes import api_bp, api_logger
     app.register_blueprint(api_bp)
+    api_logger.observer = partial(task_metrics.record_phase, "logging")
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].log_stats = api_logger.stats
+
+    if app.config["LOG_QUEUE_ENABLED"]:
+        api_logger.use_queue(**app.config["LOG_QUEUE_OPTIONS"])
+
+    # flask tasks import / export / archive / create-shards
+    from task_cli import tasks_cli
+    app.cli.add_command(tasks_cli)
 
     return app
+
+
+def read_bind_arguments():
+    '''Session bind arguments sending a read-only query to the read engine'''
+    engine = current_app.extensions.get("read_engine")
+    if engine is None:
+        return None
+    return {"bind": engine}
+
+
+def _register_sqlite_pragmas(app):
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    if not pragmas:
+        return
+
+    engines = [(engine, pragmas) for engine in db.engines.values()]
+    if "read_engine" in app.extensions:
+        engines.append((app.extensions["read_engine"],
+                        {**pragmas, "query_only": "ON"}))
+
+    for engine, engine_pragmas in engines:
+        register_sqlite_pragmas(engine, engine_pragmas)
+
+
+def register_sqlite_pragmas(engine, pragmas):
+    '''Run PRAGMA statements on each new connection of a SQLite engine'''
+    if engine.dialect.name == "sqlite" and pragmas:
+        event.listen(engine, "connect", _pragma_setter(pragmas))
+
+
+def _pragma_setter(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return set_pragmas
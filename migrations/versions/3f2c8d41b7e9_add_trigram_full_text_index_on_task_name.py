@@ -0,0 +1,48 @@
+"""Add trigram full-text index on task name
+
+Revision ID: 3f2c8d41b7e9
+Revises: 9a6905e57eac
+Create Date: 2026-10-18 10:03:57.614020
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2c8d41b7e9'
+down_revision = '9a6905e57eac'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('''
+        CREATE VIRTUAL TABLE task_fts USING fts5(
+            name, content='task', content_rowid='id', tokenize='trigram')
+    ''')
+    op.execute('''
+        CREATE TRIGGER task_fts_insert AFTER INSERT ON task BEGIN
+            INSERT INTO task_fts(rowid, name) VALUES (new.id, new.name);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER task_fts_delete AFTER DELETE ON task BEGIN
+            INSERT INTO task_fts(task_fts, rowid, name)
+            VALUES ('delete', old.id, old.name);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER task_fts_update AFTER UPDATE OF name ON task BEGIN
+            INSERT INTO task_fts(task_fts, rowid, name)
+            VALUES ('delete', old.id, old.name);
+            INSERT INTO task_fts(rowid, name) VALUES (new.id, new.name);
+        END
+    ''')
+    op.execute("INSERT INTO task_fts(task_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    op.execute('DROP TRIGGER task_fts_update')
+    op.execute('DROP TRIGGER task_fts_delete')
+    op.execute('DROP TRIGGER task_fts_insert')
+    op.execute('DROP TABLE task_fts')
@@ -0,0 +1,27 @@
+"""Add version column for ETags
+
+Revision ID: 5b7e1c9a2d64
+Revises: 3f2c8d41b7e9
+Create Date: 2026-10-18 11:26:08.447193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e1c9a2d64'
+down_revision = '3f2c8d41b7e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('task', sa.Column('version', sa.Integer(), nullable=False,
+                                    server_default='1'))
+
+
+def downgrade():
+    # Not batch mode: rebuilding the table trips over the generated
+    # rank columns, and SQLite can drop a plain column in place
+    op.drop_column('task', 'version')
@@ -0,0 +1,40 @@
+"""Add updated_on column, archiving goes by the last write of a task
+
+Revision ID: 625eeed575b8
+Revises: 7672d09fd76a
+Create Date: 2026-10-18 16:04:51.627310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '625eeed575b8'
+down_revision = '7672d09fd76a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('task', sa.Column('updated_on', sa.Date(), nullable=True))
+    op.add_column('task_archive',
+                  sa.Column('updated_on', sa.Date(), nullable=True))
+
+    # When existing tasks were completed is not known, they count as
+    # written today so none is archived earlier than it should be. Not a
+    # change of the tasks, the change feed trigger is left out meanwhile.
+    trigger = op.get_bind().execute(sa.text(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' "
+        "AND name = 'task_changes_update'")).scalar()
+    if trigger is not None:
+        op.execute('DROP TRIGGER task_changes_update')
+    op.execute("UPDATE task SET updated_on = date('now', 'localtime')")
+    if trigger is not None:
+        op.execute(trigger)
+    op.execute("UPDATE task_archive SET updated_on = archived_on")
+
+
+def downgrade():
+    op.drop_column('task_archive', 'updated_on')
+    op.drop_column('task', 'updated_on')
@@ -0,0 +1,83 @@
+"""Add task archive table and stop reusing task ids
+
+Revision ID: 7672d09fd76a
+Revises: 97cd01f315e9
+Create Date: 2026-10-18 14:51:37.204118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7672d09fd76a'
+down_revision = '97cd01f315e9'
+branch_labels = None
+depends_on = None
+
+
+PRIORITY_RANK = ("CASE priority WHEN 'Low' THEN 1 WHEN 'Medium' THEN 2 "
+                 "WHEN 'High' THEN 3 ELSE 4 END")
+STATUS_RANK = ("CASE status WHEN 'Pending' THEN 1 WHEN 'In Progress' THEN 2 "
+               "WHEN 'Completed' THEN 3 ELSE 4 END")
+STORED_COLUMNS = 'id, name, priority, due_on, status, created_on, version'
+
+
+def _rebuild_task(autoincrement):
+    # SQLite only sets AUTOINCREMENT when a table is created. Dropping the
+    # old table drops its indexes and triggers, the same ones come back.
+    schema = op.get_bind().execute(sa.text(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'task' "
+        "AND type IN ('index', 'trigger') AND sql IS NOT NULL "
+        "ORDER BY type")).scalars().all()
+    op.create_table('_task_rebuild',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=50), nullable=True),
+    sa.Column('priority', sa.String(length=20), nullable=True),
+    sa.Column('due_on', sa.Date(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=True),
+    sa.Column('created_on', sa.Date(), nullable=True),
+    sa.Column('version', sa.Integer(), server_default='1', nullable=False),
+    sa.Column('priority_rank', sa.Integer(), sa.Computed(PRIORITY_RANK), nullable=True),
+    sa.Column('status_rank', sa.Integer(), sa.Computed(STATUS_RANK), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=autoincrement
+    )
+    op.execute(f'INSERT INTO _task_rebuild({STORED_COLUMNS}) '
+               f'SELECT {STORED_COLUMNS} FROM task')
+    op.drop_table('task')
+    op.rename_table('_task_rebuild', 'task')
+    for statement in schema:
+        op.execute(statement)
+
+
+def upgrade():
+    # Archived ids must not be handed out again to new tasks
+    _rebuild_task(autoincrement=True)
+
+    op.create_table('task_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('name', sa.String(length=50), nullable=True),
+    sa.Column('priority', sa.String(length=20), nullable=True),
+    sa.Column('due_on', sa.Date(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=True),
+    sa.Column('created_on', sa.Date(), nullable=True),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('priority_rank', sa.Integer(), sa.Computed("CASE priority WHEN 'Low' THEN 1 WHEN 'Medium' THEN 2 WHEN 'High' THEN 3 ELSE 4 END", ), nullable=True),
+    sa.Column('status_rank', sa.Integer(), sa.Computed("CASE status WHEN 'Pending' THEN 1 WHEN 'In Progress' THEN 2 WHEN 'Completed' THEN 3 ELSE 4 END", ), nullable=True),
+    sa.Column('archived_on', sa.Date(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    # Archived tasks go back to the task table rather than being lost
+    op.execute('''
+        INSERT INTO task(id, name, priority, due_on, status, created_on,
+                         version)
+        SELECT id, name, priority, due_on, status, created_on, version
+        FROM task_archive
+    ''')
+    op.drop_table('task_archive')
+
+    _rebuild_task(autoincrement=False)
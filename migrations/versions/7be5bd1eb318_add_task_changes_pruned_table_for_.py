@@ -0,0 +1,27 @@
+"""Add task_changes_pruned table for change feed retention
+
+Revision ID: 7be5bd1eb318
+Revises: bfd0facd6830
+Create Date: 2026-10-18 03:53:45.181650
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7be5bd1eb318'
+down_revision = 'bfd0facd6830'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task_changes_pruned',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+
+
+def downgrade():
+    op.drop_table('task_changes_pruned')
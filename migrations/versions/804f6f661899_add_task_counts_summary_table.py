@@ -0,0 +1,81 @@
+"""Add task_counts summary table maintained by triggers
+
+Revision ID: 804f6f661899
+Revises: 5b7e1c9a2d64
+Create Date: 2026-10-18 12:26:46.496574
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '804f6f661899'
+down_revision = '5b7e1c9a2d64'
+branch_labels = None
+depends_on = None
+
+MATCH_NEW = ("status IS new.status AND priority IS new.priority "
+             "AND due_on IS new.due_on")
+MATCH_OLD = ("status IS old.status AND priority IS old.priority "
+             "AND due_on IS old.due_on")
+INCREMENT_NEW = f'''
+    UPDATE task_counts SET task_count = task_count + 1 WHERE {MATCH_NEW};
+    INSERT INTO task_counts(status, priority, due_on, task_count)
+    SELECT new.status, new.priority, new.due_on, 1
+    WHERE NOT EXISTS (SELECT 1 FROM task_counts WHERE {MATCH_NEW});
+'''
+DECREMENT_OLD = f'''
+    UPDATE task_counts SET task_count = task_count - 1 WHERE {MATCH_OLD};
+    DELETE FROM task_counts WHERE {MATCH_OLD} AND task_count <= 0;
+'''
+
+
+def upgrade():
+    op.create_table('task_counts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=True),
+    sa.Column('priority', sa.String(length=20), nullable=True),
+    sa.Column('due_on', sa.Date(), nullable=True),
+    sa.Column('task_count', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('task_counts', schema=None) as batch_op:
+        batch_op.create_index('ix_task_counts_key',
+                              ['status', 'priority', 'due_on'], unique=True)
+
+    op.execute(f'''
+        CREATE TRIGGER task_counts_insert AFTER INSERT ON task BEGIN
+            {INCREMENT_NEW}
+        END
+    ''')
+    op.execute(f'''
+        CREATE TRIGGER task_counts_delete AFTER DELETE ON task BEGIN
+            {DECREMENT_OLD}
+        END
+    ''')
+    op.execute(f'''
+        CREATE TRIGGER task_counts_update
+        AFTER UPDATE OF status, priority, due_on ON task
+        WHEN old.status IS NOT new.status OR old.priority IS NOT new.priority
+            OR old.due_on IS NOT new.due_on
+        BEGIN
+            {DECREMENT_OLD}
+            {INCREMENT_NEW}
+        END
+    ''')
+    op.execute('''
+        INSERT INTO task_counts(status, priority, due_on, task_count)
+        SELECT status, priority, due_on, count(*) FROM task
+        GROUP BY status, priority, due_on
+    ''')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER task_counts_update')
+    op.execute('DROP TRIGGER task_counts_delete')
+    op.execute('DROP TRIGGER task_counts_insert')
+    with op.batch_alter_table('task_counts', schema=None) as batch_op:
+        batch_op.drop_index('ix_task_counts_key')
+
+    op.drop_table('task_counts')
@@ -0,0 +1,26 @@
+"""Add index on created_on for created date range filters
+
+Revision ID: 97cd01f315e9
+Revises: a368ab3844af
+Create Date: 2026-10-18 14:22:48.902115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '97cd01f315e9'
+down_revision = 'a368ab3844af'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_task_created_on'), ['created_on'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_task_created_on'))
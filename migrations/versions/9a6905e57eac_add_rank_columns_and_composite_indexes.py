@@ -0,0 +1,55 @@
+"""Add rank columns and composite indexes for get_tasks filters and sorts
+
+Revision ID: 9a6905e57eac
+Revises: 1ccb6223343c
+Create Date: 2026-10-18 09:12:41.208315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6905e57eac'
+down_revision = '1ccb6223343c'
+branch_labels = None
+depends_on = None
+
+PRIORITY_RANK = ("CASE priority WHEN 'Low' THEN 1 WHEN 'Medium' THEN 2 "
+                 "WHEN 'High' THEN 3 ELSE 4 END")
+STATUS_RANK = ("CASE status WHEN 'Pending' THEN 1 WHEN 'In Progress' THEN 2 "
+               "WHEN 'Completed' THEN 3 ELSE 4 END")
+
+INDEXES = [
+    ('ix_task_priority_rank', ['priority_rank']),
+    ('ix_task_status_rank', ['status_rank']),
+    ('ix_task_status_name', ['status', 'name']),
+    ('ix_task_status_due_on', ['status', 'due_on']),
+    ('ix_task_status_priority_rank', ['status', 'priority_rank']),
+    ('ix_task_priority_name', ['priority', 'name']),
+    ('ix_task_priority_due_on', ['priority', 'due_on']),
+    ('ix_task_priority_status_rank', ['priority', 'status_rank']),
+    ('ix_task_priority_status', ['priority', 'status']),
+    ('ix_task_priority_status_due_on', ['priority', 'status', 'due_on']),
+]
+
+
+def upgrade():
+    # Virtual generated columns can be added without rebuilding the table
+    op.add_column('task', sa.Column('priority_rank', sa.Integer(),
+                                    sa.Computed(PRIORITY_RANK)))
+    op.add_column('task', sa.Column('status_rank', sa.Integer(),
+                                    sa.Computed(STATUS_RANK)))
+
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        for name, columns in INDEXES:
+            batch_op.create_index(name, columns, unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        for name, _ in reversed(INDEXES):
+            batch_op.drop_index(name)
+
+    op.drop_column('task', 'status_rank')
+    op.drop_column('task', 'priority_rank')
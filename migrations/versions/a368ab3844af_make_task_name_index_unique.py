@@ -0,0 +1,37 @@
+"""Make the task name index unique
+
+Revision ID: a368ab3844af
+Revises: b4cb552d9cb4
+Create Date: 2026-10-18 13:41:05.671138
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a368ab3844af'
+down_revision = 'b4cb552d9cb4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    duplicates = op.get_bind().execute(sa.text(
+        'SELECT name FROM task GROUP BY name HAVING count(*) > 1 LIMIT 10'
+    )).scalars().all()
+    if duplicates:
+        # Which copy to keep is not ours to decide
+        raise RuntimeError(
+            'Rename or delete the tasks sharing these names before '
+            f'upgrading: {", ".join(map(repr, duplicates))}')
+
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_task_name'))
+        batch_op.create_index(batch_op.f('ix_task_name'), ['name'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_task_name'))
+        batch_op.create_index(batch_op.f('ix_task_name'), ['name'], unique=False)
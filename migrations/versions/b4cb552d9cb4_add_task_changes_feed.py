@@ -0,0 +1,48 @@
+"""Add task_changes change feed written by triggers
+
+Revision ID: b4cb552d9cb4
+Revises: 804f6f661899
+Create Date: 2026-10-18 13:02:17.318240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4cb552d9cb4'
+down_revision = '804f6f661899'
+branch_labels = None
+depends_on = None
+
+OPERATIONS = [('insert', 'new'), ('update', 'new'), ('delete', 'old')]
+
+
+def upgrade():
+    op.create_table('task_changes',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('operation', sa.String(length=6), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+
+    for operation, row in OPERATIONS:
+        op.execute(f'''
+            CREATE TRIGGER task_changes_{operation}
+            AFTER {operation.upper()} ON task BEGIN
+                INSERT INTO task_changes(task_id, operation)
+                VALUES ({row}.id, '{operation}');
+            END
+        ''')
+    # Existing tasks enter the feed as inserts, so since=0 is a full sync
+    op.execute('''
+        INSERT INTO task_changes(task_id, operation)
+        SELECT id, 'insert' FROM task ORDER BY id
+    ''')
+
+
+def downgrade():
+    for operation, _ in reversed(OPERATIONS):
+        op.execute(f'DROP TRIGGER task_changes_{operation}')
+    op.drop_table('task_changes')
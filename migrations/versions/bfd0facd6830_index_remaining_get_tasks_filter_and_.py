@@ -0,0 +1,39 @@
+"""Index the remaining get_tasks filter and sort combinations
+
+Revision ID: bfd0facd6830
+Revises: 625eeed575b8
+Create Date: 2026-10-18 16:41:09.513872
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bfd0facd6830'
+down_revision = '625eeed575b8'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_task_due_on_name', ['due_on', 'name']),
+    ('ix_task_due_on_priority_rank', ['due_on', 'priority_rank']),
+    ('ix_task_due_on_status_rank', ['due_on', 'status_rank']),
+    ('ix_task_due_on_created_on', ['due_on', 'created_on']),
+    ('ix_task_status_created_on', ['status', 'created_on']),
+    ('ix_task_priority_created_on', ['priority', 'created_on']),
+    ('ix_task_priority_status_created_on',
+     ['priority', 'status', 'created_on']),
+]
+
+
+def upgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        for name, columns in INDEXES:
+            batch_op.create_index(name, columns, unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        for name, _ in reversed(INDEXES):
+            batch_op.drop_index(name)
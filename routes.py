@@ -1,25 +1,68 @@
 import time
 import uuid
-from flask import jsonify, request, g, Blueprint
-from config import db
-from task_models import Task, task_schema, tasks_schema
+import task_models
+from flask import (jsonify, request, g, Blueprint, Response, current_app,
+                   stream_with_context)
+from config import db, read_bind_arguments
+from task_models import (Task, TaskChangesPruned, task_schema,
+                         bulk_tasks_schema, task_dict_schema)
 from marshmallow import ValidationError
-from datetime import datetime
-from sqlalchemy import case, select
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from task_cache import (cache_key, collection_etag, current_generation,
+                        mark_tasks_changed, task_etag)
+from task_compression import compress_response
 from task_logging import StructuredLogger
-from functools import wraps
-from sqlalchemy.exc import SQLAlchemyError
+from task_metrics import (PROMETHEUS_CONTENT_TYPE, phase, render_metrics,
+                          set_action, start_request, stop_profiler)
+from task_shards import TaskNameTaken
+from task_writer import TaskWriterError
+from task_serializer import (JSON_MIMETYPE, NDJSON_MIMETYPE, encode_listing,
+                             json_response, listing_mimetypes,
+                             listing_serializer, negotiate_listing,
+                             task_serializer, to_json_bytes, to_json_lines)
+from task_queries import (MAX_PAGE_SIZE, InvalidQueryArgument,
+                          build_changes_query, build_stats_query,
+                          build_update_query, encode_cursor, parse_flag,
+                          parse_limit, parse_since, parse_wait,
+                          prepare_tasks_query, search_index_available,
+                          stats_summary_available, summarize_stats)
+from functools import partial, wraps
+from itertools import chain
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 
 api_logger = StructuredLogger(__name__)
 api_bp = Blueprint('api', __name__)
 
+# Rows fetched from the cursor per chunk of a streamed listing
+STREAM_BATCH_SIZE = 500
+# Listing formats that can be streamed, the others are built in memory
+STREAMED_MIMETYPES = (JSON_MIMETYPE, NDJSON_MIMETYPE)
+# Upper bound on items accepted by the /api/tasks/bulk endpoints
+MAX_BULK_ITEMS = 10000
+# Values per IN (...) lookup, well below SQLite's bound parameter limit
+IN_CLAUSE_CHUNK_SIZE = 500
+# How often a waiting change feed request checks the generation counter
+CHANGES_POLL_INTERVAL = 0.1
+# Server-Sent Events connections are closed after this many seconds,
+# with a comment line every CHANGES_HEARTBEAT seconds while idle
+CHANGES_STREAM_SECONDS = 300
+CHANGES_HEARTBEAT = 15
+# Endpoints that need all tasks in one database, 501 with TASK_SHARDS
+UNSHARDED_ENDPOINTS = {
+    "api.get_task_stats", "api.get_task_changes", "api.patch_task",
+    "api.patch_tasks", "api.upsert_task", "api.bulk_add_tasks",
+    "api.bulk_update_tasks", "api.bulk_delete_tasks",
+}
+
 
 def log_api_action(action_name):
     # Decorator to log each api action
     def decorator(f):
         @wraps(f)
         def decorated_func(*args, **kwargs):
+            set_action(action_name)
             api_logger.info(f"{action_name}_started",
                             endpoint=request.endpoint,
                             args=str(args),
@@ -61,6 +104,7 @@ def log_api_action(action_name):
 def before_request():
     g.request_id = str(uuid.uuid4())
     g.start_time = time.time()
+    start_request()
     api_logger.info(
         "request started",
         method=request.method,
@@ -69,138 +113,463 @@ def before_request():
         user_agent=request.headers.get('User-Agent', ''),
         content_type=request.content_type
     )
+    if request.endpoint in UNSHARDED_ENDPOINTS and \
+            _task_shards() is not None:
+        api_logger.error("not_sharded", endpoint=request.endpoint)
+        return jsonify({"error": "Not available with sharded storage",
+                        "status": 501}), 501
+
+
+def _task_shards():
+    return current_app.extensions.get("task_shards")
 
 
 @api_bp.after_request
 def after_request(response):
-    duration = time.time() - g.start_time
+    with phase("serialization"):
+        response = compress_response(
+            response, request.accept_encodings,
+            current_app.config["COMPRESSION_MIN_SIZE"])
+    log_fields = {
+        "method": request.method,
+        "path": request.path,
+        "status_code": response.status_code,
+        "request_id": g.request_id
+    }
+    request_metrics = g.get("request_metrics")
+    if request_metrics is not None and request_metrics.profiler is not None:
+        stop_profiler(request_metrics, g.request_id)
+        response.headers["X-Profile-Id"] = g.request_id
+    if response.is_streamed:
+        # Count bytes as the server sends them instead of buffering here
+        response.response = CountingIterable(
+            response.response,
+            partial(_log_request_completed, g.start_time, log_fields,
+                    request_metrics))
+    else:
+        size = response.content_length
+        if size is None:
+            size = response.calculate_content_length()
+        _log_request_completed(g.start_time, log_fields, request_metrics,
+                               size)
+    return response
+
+
+def _log_request_completed(start_time, log_fields, request_metrics,
+                           response_size):
+    duration = time.time() - start_time
+    if request_metrics is not None:
+        request_metrics.finish(log_fields["status_code"], duration)
     api_logger.info(
         "request_completed",
-        method=request.method,
-        path=request.path,
-        status_code=response.status_code,
         duration_ms=round(duration * 1000, 2),
-        response_size=len(response.get_data())
+        response_size=response_size,
+        **log_fields
     )
-    return response
+
+
+class CountingIterable:
+    '''Wraps a streamed response body and reports its size once sent'''
+
+    def __init__(self, iterable, on_complete):
+        self.iterable = iterable
+        self.on_complete = on_complete
+        self.size = 0
+        self._completed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.iterable:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                self.size += len(chunk)
+                yield chunk
+        finally:
+            self._complete()
+
+    def close(self):
+        close = getattr(self.iterable, "close", None)
+        if close is not None:
+            close()
+        self._complete()
+
+    def _complete(self):
+        if not self._completed:
+            self._completed = True
+            self.on_complete(self.size)
 
 
 @api_bp.route("/api/tasks", methods=["GET"])
 @log_api_action("get_tasks")
 def get_tasks():
-    query = select(Task)
+    # Read before querying, so a write racing the query changes the
+    # generation and invalidates what we are about to build
+    mimetype = negotiate_listing(request.accept_mimetypes)
+    if mimetype is None:
+        api_logger.error("not_acceptable",
+                         accept=request.headers.get("Accept"))
+        return jsonify({"error": "Not acceptable", "status": 406,
+                        "details": f"supported formats are "
+                                   f"{listing_mimetypes()}"}), 406
 
-    search_term = request.args.get("search")
-    if search_term:
-        query = query.where(Task.name.ilike(f'%{search_term}%'))
+    key = (cache_key(request.args), mimetype)
+    generation = current_generation()
+    etag = collection_etag(generation, key)
+    if request.if_none_match.contains_weak(etag):
+        response = _not_modified(etag)
+        response.vary.add("Accept")
+        return response
 
-    priority = request.args.get("priority")
-    if priority:
-        query = query.where(Task.priority == priority)
+    cache = current_app.extensions.get("response_cache")
+    # Shards are merged in memory, there is no single cursor to stream
+    streaming = request.args.get("limit") is None and \
+        parse_flag(request.args.get("stream")) and \
+        mimetype in STREAMED_MIMETYPES and _task_shards() is None
+    if cache is not None and not streaming:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached.to_response()
 
-    due_date = request.args.get("due_on")
-    if due_date:
-        try:
-            parsed_date = datetime.strptime(due_date, "%Y-%m-%d").date()
-            query = query.where(Task.due_on == parsed_date)
-        except ValueError as err:
-            api_logger.error("invalid_date_entered",
-                             reason=str(err))
-            return jsonify({"error": "Invalid date format",
-                            "details": str(err),
-                            "status": 400}), 400
-
-    status = request.args.get("status")
-    if status:
-        query = query.where(Task.status == status)
-
-    sort_on = request.args.get("sort")
-    if sort_on and not hasattr(Task, sort_on):
-        api_logger.error("invalid_sort_field",
-                         details="sort field needs to be in "
-                         "['name', 'due_date', 'priority', 'status', 'id']")
-        return jsonify({"error": "Invalid sort field", "status": 400}), 400
-    if sort_on:
-        if sort_on == "priority":
-            priority_case = case(
-                (Task.priority == "Low", 1),
-                (Task.priority == "Medium", 2),
-                (Task.priority == "High", 3),
-                else_=4
-            )
-            query = query.order_by(priority_case)
-        elif sort_on == "status":
-            status_case = case(
-                (Task.status == "Pending", 1),
-                (Task.status == "In Progress", 2),
-                (Task.status == "Completed", 3),
-                else_=4  # fallback for any unexpected values
-            )
-            query = query.order_by(status_case)
-        else:
-            query = query.order_by(getattr(Task, sort_on))
+    result = _list_tasks(mimetype, streaming)
+    if isinstance(result, Response) and result.status_code == 200:
+        result.set_etag(etag)
+        result.vary.add("Accept")
+        if cache is not None and not streaming:
+            cache.set(key, result, generation)
+    return result
 
-    result = db.session.execute(query)
-    tasks = result.scalars().all()
 
-    if tasks:
-        return jsonify(tasks_schema.dump(tasks))
+def _not_modified(etag):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def _list_tasks(mimetype, streaming):
+    shards = _task_shards()
+    try:
+        search_index = bool(request.args.get("search")) and (
+            search_index_available(db.session) if shards is None
+            else shards.search_index_available())
+        limit = request.args.get("limit")
+        if limit is not None:
+            limit = parse_limit(limit)
+        serializer = listing_serializer(request.args.get("fields"))
+        # Plain column tuples, serialized without ORM objects or
+        # marshmallow. One extra row tells us whether another page exists.
+        query, params, sort_key = prepare_tasks_query(
+            request.args, search_index, serializer.columns,
+            None if limit is None else limit + 1, merge=shards is not None)
+    except InvalidQueryArgument as err:
+        api_logger.error(err.event, reason=err.details)
+        body = {"error": err.error, "status": 400}
+        if err.details:
+            body["details"] = err.details
+        return jsonify(body), 400
+
+    if shards is not None:
+        with phase("db_query"):
+            rows = shards.list_tasks(query, params, sort_key,
+                                     None if limit is None else limit + 1)
+    elif streaming:
+        return _stream_tasks(query, params, serializer, mimetype)
     else:
+        result = db.session.execute(query, params,
+                                    bind_arguments=read_bind_arguments())
+        with phase("hydration"):
+            rows = result.all()
+
+    if not rows:
         api_logger.error("task_not_found",)
         return jsonify({"error": "data not found", "status": 404}), 404
+    if limit is not None:
+        return _tasks_page(rows, limit, sort_key, serializer, mimetype)
+    return _listing_response(serializer, rows, mimetype)
+
+
+def _listing_response(serializer, rows, mimetype):
+    with phase("serialization"):
+        body = encode_listing(serializer, rows, mimetype)
+    return current_app.response_class(body, mimetype=mimetype)
+
+
+def _tasks_page(rows, limit, sort_key, serializer, mimetype):
+    response = _listing_response(serializer, rows[:limit], mimetype)
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            rows[limit - 1], sort_key)
+    return response
+
+
+def _stream_tasks(query, params, serializer, mimetype):
+    result = db.session.execute(
+        query, params,
+        execution_options={"yield_per": STREAM_BATCH_SIZE},
+        bind_arguments=read_bind_arguments())
+    partitions = result.partitions()
+    with phase("hydration"):
+        first_batch = next(partitions, None)
+    if not first_batch:
+        result.close()
+        api_logger.error("task_not_found",)
+        return jsonify({"error": "data not found", "status": 404}), 404
+
+    def generate():
+        try:
+            separator = b"["
+            for batch in chain([first_batch], partitions):
+                if mimetype == NDJSON_MIMETYPE:
+                    with phase("serialization"):
+                        yield to_json_lines(serializer.dump(batch))
+                    continue
+                # Each batch is encoded as an array, its brackets dropped
+                with phase("serialization"):
+                    body = to_json_bytes(serializer.dump(batch))
+                yield separator + body[1:body.rindex(b"]")]
+                separator = b","
+            if mimetype != NDJSON_MIMETYPE:
+                yield b"]\n"
+        finally:
+            result.close()
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+@api_bp.route("/api/tasks/stats", methods=["GET"])
+@log_api_action("get_task_stats")
+def get_task_stats():
+    # Due date buckets move at midnight even when no task changed
+    today = task_models.today()
+    etag = collection_etag(current_generation(),
+                           ("stats", today.isoformat()))
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+
+    summary = current_app.config["STATS_SUMMARY_ENABLED"] and \
+        stats_summary_available(db.session)
+    rows = db.session.execute(build_stats_query(today, summary),
+                              bind_arguments=read_bind_arguments()).all()
+    response = jsonify(summarize_stats(rows))
+    response.set_etag(etag)
+    return response
+
+
+@api_bp.route("/api/tasks/changes", methods=["GET"])
+@log_api_action("get_task_changes")
+def get_task_changes():
+    streaming = request.accept_mimetypes.best == "text/event-stream"
+    try:
+        # EventSource reconnects with the id of the last event it saw
+        since = parse_since(request.args.get(
+            "since", request.headers.get("Last-Event-ID", "0")))
+        limit = parse_limit(request.args.get("limit", MAX_PAGE_SIZE))
+        wait = request.args.get("wait")
+        wait = parse_wait(wait) if wait is not None else None
+    except InvalidQueryArgument as err:
+        api_logger.error(err.event, reason=err.details)
+        return jsonify({"error": err.error, "status": 400,
+                        "details": err.details}), 400
+
+    # Deletions up to the pruned seq are gone, only a full sync is exact
+    pruned_seq = db.session.scalar(select(TaskChangesPruned.seq),
+                                   bind_arguments=read_bind_arguments())
+    if since and pruned_seq and since < pruned_seq:
+        api_logger.error("changes_pruned", since=since, pruned_seq=pruned_seq)
+        return jsonify({"error": "Changes pruned", "status": 410,
+                        "details": f"changes up to seq {pruned_seq} were "
+                                   f"removed, sync again from since=0"}), 410
+
+    if streaming:
+        duration = wait if wait is not None else CHANGES_STREAM_SECONDS
+        return _stream_changes(since, duration)
+
+    # Read the generation first, a write after it wakes the wait below
+    generation = current_generation()
+    changes = _read_changes(since, limit)
+    deadline = time.monotonic() + (wait or 0)
+    while not changes and time.monotonic() < deadline:
+        if _wait_for_change(generation, deadline - time.monotonic()):
+            generation = current_generation()
+            changes = _read_changes(since, limit)
+
+    return jsonify({"changes": changes,
+                    "last_seq": changes[-1]["seq"] if changes else since})
+
+
+def _read_changes(since, limit):
+    rows = db.session.execute(
+        build_changes_query(since, limit, task_serializer.columns),
+        bind_arguments=read_bind_arguments()).all()
+    # Hand the connection back while a long poll sleeps
+    db.session.close()
+    return [{"seq": row[0], "id": row[1], "deleted": True}
+            if row[2] is None else
+            {"seq": row[0], "id": row[1], "deleted": False,
+             "task": task_serializer.dump_one(row[3:])}
+            for row in rows]
+
+
+def _wait_for_change(generation, timeout):
+    '''Sleep until a write moves the generation counter or timeout passes'''
+    deadline = time.monotonic() + timeout
+    while current_generation() == generation:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+    return True
+
+
+def _stream_changes(since, duration):
+    def generate():
+        last_seq = since
+        deadline = time.monotonic() + duration
+        yield b"retry: 1000\n\n"
+        while True:
+            generation = current_generation()
+            changes = _read_changes(last_seq, MAX_PAGE_SIZE)
+            for change in changes:
+                data = to_json_bytes(change).rstrip(b"\n")
+                yield b"id: %d\nevent: change\ndata: %s\n\n" % (
+                    change["seq"], data)
+            if changes:
+                last_seq = changes[-1]["seq"]
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not _wait_for_change(generation,
+                                    min(CHANGES_HEARTBEAT, remaining)):
+                yield b": keep-alive\n\n"
+
+    response = Response(stream_with_context(generate()),
+                        mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 @api_bp.route("/api/tasks", methods=["POST"])
 @log_api_action("create_task")
 def add_task():
+    store = _task_store()
     try:
-        new_task = task_schema.load(request.get_json())
+        with phase("validation"):
+            # Stores write plain values, there is no session to add to
+            new_task = (task_schema if store is None
+                        else task_dict_schema).load(request.get_json())
     except ValidationError as err:
         api_logger.error("task_validation_failed",
                          reason=err.messages)
         return jsonify({"error": "Invalid data",
                         "details": err.messages,
                         "status": 400}), 400
+    if store is not None:
+        return _add_task_row(store, new_task)
 
-    task = db.session.execute(select(Task).where(Task.name ==
-                                                 new_task.name)).scalar()
-    if task:
-        api_logger.error("task_creation_failed",
-                         reason="task already exists")
-        return jsonify({"error": "Task already exists", "status": 406}), 406
-
+    # The unique name index rejects duplicates, no need to look first
     try:
         db.session.add(new_task)
         db.session.commit()
-        return jsonify(task_schema.dump(new_task)), 201
+        mark_tasks_changed()
+        with phase("serialization"):
+            response = jsonify(task_schema.dump(new_task))
+        response.set_etag(task_etag(new_task.id, new_task.version))
+        return response, 201
+    except IntegrityError:
+        db.session.rollback()
+        return _task_exists()
     except SQLAlchemyError as err:
         db.session.rollback()
         api_logger.error("database_error", error=str(err))
         return jsonify({"error": "Database error", "status": 500}), 500
 
 
+def _task_store():
+    '''The shards or the group commit writer, None for the session'''
+    shards = _task_shards()
+    if shards is not None:
+        return shards
+    return current_app.extensions.get("task_writer")
+
+
+def _writer_unavailable(err):
+    api_logger.error("task_write_failed", error=str(err))
+    return jsonify({"error": "Service unavailable", "status": 503,
+                    "details": str(err)}), 503
+
+
+def _add_task_row(store, values):
+    try:
+        row = store.insert(values, [*task_serializer.columns, Task.version])
+    except (IntegrityError, TaskNameTaken):
+        return _task_exists()
+    except TaskWriterError as err:
+        return _writer_unavailable(err)
+    except SQLAlchemyError as err:
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+
+    mark_tasks_changed()
+    with phase("serialization"):
+        response = json_response(task_serializer.dump_one(row), 201)
+    response.set_etag(task_etag(row.id, row.version))
+    return response
+
+
 @api_bp.route("/api/tasks/<int:task_id>", methods=["GET"])
 @log_api_action("get_task_by_id")
 def get_task(task_id):
-    task = db.session.get(Task, task_id)
-    if task:
-        return jsonify(task_schema.dump(task))
+    if request.if_none_match:
+        # Compare against the version alone before loading the whole row
+        version = _read_task(
+            task_id, select(Task.version).where(Task.id == task_id)).scalar()
+        if version is not None and request.if_none_match.contains_weak(
+                task_etag(task_id, version)):
+            return _not_modified(task_etag(task_id, version))
+
+    result = _read_task(task_id,
+                        select(*task_serializer.columns, Task.version)
+                        .where(Task.id == task_id))
+    with phase("hydration"):
+        row = result.first()
+    if row:
+        with phase("serialization"):
+            response = json_response(task_serializer.dump_one(row))
+        response.set_etag(task_etag(task_id, row.version))
+        return response
     else:
         api_logger.error("task_not_found",)
         return jsonify({"error": "data not found", "status": 404}), 404
 
 
+def _read_task(task_id, statement):
+    shards = _task_shards()
+    if shards is not None:
+        return shards.execute(task_id, statement)
+    return db.session.execute(statement,
+                              bind_arguments=read_bind_arguments())
+
+
 @api_bp.route("/api/tasks/<int:task_id>", methods=["PUT"])
 @log_api_action("update_task")
 def update_task(task_id):
+    store = _task_store()
+    if store is not None:
+        return _update_task_row(store, task_id)
     task_to_update = db.session.get(Task, task_id)
     if not task_to_update:
         api_logger.error("task_not_found",)
         return jsonify({"error": "Data not found", "status": 404}), 404
     try:
-        task_schema.load(request.get_json(), instance=task_to_update)
+        with phase("validation"):
+            task_schema.load(request.get_json(), instance=task_to_update)
         db.session.commit()
-        return jsonify(task_schema.dump(task_to_update)), 200
+        mark_tasks_changed()
+        with phase("serialization"):
+            response = jsonify(task_schema.dump(task_to_update))
+        response.set_etag(task_etag(task_to_update.id,
+                                    task_to_update.version))
+        return response, 200
 
     except ValidationError as err:
         api_logger.error(
@@ -210,15 +579,216 @@ def update_task(task_id):
         return jsonify({"error": "invalid data", "status": 400,
                         "details": err.messages}), 400
 
+    except IntegrityError:
+        db.session.rollback()
+        return _task_exists()
+
     except SQLAlchemyError as err:
         db.session.rollback()
         api_logger.error("database_error", error=str(err))
         return jsonify({"error": "Database error", "status": 500}), 500
 
 
+def _update_task_row(store, task_id):
+    if _read_task(task_id,
+                  select(Task.id).where(Task.id == task_id)).first() is None:
+        api_logger.error("task_not_found",)
+        return jsonify({"error": "Data not found", "status": 404}), 404
+    try:
+        with phase("validation"):
+            values = task_dict_schema.load(request.get_json())
+    except ValidationError as err:
+        api_logger.error("task_validation_failed", reason=err.messages)
+        return jsonify({"error": "invalid data", "status": 400,
+                        "details": err.messages}), 400
+
+    try:
+        row = store.update(task_id, values,
+                           [*task_serializer.columns, Task.version])
+    except (IntegrityError, TaskNameTaken):
+        return _task_exists()
+    except TaskWriterError as err:
+        return _writer_unavailable(err)
+    except SQLAlchemyError as err:
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+    if row is None:
+        # Deleted since the check above
+        api_logger.error("task_not_found",)
+        return jsonify({"error": "Data not found", "status": 404}), 404
+
+    mark_tasks_changed()
+    with phase("serialization"):
+        response = json_response(task_serializer.dump_one(row))
+    response.set_etag(task_etag(task_id, row.version))
+    return response
+
+
+@api_bp.route("/api/tasks/<int:task_id>", methods=["PATCH"])
+@log_api_action("patch_task")
+def patch_task(task_id):
+    values, error = _load_patch()
+    if error:
+        return error
+
+    # Only the supplied columns are written, in one UPDATE ... RETURNING
+    statement = update(Task).where(Task.id == task_id).values(**values)
+    versions = _if_match_versions(task_id)
+    if versions is not None:
+        statement = statement.where(Task.version.in_(versions))
+    try:
+        row = db.session.execute(statement.returning(
+            *task_serializer.columns, Task.version)).first()
+        if row is None:
+            db.session.rollback()
+            if db.session.get(Task, task_id) is None:
+                api_logger.error("task_not_found",)
+                return jsonify({"error": "Data not found",
+                                "status": 404}), 404
+            api_logger.error("task_precondition_failed",
+                             reason="version does not match If-Match")
+            return jsonify({"error": "Task was modified",
+                            "status": 412}), 412
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return _task_exists()
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+
+    mark_tasks_changed()
+    with phase("serialization"):
+        response = json_response(task_serializer.dump_one(row))
+    response.set_etag(task_etag(task_id, row.version))
+    return response
+
+
+@api_bp.route("/api/tasks", methods=["PATCH"])
+@log_api_action("patch_tasks")
+def patch_tasks():
+    values, error = _load_patch()
+    if error:
+        return error
+    try:
+        search_index = bool(request.args.get("search")) and \
+            search_index_available(db.session)
+        statement = build_update_query(request.args, values, search_index)
+    except InvalidQueryArgument as err:
+        api_logger.error(err.event, reason=err.details)
+        body = {"error": err.error, "status": 400}
+        if err.details:
+            body["details"] = err.details
+        return jsonify(body), 400
+
+    try:
+        updated = db.session.execute(statement).rowcount
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return _task_exists()
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+
+    if updated:
+        mark_tasks_changed()
+    api_logger.info("tasks_patched", updated=updated)
+    return jsonify({"updated": updated}), 200
+
+
+def _load_patch():
+    payload = request.get_json()
+    try:
+        with phase("validation"):
+            # Partial, fields that were not sent are neither checked nor set
+            values = task_dict_schema.load(payload, partial=True)
+    except ValidationError as err:
+        api_logger.error("task_validation_failed", reason=err.messages)
+        return None, (jsonify({"error": "invalid data", "status": 400,
+                               "details": err.messages}), 400)
+    values.pop("id", None)
+    if not values:
+        api_logger.error("task_validation_failed", reason="no fields")
+        return None, (jsonify({"error": "invalid data", "status": 400,
+                               "details": "no fields to update"}), 400)
+    return values, None
+
+
+def _if_match_versions(task_id):
+    '''Versions of the task the If-Match header accepts, None for any'''
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    prefix = f"{task_id}-"
+    # Weak too, compressed responses carry the ETag as a weak one
+    return [int(etag[len(prefix):])
+            for etag in if_match.as_set(include_weak=True)
+            if etag.startswith(prefix) and etag[len(prefix):].isdigit()]
+
+
+@api_bp.route("/api/tasks/by-name/<name>", methods=["PUT"])
+@log_api_action("upsert_task")
+def upsert_task(name):
+    payload = request.get_json()
+    if isinstance(payload, dict) and payload.get("name", name) != name:
+        api_logger.error("task_validation_failed",
+                         reason="name does not match the URL")
+        return jsonify({"error": "invalid data", "status": 400,
+                        "details": {"name": ["Must match the URL."]}}), 400
+    try:
+        with phase("validation"):
+            data = task_dict_schema.load(
+                {**payload, "name": name} if isinstance(payload, dict)
+                else payload)
+    except ValidationError as err:
+        api_logger.error("task_validation_failed", reason=err.messages)
+        return jsonify({"error": "invalid data", "status": 400,
+                        "details": err.messages}), 400
+
+    data.pop("id", None)
+    # Overwrites the whole task, a due_on left out clears the old one
+    data.setdefault("due_on", None)
+    # Create or overwrite in one statement, ON CONFLICT on the name index
+    statement = sqlite_insert(Task).values(**data)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Task.name],
+        set_={**{key: statement.excluded[key] for key in data
+                 if key != "name"},
+              # ON CONFLICT DO UPDATE leaves out the onupdate defaults
+              "updated_on": statement.excluded.updated_on,
+              "version": Task.version + 1})
+    try:
+        row = db.session.execute(statement.returning(
+            *task_serializer.columns, Task.version)).one()
+        db.session.commit()
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+
+    mark_tasks_changed()
+    with phase("serialization"):
+        # A new row still has the version it was inserted with
+        response = json_response(task_serializer.dump_one(row),
+                                 201 if row.version == 1 else 200)
+    response.set_etag(task_etag(row.id, row.version))
+    return response
+
+
+def _task_exists():
+    api_logger.error("task_creation_failed", reason="task already exists")
+    return jsonify({"error": "Task already exists", "status": 406}), 406
+
+
 @api_bp.route("/api/tasks/<int:task_id>", methods=['DELETE'])
 @log_api_action("delete_task")
 def delete_task(task_id):
+    shards = _task_shards()
+    if shards is not None:
+        return _delete_sharded_task(shards, task_id)
     task_to_delete = db.session.get(Task, task_id)
     if not task_to_delete:
         api_logger.error("task_not_found",)
@@ -227,9 +797,239 @@ def delete_task(task_id):
     try:
         db.session.delete(task_to_delete)
         db.session.commit()
+        mark_tasks_changed()
         return jsonify({"message": "task successfully deleted"}), 200
 
     except SQLAlchemyError as err:
         db.session.rollback()
         api_logger.error("database_error", error=str(err))
         return jsonify({"error": "Database error", "status": 500}), 500
+
+
+def _delete_sharded_task(shards, task_id):
+    try:
+        deleted = shards.delete(task_id)
+    except SQLAlchemyError as err:
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+    if not deleted:
+        api_logger.error("task_not_found",)
+        return jsonify({"error": "data not found", "status": 404}), 404
+    mark_tasks_changed()
+    return jsonify({"message": "task successfully deleted"}), 200
+
+
+@api_bp.route("/api/tasks/bulk", methods=["POST"])
+@log_api_action("bulk_create_tasks")
+def bulk_add_tasks():
+    items, error = _bulk_payload()
+    if error:
+        return error
+
+    results = [None] * len(items)
+    rows, indexes = [], {}
+    loaded, errors = _bulk_load(items)
+    for index, data in enumerate(loaded):
+        if index in errors:
+            results[index] = _bulk_result(index, 400, error="Invalid data",
+                                          details=errors[index])
+        elif data["name"] in indexes:
+            results[index] = _bulk_result(index, 406,
+                                          error="Task already exists")
+        else:
+            data.pop("id", None)
+            data.setdefault("due_on", None)
+            rows.append(data)
+            indexes[data["name"]] = index
+
+    try:
+        if rows:
+            # Names already taken, also by a concurrent request, are
+            # skipped by the unique index instead of failing the batch
+            created = db.session.execute(
+                insert(Task).prefix_with("OR IGNORE").returning(
+                    Task.id, Task.name),
+                rows).all()
+            db.session.commit()
+            if created:
+                mark_tasks_changed()
+            for new_id, name in created:
+                index = indexes.pop(name)
+                results[index] = _bulk_result(index, 201, id=new_id)
+            for index in indexes.values():
+                results[index] = _bulk_result(index, 406,
+                                              error="Task already exists")
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+
+    return _bulk_response(results, 201, "bulk_tasks_created")
+
+
+@api_bp.route("/api/tasks/bulk", methods=["PATCH"])
+@log_api_action("bulk_update_tasks")
+def bulk_update_tasks():
+    items, error = _bulk_payload()
+    if error:
+        return error
+
+    results = [None] * len(items)
+    loaded, errors = _bulk_load(items, partial=True)
+    for index, data in enumerate(loaded):
+        if index not in errors and not isinstance(data.get("id"), int):
+            errors[index] = {"id": ["Missing data for required field."]}
+
+    candidates = [(index, data) for index, data in enumerate(loaded)
+                  if index not in errors]
+    existing_ids = set()
+    for chunk in _chunked([data["id"] for _, data in candidates]):
+        existing_ids.update(db.session.scalars(
+            select(Task.id).where(Task.id.in_(chunk))))
+    name_owners = {}
+    for chunk in _chunked([data["name"] for _, data in candidates
+                           if "name" in data]):
+        name_owners.update(db.session.execute(
+            select(Task.name, Task.id).where(Task.name.in_(chunk))).all())
+
+    rows, indexes, seen_ids = [], [], set()
+    for index, data in enumerate(loaded):
+        if index in errors:
+            results[index] = _bulk_result(index, 400, error="invalid data",
+                                          details=errors[index])
+        elif data["id"] not in existing_ids:
+            results[index] = _bulk_result(index, 404,
+                                          error="Data not found")
+        elif data["id"] in seen_ids:
+            results[index] = _bulk_result(
+                index, 400, error="invalid data",
+                details={"id": ["Task appears more than once in batch."]})
+        elif name_owners.get(data.get("name"), data["id"]) != data["id"]:
+            results[index] = _bulk_result(index, 406,
+                                          error="Task already exists")
+        else:
+            seen_ids.add(data["id"])
+            if "name" in data:
+                name_owners[data["name"]] = data["id"]
+            rows.append(data)
+            indexes.append(index)
+
+    try:
+        if rows:
+            db.session.execute(update(Task), rows)
+            db.session.commit()
+            mark_tasks_changed()
+            for index, data in zip(indexes, rows):
+                results[index] = _bulk_result(index, 200, id=data["id"])
+    except IntegrityError:
+        db.session.rollback()
+        return _task_exists()
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+
+    return _bulk_response(results, 200, "bulk_tasks_updated")
+
+
+@api_bp.route("/api/tasks/bulk", methods=["DELETE"])
+@log_api_action("bulk_delete_tasks")
+def bulk_delete_tasks():
+    items, error = _bulk_payload()
+    if error:
+        return error
+
+    results = [None] * len(items)
+    valid_ids = {item for item in items
+                 if isinstance(item, int) and not isinstance(item, bool)}
+    existing_ids = set()
+    for chunk in _chunked(list(valid_ids)):
+        existing_ids.update(db.session.scalars(
+            select(Task.id).where(Task.id.in_(chunk))))
+
+    deleted = set()
+    for index, item in enumerate(items):
+        if item not in valid_ids:
+            results[index] = _bulk_result(
+                index, 400, error="invalid data",
+                details={"id": ["Not a valid integer."]})
+        elif item not in existing_ids or item in deleted:
+            results[index] = _bulk_result(index, 404,
+                                          error="data not found")
+        else:
+            deleted.add(item)
+            results[index] = _bulk_result(index, 200, id=item)
+
+    try:
+        for chunk in _chunked(list(deleted)):
+            db.session.execute(delete(Task).where(Task.id.in_(chunk)))
+        db.session.commit()
+        mark_tasks_changed()
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        api_logger.error("database_error", error=str(err))
+        return jsonify({"error": "Database error", "status": 500}), 500
+
+    return _bulk_response(results, 200, "bulk_tasks_deleted")
+
+
+def _bulk_payload():
+    items = request.get_json()
+    if not isinstance(items, list) or not items:
+        api_logger.error("bulk_validation_failed",
+                         reason="body is not a non-empty JSON array")
+        return None, (jsonify({"error": "Invalid data",
+                               "details": "expected a non-empty JSON array",
+                               "status": 400}), 400)
+    if len(items) > MAX_BULK_ITEMS:
+        api_logger.error("bulk_validation_failed",
+                         reason="too many items", count=len(items))
+        return None, (jsonify({"error": "Invalid data",
+                               "details": f"at most {MAX_BULK_ITEMS} items "
+                                          "per request",
+                               "status": 400}), 400)
+    return items, None
+
+
+def _bulk_load(items, partial=False):
+    # Validate the whole batch in one pass, keeping the per-item errors
+    try:
+        with phase("validation"):
+            return bulk_tasks_schema.load(items, partial=partial), {}
+    except ValidationError as err:
+        return err.valid_data, err.messages
+
+
+def _chunked(values, size=None):
+    size = size or IN_CLAUSE_CHUNK_SIZE
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _bulk_result(index, status, **fields):
+    return {"index": index, "status": status, **fields}
+
+
+def _bulk_response(results, success_status, event):
+    failed = sum(1 for result in results if result["status"] >= 400)
+    api_logger.info(event, succeeded=len(results) - failed, failed=failed)
+    status_code = success_status if not failed else 207
+    return jsonify({"results": results,
+                    "succeeded": len(results) - failed,
+                    "failed": failed}), status_code
+
+
+@api_bp.route("/api/cache/stats", methods=["GET"])
+@log_api_action("get_cache_stats")
+def get_cache_stats():
+    cache = current_app.extensions.get("response_cache")
+    return jsonify({"enabled": cache is not None,
+                    **(cache.stats() if cache is not None else {})})
+
+
+@api_bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    body = render_metrics()
+    if body is None:
+        return jsonify({"error": "metrics are disabled", "status": 404}), 404
+    return Response(body, content_type=PROMETHEUS_CONTENT_TYPE)
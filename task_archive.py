@@ -0,0 +1,90 @@
+'''Moves old Completed tasks from the task table to task_archive
+
+Nearly all traffic is about open tasks, so finished ones only make the
+task table, its indexes and the listing scans bigger. Completed tasks
+last written more than ARCHIVE_AFTER_DAYS ago (updated_on, which every
+write sets, completing a task included) are copied to task_archive and
+deleted from task in chunks of ARCHIVE_BATCH_SIZE. Each chunk is its own
+short transaction, writers wait for one chunk at most. Run it with
+`flask tasks archive`, e.g. from cron.
+
+Archived tasks leave the task table's triggers like deleted ones: the
+full-text index, the stats counts and the change feed drop them.
+GET /api/tasks?include_archived=true still lists them.
+
+The change feed grows by a row per write. `flask tasks prune-changes`
+trims it to the last CHANGES_RETAINED sequence numbers, keeping the
+latest change of every remaining task so since=0 is still a full sync.
+'''
+import time
+from datetime import timedelta
+
+from sqlalchemy import delete, func, insert, literal, or_, select
+
+from task_cache import mark_tasks_changed
+from task_models import (Task, TaskArchive, TaskChange, TaskChangesPruned,
+                         today)
+
+ARCHIVED_STATUS = "Completed"
+ARCHIVE_COLUMNS = ["id", "name", "priority", "due_on", "status", "created_on",
+                   "updated_on", "version"]
+
+
+def archive_completed_tasks(session, older_than_days, batch_size, pause=0.0):
+    '''Archive Completed tasks not written since the cutoff, returns how many
+
+    pause is slept between chunks, giving waiting writers the lock.
+    '''
+    archived_on = today()
+    cutoff = archived_on - timedelta(days=older_than_days)
+    archived = 0
+    last_id = 0
+    while True:
+        # Keyset over ix_task_status, young Completed tasks are read once
+        ids = session.scalars(
+            select(Task.id)
+            .where(Task.status == ARCHIVED_STATUS, Task.id > last_id)
+            .where(Task.updated_on < cutoff)
+            .order_by(Task.id).limit(batch_size)).all()
+        if not ids:
+            break
+        last_id = ids[-1]
+        # Conditions repeated, a task may have been reopened meanwhile.
+        # The INSERT takes the write lock, so the DELETE sees the same rows.
+        chunk = (Task.id.in_(ids), Task.status == ARCHIVED_STATUS,
+                 Task.updated_on < cutoff)
+        session.execute(insert(TaskArchive).from_select(
+            [*ARCHIVE_COLUMNS, "archived_on"],
+            select(*[getattr(Task, name) for name in ARCHIVE_COLUMNS],
+                   literal(archived_on)).where(*chunk)))
+        moved = session.execute(delete(Task).where(*chunk)).rowcount
+        session.commit()
+        if moved:
+            mark_tasks_changed()
+            archived += moved
+        if pause:
+            time.sleep(pause)
+    return archived
+
+
+def prune_task_changes(session, keep):
+    '''Remove changes older than the last keep seqs, returns how many
+
+    Older rows go unless they are the latest change of a task that still
+    exists. The highest pruned seq is recorded in task_changes_pruned,
+    the change feed answers 410 to a since below it.
+    '''
+    last_seq = session.scalar(select(func.max(TaskChange.seq)))
+    pruned_seq = session.scalar(select(TaskChangesPruned.seq)) or 0
+    if last_seq is None or last_seq - keep <= pruned_seq:
+        return 0
+    pruned_seq = last_seq - keep
+    latest = select(func.max(TaskChange.seq)).group_by(TaskChange.task_id)
+    pruned = session.execute(delete(TaskChange).where(
+        TaskChange.seq <= pruned_seq,
+        or_(TaskChange.operation == "delete",
+            TaskChange.seq.not_in(latest)))).rowcount
+    session.execute(delete(TaskChangesPruned))
+    session.add(TaskChangesPruned(seq=pruned_seq))
+    session.commit()
+    return pruned
@@ -0,0 +1,359 @@
+'''ASGI version of the /api/tasks endpoints on SQLAlchemy's asyncio extension
+
+Serves the same contract as routes.py for listing, creating, reading,
+updating and deleting tasks: same query arguments, validation rules,
+response bodies, status codes and ETags. Requests wait on the database
+without holding a thread, so one process can keep thousands of polling
+clients connected. Needs the optional aiosqlite driver and an ASGI
+server, see asgi.py.
+
+The bulk, PATCH, upsert, stats and change feed endpoints, streamed
+listings, the response cache and /metrics remain WSGI only, and so do
+sharded databases (TASK_SHARDS).
+'''
+import json
+import time
+import uuid
+from urllib.parse import parse_qsl
+
+from flask import g
+from marshmallow import ValidationError
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from werkzeug.datastructures import MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header, parse_etags
+
+from config import create_app, db, register_sqlite_pragmas
+from routes import api_logger
+from task_cache import (cache_key, collection_etag, current_generation,
+                        mark_tasks_changed, task_etag)
+from task_compression import choose_encoding, compress
+from task_models import Task, task_dict_schema
+from task_queries import (InvalidQueryArgument, encode_cursor, parse_limit,
+                          prepare_tasks_query)
+from task_serializer import (encode_listing, listing_mimetypes,
+                             listing_serializer, negotiate_listing,
+                             task_serializer, to_json_bytes)
+
+TASKS_PATH = "/api/tasks"
+
+
+class AsgiRequest:
+    '''The parts of an ASGI http scope the handlers need'''
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = MultiDict(parse_qsl(scope["query_string"].decode(),
+                                        keep_blank_values=True))
+        self.headers = {name.decode("latin-1").lower():
+                        value.decode("latin-1")
+                        for name, value in scope["headers"]}
+        self.body = body
+
+    def get_json(self):
+        '''Decoded JSON body, None when it is missing or malformed'''
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def if_none_match(self, etag):
+        header = self.headers.get("if-none-match")
+        return bool(header) and parse_etags(header).contains_weak(etag)
+
+
+class AsgiResponse:
+    __slots__ = ("status", "body", "headers")
+
+    def __init__(self, status, body=b"", headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or []
+
+
+def json_reply(data, status=200, etag=None):
+    headers = [("content-type", "application/json")]
+    if etag is not None:
+        headers.append(("etag", f'"{etag}"'))
+    return AsgiResponse(status, to_json_bytes(data), headers)
+
+
+def error_reply(error, status, **fields):
+    return json_reply({"error": error, "status": status, **fields}, status)
+
+
+def task_exists_reply():
+    api_logger.error("task_creation_failed", reason="task already exists")
+    return error_reply("Task already exists", 406)
+
+
+def not_modified(etag):
+    return AsgiResponse(304, headers=[("etag", f'"{etag}"')])
+
+
+class TaskAsgiApp:
+    '''ASGI callable backed by a Flask app's configuration
+
+    The Flask app supplies the database URI, pragmas, JSON settings and
+    generation counter. An app context is pushed around each request so
+    the shared helpers and the structured logger work unchanged.
+    '''
+
+    def __init__(self, flask_app):
+        if "task_shards" in flask_app.extensions:
+            # The engines below would serve the main database, not the shards
+            raise RuntimeError("the ASGI app does not support TASK_SHARDS")
+        self.flask_app = flask_app
+        config = flask_app.config
+        with flask_app.app_context():
+            # Flask-SQLAlchemy resolves relative SQLite paths, reuse its URL
+            url = db.engine.url
+        options = config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        self.engine = _create_async_engine(url, options,
+                                           config["SQLITE_PRAGMAS"])
+        self.read_engine = self.engine
+        if config["READ_ENGINE_ENABLED"]:
+            self.read_engine = _create_async_engine(
+                config.get("READ_DATABASE_URI") or url, options,
+                {**config["SQLITE_PRAGMAS"], "query_only": "ON"})
+        self._search_index = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        request = AsgiRequest(scope, body)
+        with self.flask_app.app_context():
+            g.request_id = str(uuid.uuid4())
+            start_time = time.time()
+            response = await self._dispatch(request)
+            self._compress(request, response)
+            api_logger.info(
+                "request_completed",
+                duration_ms=round((time.time() - start_time) * 1000, 2),
+                response_size=len(response.body),
+                method=request.method,
+                path=request.path,
+                status_code=response.status,
+                request_id=g.request_id)
+
+        headers = [(name.encode("latin-1"), value.encode("latin-1"))
+                   for name, value in response.headers]
+        headers.append((b"content-length", str(len(response.body)).encode()))
+        await send({"type": "http.response.start",
+                    "status": response.status, "headers": headers})
+        await send({"type": "http.response.body", "body": response.body})
+
+    def _compress(self, request, response):
+        min_size = self.flask_app.config["COMPRESSION_MIN_SIZE"]
+        if min_size is None or len(response.body) < min_size:
+            return
+        response.headers.append(("vary", "Accept-Encoding"))
+        encoding = choose_encoding(parse_accept_header(
+            request.headers.get("accept-encoding")))
+        if encoding is None:
+            return
+        compressed = compress(response.body, encoding)
+        if len(compressed) >= len(response.body):
+            return
+        response.body = compressed
+        response.headers = [
+            # Weak, like the Flask app's compressed responses
+            (name, f"W/{value}" if name == "etag" and
+             not value.startswith("W/") else value)
+            for name, value in response.headers]
+        response.headers.append(("content-encoding", encoding))
+
+    async def dispose(self):
+        await self.engine.dispose()
+        if self.read_engine is not self.engine:
+            await self.read_engine.dispose()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _dispatch(self, request):
+        if request.path == TASKS_PATH:
+            handlers = {"GET": self.get_tasks, "POST": self.add_task}
+            handler = handlers.get(request.method)
+            args = ()
+        else:
+            prefix, _, task_id = request.path.rpartition("/")
+            if prefix != TASKS_PATH or not task_id.isdigit():
+                return error_reply("Not found", 404)
+            handlers = {"GET": self.get_task, "PUT": self.update_task,
+                        "DELETE": self.delete_task}
+            handler = handlers.get(request.method)
+            args = (int(task_id),)
+
+        if handler is None:
+            return error_reply("Method not allowed", 405)
+        try:
+            return await handler(request, *args)
+        except SQLAlchemyError as err:
+            api_logger.error("database_error", error=str(err))
+            return error_reply("Database error", 500)
+
+    async def get_tasks(self, request):
+        mimetype = negotiate_listing(parse_accept_header(
+            request.headers.get("accept"), MIMEAccept))
+        if mimetype is None:
+            api_logger.error("not_acceptable",
+                             accept=request.headers.get("accept"))
+            return error_reply("Not acceptable", 406,
+                               details=f"supported formats are "
+                                       f"{listing_mimetypes()}")
+
+        key = (cache_key(request.args), mimetype)
+        etag = collection_etag(current_generation(), key)
+        if request.if_none_match(etag):
+            response = not_modified(etag)
+            response.headers.append(("vary", "Accept"))
+            return response
+
+        try:
+            search_index = bool(request.args.get("search")) and \
+                await self._search_index_available()
+            limit = request.args.get("limit")
+            if limit is not None:
+                limit = parse_limit(limit)
+            serializer = listing_serializer(request.args.get("fields"))
+            # One extra row tells us whether another page exists
+            query, params, sort_key = prepare_tasks_query(
+                request.args, search_index, serializer.columns,
+                None if limit is None else limit + 1)
+        except InvalidQueryArgument as err:
+            api_logger.error(err.event, reason=err.details)
+            details = {"details": err.details} if err.details else {}
+            return error_reply(err.error, 400, **details)
+
+        async with self.read_engine.connect() as connection:
+            rows = (await connection.execute(query, params)).all()
+        if not rows:
+            api_logger.error("task_not_found",)
+            return error_reply("data not found", 404)
+
+        response = AsgiResponse(
+            200, encode_listing(serializer, rows[:limit], mimetype),
+            [("content-type", mimetype), ("etag", f'"{etag}"'),
+             ("vary", "Accept")])
+        if limit is not None and len(rows) > limit:
+            response.headers.append(
+                ("x-next-cursor", encode_cursor(rows[limit - 1], sort_key)))
+        return response
+
+    async def add_task(self, request):
+        try:
+            data = task_dict_schema.load(request.get_json())
+        except ValidationError as err:
+            api_logger.error("task_validation_failed", reason=err.messages)
+            return error_reply("Invalid data", 400, details=err.messages)
+
+        try:
+            async with self.engine.begin() as connection:
+                row = (await connection.execute(
+                    insert(Task).values(**data)
+                    .returning(*task_serializer.columns, Task.version))).one()
+        except IntegrityError:
+            return task_exists_reply()
+        mark_tasks_changed()
+        return json_reply(task_serializer.dump_one(row), 201,
+                          etag=task_etag(row.id, row.version))
+
+    async def get_task(self, request, task_id):
+        async with self.read_engine.connect() as connection:
+            if request.headers.get("if-none-match"):
+                # Compare against the version alone before the whole row
+                version = await connection.scalar(
+                    select(Task.version).where(Task.id == task_id))
+                if version is not None and \
+                        request.if_none_match(task_etag(task_id, version)):
+                    return not_modified(task_etag(task_id, version))
+            row = (await connection.execute(
+                select(*task_serializer.columns, Task.version)
+                .where(Task.id == task_id))).first()
+        if row is None:
+            api_logger.error("task_not_found",)
+            return error_reply("data not found", 404)
+        return json_reply(task_serializer.dump_one(row),
+                          etag=task_etag(task_id, row.version))
+
+    async def update_task(self, request, task_id):
+        try:
+            async with self.engine.begin() as connection:
+                exists = await connection.scalar(
+                    select(Task.id).where(Task.id == task_id))
+                if exists is None:
+                    api_logger.error("task_not_found",)
+                    return error_reply("Data not found", 404)
+                try:
+                    data = task_dict_schema.load(request.get_json())
+                except ValidationError as err:
+                    api_logger.error("task_validation_failed",
+                                     reason=err.messages)
+                    return error_reply("invalid data", 400,
+                                       details=err.messages)
+                row = (await connection.execute(
+                    update(Task).where(Task.id == task_id).values(**data)
+                    .returning(*task_serializer.columns, Task.version))).one()
+        except IntegrityError:
+            return task_exists_reply()
+        mark_tasks_changed()
+        return json_reply(task_serializer.dump_one(row),
+                          etag=task_etag(task_id, row.version))
+
+    async def delete_task(self, request, task_id):
+        async with self.engine.begin() as connection:
+            deleted = await connection.scalar(
+                delete(Task).where(Task.id == task_id).returning(Task.id))
+        if deleted is None:
+            api_logger.error("task_not_found",)
+            return error_reply("data not found", 404)
+        mark_tasks_changed()
+        return json_reply({"message": "task successfully deleted"})
+
+    async def _search_index_available(self):
+        if self._search_index is None:
+            async with self.read_engine.connect() as connection:
+                self._search_index = (await connection.exec_driver_sql(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'task_fts'"
+                )).first() is not None
+        return self._search_index
+
+
+def _create_async_engine(url, engine_options, pragmas):
+    url = make_url(url)
+    if url.drivername == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    options = dict(engine_options)
+    if url.database in (None, "", ":memory:"):
+        # One shared connection, otherwise every checkout is a new database
+        options = {"poolclass": StaticPool}
+    engine = create_async_engine(url, **options)
+    register_sqlite_pragmas(engine.sync_engine, pragmas)
+    return engine
+
+
+def create_asgi_app(config_type='development'):
+    return TaskAsgiApp(create_app(config_type))
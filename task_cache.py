@@ -0,0 +1,199 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from task_queries import LISTING_ARGS
+
+
+class LocalGenerationCounter:
+    '''Task table generation counter visible to this process only'''
+
+    def __init__(self):
+        # Start from the clock so values never repeat across restarts
+        self._value = time.time_ns()
+        self._lock = threading.Lock()
+
+    def current(self):
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+class FileGenerationCounter:
+    '''Task table generation counter in a memory-mapped file
+
+    Every worker process that maps the same file sees a bump from any of
+    them on its next read, without a system call. Values come from the
+    clock, so two racing bumps both move the counter to a new value.
+    '''
+
+    _format = struct.Struct("<Q")
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self._format.size:
+                os.write(fd, self._format.pack(time.time_ns()))
+            self._map = mmap.mmap(fd, self._format.size)
+        finally:
+            os.close(fd)
+
+    def current(self):
+        return self._format.unpack_from(self._map)[0]
+
+    def bump(self):
+        value = max(time.time_ns(), self.current() + 1)
+        self._format.pack_into(self._map, 0, value)
+        return value
+
+
+class CachedResponse:
+    '''Serialized response body plus what is needed to replay it'''
+
+    __slots__ = ("body", "mimetype", "headers", "generation", "expires")
+
+    def __init__(self, body, mimetype, headers, generation, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers
+        self.generation = generation
+        self.expires = expires
+
+    def to_response(self):
+        response = current_app.response_class(self.body,
+                                              mimetype=self.mimetype)
+        response.headers.extend(self.headers)
+        return response
+
+
+class ResponseCache:
+    '''LRU cache of GET /api/tasks responses with a TTL
+
+    An entry is only served while the table generation it was built at
+    is still current, so any write that bumps the counter invalidates
+    every entry at once. Entries are evicted once there are more than
+    max_entries of them or their bodies add up to more than max_bytes,
+    a body larger than max_bytes is not cached at all.
+    '''
+
+    def __init__(self, generation, max_entries=256, max_bytes=32 << 20,
+                 ttl=5.0):
+        self.generation = generation
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        generation = self.generation.current()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.generation != generation or \
+                    entry.expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, response, generation):
+        '''Store response, built from data read at generation'''
+        body = response.get_data()
+        if len(body) > self.max_bytes:
+            return
+        headers = [(name, value) for name, value in response.headers
+                   if name not in ("Content-Type", "Content-Length")]
+        entry = CachedResponse(body, response.mimetype, headers, generation,
+                               time.monotonic() + self.ttl)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or \
+                    self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+
+def init_app(app):
+    '''Attach the generation counter and, if enabled, the response cache'''
+    path = app.config["GENERATION_COUNTER_FILE"]
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        counter = FileGenerationCounter(path)
+    else:
+        counter = LocalGenerationCounter()
+    app.extensions["task_generation"] = counter
+
+    if app.config["RESPONSE_CACHE_ENABLED"]:
+        app.extensions["response_cache"] = ResponseCache(
+            counter,
+            max_entries=app.config["RESPONSE_CACHE_MAX_ENTRIES"],
+            max_bytes=app.config["RESPONSE_CACHE_MAX_BYTES"],
+            ttl=app.config["RESPONSE_CACHE_TTL"])
+
+
+def cache_key(args):
+    '''Normalize query arguments so equivalent requests share an entry
+
+    Only the arguments the listing reads are part of the key, an unknown
+    one such as a cache buster does not add an entry.
+    '''
+    return tuple(sorted((name, tuple(values))
+                        for name, values in args.lists()
+                        if name in LISTING_ARGS and any(values)))
+
+
+def collection_etag(generation, key):
+    '''ETag of a listing: the table generation plus the normalized args'''
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+    return f"{generation:x}-{digest}"
+
+
+def task_etag(task_id, version):
+    return f"{task_id}-{version}"
+
+
+def current_generation():
+    return current_app.extensions["task_generation"].current()
+
+
+def mark_tasks_changed():
+    '''Record a write to the task table, invalidating cached reads'''
+    current_app.extensions["task_generation"].bump()
@@ -0,0 +1,335 @@
+'''flask tasks import / export / archive, data movement without the API
+
+Import and export stream: import reads NDJSON or CSV in batches, validates
+each batch with the task schema rules and inserts it with one
+executemany, committing every TRANSACTION_ROWS rows. Export reads the
+table with yield_per and writes rows as they arrive, so memory stays
+bounded by the batch size however many tasks there are. Archive moves
+old Completed tasks to task_archive and prune-changes trims the change
+feed, see task_archive.py. create-shards
+creates the tables of the TASK_SHARDS databases, see task_shards.py.
+
+    flask tasks export tasks.ndjson
+    flask tasks import --fast tasks.ndjson
+
+--fast is for offline loads into a database nobody else is using. It
+drops the non-unique ix_task_* indexes and the full-text and task_counts
+insert triggers, rebuilds all of them once at the end and turns off fsync
+for the duration of the load.
+'''
+import csv
+import json
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from marshmallow import ValidationError
+from marshmallow.fields import Date
+from sqlalchemy import insert, select
+
+from config import db, read_bind_arguments
+from task_archive import archive_completed_tasks, prune_task_changes
+from task_cache import mark_tasks_changed
+from task_models import (TASK_COUNTS_BACKFILL, TASK_COUNTS_DDL, TASK_FTS_DDL,
+                         Task, TaskSchema, today)
+from task_serializer import task_serializer, to_json_lines
+
+FORMATS = ["ndjson", "csv"]
+BATCH_SIZE = 10000
+# Rows per transaction, large ones save a journal sync per batch
+TRANSACTION_ROWS = 500000
+# Pragmas of the --fast load connection, restored afterwards
+FAST_LOAD_PRAGMAS = {"synchronous": "OFF", "cache_size": -262144}
+# The name index stays, it is what rejects duplicate names
+DEFERRED_INDEX_PREFIX = "ix_task_"
+# Insert triggers whose work --fast redoes in one pass over the table.
+# The change feed trigger stays, its rows carry the insert order.
+DEFERRED_TRIGGERS = ["task_fts_insert", "task_counts_insert"]
+FAST_LOAD_REBUILD = [
+    *TASK_FTS_DDL,
+    "INSERT INTO task_fts(task_fts) VALUES ('rebuild')",
+    *TASK_COUNTS_DDL,
+    "DELETE FROM task_counts",
+    TASK_COUNTS_BACKFILL,
+]
+
+tasks_cli = AppGroup("tasks", help="Import and export tasks.")
+
+
+class TaskImportSchema(TaskSchema):
+    '''TaskSchema without the request time date rules
+
+    Imported tasks keep their creation date, may be overdue and may have
+    no due date, as exported. Every other rule (name length, choices,
+    unknown fields) still applies.
+    '''
+    due_on = Date(allow_none=True)
+    created_on = Date()
+
+
+import_schema = TaskImportSchema(many=True, load_instance=False)
+IMPORT_COLUMNS = ["id", "name", "priority", "status", "due_on", "created_on"]
+
+
+def _guess_format(path, file_format):
+    if file_format:
+        return file_format
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def _open(path, mode):
+    if path == "-":
+        # stdin/stdout, left open on exit
+        return click.open_file(path, mode)
+    if "b" in mode:
+        return open(path, mode)
+    # newline="" as the csv module asks, NDJSON lines end in \n anyway
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def _batches(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+def read_ndjson(lines):
+    '''(line number, record or error message) for each non-blank line'''
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as err:
+            yield number, ValidationError(f"Invalid JSON: {err}")
+
+
+def read_csv(lines):
+    '''(line number, record) for each CSV row after the header
+
+    Empty cells are left out, so they get the schema defaults or NULL.
+    '''
+    reader = csv.DictReader(lines)
+    for record in reader:
+        row = {key: value for key, value in record.items() if value != ""}
+        if row.get("id", "").isdigit():
+            row["id"] = int(row["id"])
+        yield reader.line_num, row
+
+
+def validate_batch(records):
+    '''Insertable rows and {line number: messages} of one batch'''
+    errors = {}
+    candidates = []
+    for number, record in records:
+        if isinstance(record, ValidationError):
+            errors[number] = record.messages
+        else:
+            candidates.append((number, record))
+    try:
+        loaded = import_schema.load([record for _, record in candidates])
+        invalid = {}
+    except ValidationError as err:
+        loaded, invalid = err.valid_data, err.messages
+    created_on = today()
+    rows = []
+    for index, ((number, _), values) in enumerate(zip(candidates, loaded)):
+        if index in invalid:
+            errors[number] = invalid[index]
+            continue
+        # executemany needs the same keys in every row
+        row = dict.fromkeys(IMPORT_COLUMNS)
+        row["created_on"] = created_on
+        row.update(values)
+        rows.append(row)
+    return rows, errors
+
+
+def deferred_indexes():
+    return [index for index in Task.__table__.indexes
+            if index.name.startswith(DEFERRED_INDEX_PREFIX)
+            and not index.unique]
+
+
+def import_tasks(connection, records, batch_size=BATCH_SIZE,
+                 transaction_rows=TRANSACTION_ROWS, report=None):
+    '''Insert valid records, returns (imported, rejected, duplicates)
+
+    report(line number, messages) is called for each invalid record.
+    Records whose id or name is already taken are skipped and counted as
+    duplicates, the unique indexes make that check part of the insert.
+    '''
+    imported = rejected = duplicates = 0
+    pending = 0
+    statement = insert(Task).prefix_with("OR IGNORE")
+    transaction = connection.begin()
+    try:
+        for batch in _batches(records, batch_size):
+            rows, errors = validate_batch(batch)
+            for number, messages in errors.items():
+                rejected += 1
+                if report is not None:
+                    report(number, messages)
+            if rows:
+                inserted = connection.execute(statement, rows).rowcount
+                imported += inserted
+                duplicates += len(rows) - inserted
+                pending += len(rows)
+            if pending >= transaction_rows:
+                transaction.commit()
+                transaction = connection.begin()
+                pending = 0
+        transaction.commit()
+    except BaseException:
+        transaction.rollback()
+        raise
+    return imported, rejected, duplicates
+
+
+def _set_pragmas(connection, pragmas):
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = connection.exec_driver_sql(
+            f"PRAGMA {name}").scalar()
+        connection.exec_driver_sql(f"PRAGMA {name}={value}")
+    return previous
+
+
+@contextmanager
+def fast_load(connection):
+    '''Defer index and trigger maintenance of the task table to the end
+
+    Everything is rebuilt even when the load fails half way, so the
+    committed part is indexed and counted like any other row.
+    '''
+    indexes = deferred_indexes()
+    previous = _set_pragmas(connection, FAST_LOAD_PRAGMAS)
+    for index in indexes:
+        index.drop(connection, checkfirst=True)
+    for trigger in DEFERRED_TRIGGERS:
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+    connection.commit()
+    try:
+        yield
+    finally:
+        click.echo(f"Rebuilding {len(indexes)} indexes, the full-text index "
+                   "and task counts", err=True)
+        for index in indexes:
+            index.create(connection, checkfirst=True)
+        for statement in FAST_LOAD_REBUILD:
+            connection.exec_driver_sql(statement)
+        connection.commit()
+        _set_pragmas(connection, previous)
+
+
+def _require_unsharded():
+    # These commands only know the main database
+    if "task_shards" in current_app.extensions:
+        raise click.UsageError(
+            "Not available with TASK_SHARDS, the tasks are in the shards.")
+
+
+@tasks_cli.command("import")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "file_format", type=click.Choice(FORMATS),
+              help="Input format, by default guessed from the extension.")
+@click.option("--batch-size", type=click.IntRange(1), default=BATCH_SIZE,
+              show_default=True, help="Rows validated and inserted at once.")
+@click.option("--transaction-rows", type=click.IntRange(1),
+              default=TRANSACTION_ROWS, show_default=True,
+              help="Rows per committed transaction.")
+@click.option("--fast", is_flag=True,
+              help="Offline load: index and count at the end, no fsync.")
+def import_command(path, file_format, batch_size, transaction_rows, fast):
+    '''Import tasks from an NDJSON or CSV file, - for stdin.'''
+    _require_unsharded()
+    file_format = _guess_format(path, file_format)
+    reader = read_csv if file_format == "csv" else read_ndjson
+
+    def report(number, messages):
+        click.echo(f"line {number}: {json.dumps(messages, sort_keys=True)}",
+                   err=True)
+
+    with _open(path, "r") as lines, \
+            db.engine.connect() as connection, \
+            fast_load(connection) if fast else nullcontext():
+        imported, rejected, duplicates = import_tasks(
+            connection, reader(lines), batch_size, transaction_rows, report)
+    mark_tasks_changed()
+
+    click.echo(f"Imported {imported} tasks, rejected {rejected} invalid, "
+               f"skipped {duplicates} with an existing id or name", err=True)
+    if rejected or duplicates:
+        raise SystemExit(1)
+
+
+@tasks_cli.command("export")
+@click.argument("path", default="-",
+                type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "file_format", type=click.Choice(FORMATS),
+              help="Output format, by default guessed from the extension.")
+@click.option("--batch-size", type=click.IntRange(1), default=BATCH_SIZE,
+              show_default=True, help="Rows fetched at once.")
+def export_command(path, file_format, batch_size):
+    '''Export all tasks as NDJSON or CSV, to stdout by default.'''
+    _require_unsharded()
+    file_format = _guess_format(path, file_format)
+    result = db.session.execute(
+        select(*task_serializer.columns).order_by(Task.id),
+        execution_options={"yield_per": batch_size},
+        bind_arguments=read_bind_arguments())
+    exported = 0
+    if file_format == "csv":
+        with _open(path, "w") as output:
+            writer = csv.writer(output)
+            writer.writerow(task_serializer.keys)
+            for rows in result.partitions():
+                writer.writerows(map(task_serializer.dump_values, rows))
+                exported += len(rows)
+    else:
+        with _open(path, "wb") as output:
+            for rows in result.partitions():
+                output.write(to_json_lines(task_serializer.dump(rows)))
+                exported += len(rows)
+    click.echo(f"Exported {exported} tasks", err=True)
+
+
+@tasks_cli.command("archive")
+@click.option("--older-than", type=click.IntRange(0),
+              help="Age in days, ARCHIVE_AFTER_DAYS by default.")
+@click.option("--batch-size", type=click.IntRange(1),
+              help="Tasks per transaction, ARCHIVE_BATCH_SIZE by default.")
+def archive_command(older_than, batch_size):
+    '''Move old Completed tasks to the archive table.'''
+    _require_unsharded()
+    config = current_app.config
+    archived = archive_completed_tasks(
+        db.session,
+        config["ARCHIVE_AFTER_DAYS"] if older_than is None else older_than,
+        batch_size or config["ARCHIVE_BATCH_SIZE"], config["ARCHIVE_PAUSE"])
+    click.echo(f"Archived {archived} tasks", err=True)
+
+
+@tasks_cli.command("prune-changes")
+@click.option("--keep", type=click.IntRange(0),
+              help="Sequence numbers kept, CHANGES_RETAINED by default.")
+def prune_changes_command(keep):
+    '''Remove old entries of the change feed.'''
+    _require_unsharded()
+    pruned = prune_task_changes(
+        db.session,
+        current_app.config["CHANGES_RETAINED"] if keep is None else keep)
+    click.echo(f"Pruned {pruned} changes", err=True)
+
+
+@tasks_cli.command("create-shards")
+def create_shards_command():
+    '''Create the task tables in every TASK_SHARDS database.'''
+    shards = current_app.extensions.get("task_shards")
+    if shards is None:
+        raise click.UsageError("TASK_SHARDS is not configured.")
+    shards.create_all()
+    click.echo(f"Created the tables of {len(shards.engines)} shards",
+               err=True)
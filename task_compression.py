@@ -0,0 +1,62 @@
+'''gzip and brotli content coding of large response bodies
+
+Only buffered bodies are compressed, streamed responses go out as they
+are produced. Brotli is offered when the optional brotli package is
+installed.
+'''
+import gzip
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+
+# Bodies are compressed on every request, favour speed over ratio
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def available_encodings():
+    '''Content codings we can produce, preferred first'''
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def choose_encoding(accept_encodings):
+    '''Coding for a parsed Accept-Encoding header, None for identity'''
+    if not accept_encodings:
+        return None
+    return accept_encodings.best_match(available_encodings())
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # A fixed mtime keeps equal bodies byte for byte equal
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compress_response(response, accept_encodings, min_size):
+    '''Compress a Flask response in place when it is large enough'''
+    if min_size is None or response.is_streamed or \
+            response.direct_passthrough or \
+            "Content-Encoding" in response.headers:
+        return response
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+    compressed = compress(body, encoding)
+    if len(compressed) >= len(body):
+        return response
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Another representation of the same content, like nginx does
+        response.set_etag(etag, weak=True)
+    return response
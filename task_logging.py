@@ -1,42 +1,81 @@
+import atexit
 import logging
 import json
+import queue
+import threading
+import time
 from datetime import datetime, timezone
 
 
+LOG_FILE = 'logs.json'
+
+
 class StructuredLogger:
     '''A customized logger that writes JSON with structured data to file'''
 
     def __init__(self, name):
         self.logger = logging.getLogger(name)
-        handler = logging.FileHandler('logs.json', 'a', encoding='UTF-8')
-        formatter = JsonFormatter()
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        self.handler = logging.FileHandler(LOG_FILE, 'a', encoding='UTF-8')
+        self.handler.setFormatter(JsonFormatter())
+        self.logger.addHandler(self.handler)
         self.logger.setLevel(logging.INFO)
+        # Called with the seconds each entry took to log, see task_metrics
+        self.observer = None
 
     def info(self, event, **kwargs):
         '''Log level INFO with structured data'''
-        log_data = self._build_log_entry(event, "INFO", **kwargs)
-        self.logger.info(json.dumps(log_data))
+        self._log(logging.INFO, "INFO", event, kwargs)
 
     def error(self, event, **kwargs):
         '''Log level ERROR with structured data'''
-        log_data = self._build_log_entry(event, "ERROR", **kwargs)
-        self.logger.error(json.dumps(log_data))
+        self._log(logging.ERROR, "ERROR", event, kwargs)
 
     def warning(self, event, **kwargs):
         '''Log level WARNING with structured data'''
-        log_data = self._build_log_entry(event, "WARNING", **kwargs)
-        self.logger.warning(json.dumps(log_data))
+        self._log(logging.WARNING, "WARNING", event, kwargs)
+
+    def _log(self, level, level_name, event, kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        # The message stays the event name for any other handler, the
+        # entry rides along on the record for JsonFormatter
+        extra = {"entry": self._build_log_entry(event, level_name, **kwargs)}
+        if self.observer is None:
+            self.logger.log(level, event, extra=extra)
+            return
+        start = time.perf_counter()
+        self.logger.log(level, event, extra=extra)
+        self.observer(time.perf_counter() - start)
+
+    def use_queue(self, **options):
+        '''Move formatting and file writes onto a background thread'''
+        if isinstance(self.handler, BatchingFileHandler):
+            return self.handler
+        handler = BatchingFileHandler(LOG_FILE, **options)
+        handler.setFormatter(JsonFormatter())
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        self.logger.addHandler(handler)
+        self.handler = handler
+        return handler
+
+    def stats(self):
+        '''Counters of the background writer, empty in synchronous mode'''
+        if isinstance(self.handler, BatchingFileHandler):
+            return self.handler.stats()
+        return {}
 
     def _build_log_entry(self, event, level, **kwargs):
         '''Build standardized log entry'''
-        from flask import g
+        from flask import g, has_app_context
+        request_id = None
+        if has_app_context():
+            request_id = getattr(g, 'request_id', None)
         log_entry = {
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "level": level,
             "event": event,
-            "request_id": getattr(g, 'request_id', None),
+            "request_id": request_id,
             "service": "task_api",
             "version": 1.0
         }
@@ -47,14 +86,124 @@ class StructuredLogger:
 class JsonFormatter(logging.Formatter):
     '''Custom formatter to ensure JSON'''
     def format(self, record):
+        # StructuredLogger hands over the entry itself, serialize it once
+        entry = getattr(record, "entry", None)
+        if entry is not None:
+            return json.dumps(entry, default=str)
+        log_entry = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name
+        }
+        return json.dumps(log_entry)
+
+
+_STOP = object()
+
+
+class BatchingFileHandler(logging.Handler):
+    '''Queues records and writes them from a background thread in batches
+
+    A batch is written once batch_size records are waiting or
+    flush_interval seconds after its first record, whichever comes first.
+    When the queue is full emit() waits up to block_timeout seconds for
+    room (counted as backpressure) and then drops the record.
+    '''
+
+    def __init__(self, filename, max_queue_size=10000, batch_size=256,
+                 flush_interval=0.5, block_timeout=0.0):
+        super().__init__()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(max_queue_size)
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.backpressure = 0
+        self._counter_lock = threading.Lock()
+        self._stream = open(filename, 'a', encoding='UTF-8')
+        self._thread = threading.Thread(target=self._run,
+                                        name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self.block_timeout:
+            with self._counter_lock:
+                self.backpressure += 1
+            try:
+                self.queue.put(record, timeout=self.block_timeout)
+                return
+            except queue.Full:
+                pass
+        with self._counter_lock:
+            self.dropped += 1
+
+    def flush(self):
+        '''Block until every queued record has been written'''
+        if self._thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+        if not self._stream.closed:
+            self._stream.close()
+        super().close()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "backpressure": self.backpressure
+        }
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while record is not _STOP:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            self._write(batch)
+            for _ in range(len(batch) + (record is _STOP)):
+                self.queue.task_done()
+            if record is _STOP:
+                return
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
         try:
-            json.loads(record.getMessage())
-            return record.getMessage()
-        except (json.JSONDecodeError, ValueError):
-            log_entry = {
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "level": record.levelname,
-                "message": record.getMessage(),
-                "logger": record.name
-            }
-            return json.dumps(log_entry)
+            self._stream.write("\n".join(lines) + "\n")
+            self._stream.flush()
+        except Exception:
+            self.handleError(batch[0])
+            return
+        self.written += len(lines)
+        self.batches += 1
@@ -0,0 +1,300 @@
+import cProfile
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Upper bounds in seconds, Prometheus adds the +Inf bucket
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+PHASES = ("validation", "db_query", "hydration", "serialization", "logging")
+PROFILE_HEADER = "X-Profile"
+# Counters of the background log writer, see BatchingFileHandler.stats
+LOG_QUEUE_METRICS = {
+    "queued": ("task_api_log_queue_records", "gauge",
+               "Log records waiting for the writer thread."),
+    "written": ("task_api_log_records_written_total", "counter",
+                "Log records written to the log file."),
+    "batches": ("task_api_log_batches_written_total", "counter",
+                "Batches of log records written to the log file."),
+    "dropped": ("task_api_log_records_dropped_total", "counter",
+                "Log records dropped because the queue was full."),
+    "backpressure": ("task_api_log_backpressure_total", "counter",
+                     "Log records that waited for room in a full queue."),
+}
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_cursor_events_installed = False
+_cursor_events_lock = threading.Lock()
+
+
+class Histogram:
+    '''Prometheus histogram, one set of buckets per label combination'''
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per bucket counts plus +Inf, then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1)
+                series.append(0.0)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(values))
+                            for labels, values in self._series.items())
+        for labels, values in series:
+            label_text = _format_labels(self.label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text}'
+                             f'{"," if label_text else ""}le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    '''Prometheus counter, one value per label combination'''
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{{"
+                         f"{_format_labels(self.label_names, labels)}}} "
+                         f"{value}")
+        return lines
+
+
+def _render_stats(stats, metrics):
+    '''Unlabelled metrics read from a stats() dict when scraped'''
+    lines = []
+    for key, (name, metric_type, help_text) in metrics.items():
+        if key in stats:
+            lines.extend([f"# HELP {name} {help_text}",
+                          f"# TYPE {name} {metric_type}",
+                          f"{name} {stats[key]}"])
+    return lines
+
+
+def _format_labels(names, values):
+    return ",".join(f'{name}="{_escape(value)}"'
+                    for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+class Metrics:
+    '''The metrics of one app, kept per process'''
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            "task_api_request_duration_seconds",
+            "Time from the start of a request until its body was sent.",
+            ("action",), LATENCY_BUCKETS)
+        self.phase_duration = Histogram(
+            "task_api_request_phase_duration_seconds",
+            "Time a request spent in each phase of its handling.",
+            ("action", "phase"), LATENCY_BUCKETS)
+        self.queries_per_request = Histogram(
+            "task_api_db_queries_per_request",
+            "SQL statements executed per request.",
+            ("action",), QUERY_COUNT_BUCKETS)
+        self.requests = Counter(
+            "task_api_requests_total",
+            "Requests handled, by action and status code.",
+            ("action", "status"))
+        self.profiles = Counter(
+            "task_api_profiled_requests_total",
+            "Requests run under the sampling profiler.",
+            ("action",))
+        # Returns the log writer's counters, see StructuredLogger.stats
+        self.log_stats = None
+
+    def render(self):
+        lines = []
+        for metric in (self.request_duration, self.phase_duration,
+                       self.queries_per_request, self.requests,
+                       self.profiles):
+            lines.extend(metric.render())
+        if self.log_stats is not None:
+            lines.extend(_render_stats(self.log_stats(), LOG_QUEUE_METRICS))
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    '''Timings collected while one request is handled'''
+
+    __slots__ = ("metrics", "action", "phases", "query_count", "profiler")
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.action = None
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.query_count = 0
+        self.profiler = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def finish(self, status_code, duration):
+        '''Record the finished request, duration in seconds'''
+        if self.action is None:
+            return
+        metrics = self.metrics
+        metrics.request_duration.observe((self.action,), duration)
+        metrics.requests.inc((self.action, str(status_code)))
+        metrics.queries_per_request.observe((self.action,), self.query_count)
+        for phase, seconds in self.phases.items():
+            if seconds:
+                metrics.phase_duration.observe((self.action, phase), seconds)
+
+
+def init_app(app):
+    '''Attach the metrics and hook SQL statement timing into SQLAlchemy'''
+    app.extensions["metrics"] = Metrics()
+
+    global _cursor_events_installed
+    with _cursor_events_lock:
+        if not _cursor_events_installed:
+            # On the Engine class so the read engine is covered too
+            event.listen(Engine, "before_cursor_execute",
+                         _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute",
+                         _after_cursor_execute)
+            _cursor_events_installed = True
+
+
+def start_request():
+    '''Begin collecting metrics for the current request'''
+    metrics = current_app.extensions.get("metrics")
+    if metrics is None:
+        return None
+    request_metrics = g.request_metrics = RequestMetrics(metrics)
+    if _should_profile():
+        request_metrics.profiler = cProfile.Profile()
+        request_metrics.profiler.enable()
+    return request_metrics
+
+
+def set_action(action_name):
+    request_metrics = _current()
+    if request_metrics is not None:
+        request_metrics.action = action_name
+
+
+def record_phase(phase, seconds):
+    request_metrics = _current()
+    if request_metrics is not None:
+        request_metrics.add(phase, seconds)
+
+
+@contextmanager
+def phase(name):
+    '''Time the enclosed block as a phase of the current request'''
+    request_metrics = _current()
+    if request_metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics.add(name, time.perf_counter() - start)
+
+
+def stop_profiler(request_metrics, request_id):
+    '''Stop the request's profiler and dump its stats, returns the path'''
+    profiler = request_metrics.profiler
+    if profiler is None:
+        return None
+    profiler.disable()
+    request_metrics.profiler = None
+
+    directory = current_app.config["PROFILE_DIR"] or os.path.join(
+        current_app.instance_path, "profiles")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{request_id}.prof")
+    profiler.dump_stats(path)
+    request_metrics.metrics.profiles.inc((request_metrics.action or "",))
+    return path
+
+
+def render_metrics():
+    '''Prometheus text exposition of this process, None when disabled'''
+    metrics = current_app.extensions.get("metrics")
+    return metrics.render() if metrics is not None else None
+
+
+def _current():
+    if not has_request_context():
+        return None
+    return g.get("request_metrics")
+
+
+def _should_profile():
+    config = current_app.config
+    if not config["PROFILING_ENABLED"]:
+        return False
+    if request.headers.get(PROFILE_HEADER, "").lower() in ("1", "true"):
+        return True
+    rate = config["PROFILE_SAMPLE_RATE"]
+    return rate > 0 and random.random() < rate
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    # On the execution context, which goes away with a statement that
+    # fails before after_cursor_execute
+    if context is not None:
+        context._query_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, "_query_start_time", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    request_metrics = _current()
+    if request_metrics is not None:
+        request_metrics.query_count += 1
+        request_metrics.add("db_query", elapsed)
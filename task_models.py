@@ -1,33 +1,437 @@
 from config import db, ma
-from marshmallow.fields import String, Date
-from marshmallow import validate
-from datetime import datetime
+from marshmallow.fields import String, Date, Integer
+from marshmallow import Schema, ValidationError, missing, validate
+from datetime import date
+import sqlalchemy as sa
+
+
+# Sort order of the priority and status values, unknown values sort last
+PRIORITY_RANKS = {"Low": 1, "Medium": 2, "High": 3}
+STATUS_RANKS = {"Pending": 1, "In Progress": 2, "Completed": 3}
+UNKNOWN_RANK = 4
+
+
+def today():
+    '''Current date, looked up on every use so long-running workers roll
+    over at midnight. Tests patch it to move the clock.'''
+    return date.today()
+
+
+def _rank_sql(column, ranks):
+    whens = " ".join(f"WHEN '{value}' THEN {rank}"
+                     for value, rank in ranks.items())
+    return f"CASE {column} {whens} ELSE {UNKNOWN_RANK} END"
 
 
 class Task(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), index=True)
+    name = db.Column(db.String(50), index=True, unique=True)
     priority = db.Column(db.String(20), index=True)
     due_on = db.Column(db.Date, index=True)
     status = db.Column(db.String(20), index=True)
-    created_on = db.Column(db.Date, default=datetime.now().date())
+    # Through the module global at insert time, not the start-up date
+    created_on = db.Column(db.Date, default=lambda: today(), index=True)
+    # Day of the last write, which for a Completed task is at least the
+    # day it was completed. task_archive.py archives by it.
+    updated_on = db.Column(db.Date, default=lambda: today(),
+                           onupdate=lambda: today())
+    # Bumped by every UPDATE, the strong ETag of a single task
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default="1",
+                        onupdate=sa.literal_column("version + 1"))
+    # Virtual generated columns so priority/status sorts can use an index
+    priority_rank = db.Column(db.Integer,
+                              db.Computed(_rank_sql("priority",
+                                                    PRIORITY_RANKS)))
+    status_rank = db.Column(db.Integer,
+                            db.Computed(_rank_sql("status", STATUS_RANKS)))
+
+    # One index per filter + sort combination served by GET /api/tasks.
+    # SQLite appends the rowid to every index, so each also serves the
+    # id tie-break of the ORDER BY and keyset pagination.
+    __table_args__ = (
+        db.Index("ix_task_priority_rank", "priority_rank"),
+        db.Index("ix_task_status_rank", "status_rank"),
+        db.Index("ix_task_status_name", "status", "name"),
+        db.Index("ix_task_status_due_on", "status", "due_on"),
+        db.Index("ix_task_status_priority_rank", "status", "priority_rank"),
+        db.Index("ix_task_priority_name", "priority", "name"),
+        db.Index("ix_task_priority_due_on", "priority", "due_on"),
+        db.Index("ix_task_priority_status_rank", "priority", "status_rank"),
+        db.Index("ix_task_priority_status", "priority", "status"),
+        db.Index("ix_task_priority_status_due_on",
+                 "priority", "status", "due_on"),
+        db.Index("ix_task_due_on_name", "due_on", "name"),
+        db.Index("ix_task_due_on_priority_rank", "due_on", "priority_rank"),
+        db.Index("ix_task_due_on_status_rank", "due_on", "status_rank"),
+        db.Index("ix_task_due_on_created_on", "due_on", "created_on"),
+        db.Index("ix_task_status_created_on", "status", "created_on"),
+        db.Index("ix_task_priority_created_on", "priority", "created_on"),
+        db.Index("ix_task_priority_status_created_on",
+                 "priority", "status", "created_on"),
+        # Archived ids must not come back for new tasks
+        {"sqlite_autoincrement": True},
+    )
+
+
+class TaskArchive(db.Model):
+    '''Completed tasks moved out of the task table, see task_archive.py
+
+    Same columns as task, plus the day the task was archived. Only
+    GET /api/tasks?include_archived=true reads it, so the only index is
+    the primary key. Ids stay unique across both tables because task ids
+    are never handed out twice.
+    '''
+    __tablename__ = "task_archive"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(50))
+    priority = db.Column(db.String(20))
+    due_on = db.Column(db.Date)
+    status = db.Column(db.String(20))
+    created_on = db.Column(db.Date)
+    updated_on = db.Column(db.Date)
+    version = db.Column(db.Integer, nullable=False)
+    priority_rank = db.Column(db.Integer,
+                              db.Computed(_rank_sql("priority",
+                                                    PRIORITY_RANKS)))
+    status_rank = db.Column(db.Integer,
+                            db.Computed(_rank_sql("status", STATUS_RANKS)))
+    archived_on = db.Column(db.Date, nullable=False)
+
+
+# Trigram full-text index over task names, kept in sync by triggers. The
+# migration creates the same objects for databases managed by Alembic.
+TASK_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5("
+    "name, content='task', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS task_fts_insert AFTER INSERT ON task "
+    "BEGIN INSERT INTO task_fts(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS task_fts_delete AFTER DELETE ON task "
+    "BEGIN INSERT INTO task_fts(task_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS task_fts_update AFTER UPDATE OF name ON task "
+    "BEGIN INSERT INTO task_fts(task_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); "
+    "INSERT INTO task_fts(rowid, name) VALUES (new.id, new.name); END",
+]
+
+# Not part of db.metadata, create_all must not treat it as a plain table
+task_fts = sa.Table("task_fts", sa.MetaData(),
+                    sa.Column("rowid", sa.Integer),
+                    sa.Column("name", sa.String),
+                    sa.Column("rank", sa.Float))
+
+
+@sa.event.listens_for(Task.__table__, "after_create")
+def _create_task_fts(target, connection, **kwargs):
+    if connection.dialect.name == "sqlite":
+        for statement in TASK_FTS_DDL:
+            connection.exec_driver_sql(statement)
+
+
+@sa.event.listens_for(Task.__table__, "before_drop")
+def _drop_task_fts(target, connection, **kwargs):
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("DROP TABLE IF EXISTS task_fts")
+
+
+class TaskCount(db.Model):
+    '''Number of tasks per status, priority and due date
+
+    Kept in step with the task table by triggers inside the writing
+    transaction, so GET /api/tasks/stats reads a table whose size depends
+    on the number of distinct due dates rather than the number of tasks.
+    '''
+    __tablename__ = "task_counts"
+
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20))
+    priority = db.Column(db.String(20))
+    due_on = db.Column(db.Date)
+    task_count = db.Column(db.Integer, nullable=False, server_default="0")
+
+    __table_args__ = (
+        db.Index("ix_task_counts_key", "status", "priority", "due_on",
+                 unique=True),
+    )
+
+
+def _task_count_change(row, increment):
+    # IS instead of = so a NULL due date matches its own counter row
+    match = (f"status IS {row}.status AND priority IS {row}.priority "
+             f"AND due_on IS {row}.due_on")
+    if increment:
+        return (
+            "UPDATE task_counts SET task_count = task_count + 1 "
+            f"WHERE {match}; "
+            "INSERT INTO task_counts(status, priority, due_on, task_count) "
+            f"SELECT {row}.status, {row}.priority, {row}.due_on, 1 "
+            f"WHERE NOT EXISTS (SELECT 1 FROM task_counts WHERE {match});")
+    return ("UPDATE task_counts SET task_count = task_count - 1 "
+            f"WHERE {match}; "
+            f"DELETE FROM task_counts WHERE {match} AND task_count <= 0;")
+
+
+# The migration creates the same triggers for databases managed by Alembic
+TASK_COUNTS_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS task_counts_insert AFTER INSERT ON task "
+    f"BEGIN {_task_count_change('new', True)} END",
+    "CREATE TRIGGER IF NOT EXISTS task_counts_delete AFTER DELETE ON task "
+    f"BEGIN {_task_count_change('old', False)} END",
+    "CREATE TRIGGER IF NOT EXISTS task_counts_update "
+    "AFTER UPDATE OF status, priority, due_on ON task "
+    "WHEN old.status IS NOT new.status OR old.priority IS NOT new.priority "
+    "OR old.due_on IS NOT new.due_on "
+    f"BEGIN {_task_count_change('old', False)} "
+    f"{_task_count_change('new', True)} END",
+]
+TASK_COUNTS_BACKFILL = (
+    "INSERT INTO task_counts(status, priority, due_on, task_count) "
+    "SELECT status, priority, due_on, count(*) FROM task "
+    "GROUP BY status, priority, due_on")
+
+
+@sa.event.listens_for(TaskCount.__table__, "after_create")
+def _create_task_counts_triggers(target, connection, **kwargs):
+    if connection.dialect.name == "sqlite":
+        for statement in TASK_COUNTS_DDL:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql(TASK_COUNTS_BACKFILL)
+
+
+@sa.event.listens_for(TaskCount.__table__, "before_drop")
+def _drop_task_counts_triggers(target, connection, **kwargs):
+    if connection.dialect.name == "sqlite":
+        for trigger in ("task_counts_insert", "task_counts_delete",
+                        "task_counts_update"):
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+
+
+class TaskChange(db.Model):
+    '''Change feed of the task table, one row per insert, update or delete
+
+    Written by triggers in the same transaction as the change itself.
+    AUTOINCREMENT keeps seq increasing even after old rows are removed,
+    see prune_task_changes.
+    '''
+    __tablename__ = "task_changes"
+
+    seq = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(6), nullable=False)
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+# The migration creates the same triggers for databases managed by Alembic
+TASK_CHANGES_DDL = [
+    f"CREATE TRIGGER IF NOT EXISTS task_changes_{operation} "
+    f"AFTER {operation.upper()} ON task BEGIN "
+    "INSERT INTO task_changes(task_id, operation) "
+    f"VALUES ({row}.id, '{operation}'); END"
+    for operation, row in (("insert", "new"), ("update", "new"),
+                           ("delete", "old"))
+]
+# Existing tasks enter the feed as inserts, so since=0 is a full sync
+TASK_CHANGES_BACKFILL = (
+    "INSERT INTO task_changes(task_id, operation) "
+    "SELECT id, 'insert' FROM task ORDER BY id")
+
+
+@sa.event.listens_for(TaskChange.__table__, "after_create")
+def _create_task_changes_triggers(target, connection, **kwargs):
+    if connection.dialect.name == "sqlite":
+        for statement in TASK_CHANGES_DDL:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql(TASK_CHANGES_BACKFILL)
+
+
+@sa.event.listens_for(TaskChange.__table__, "before_drop")
+def _drop_task_changes_triggers(target, connection, **kwargs):
+    if connection.dialect.name == "sqlite":
+        for operation in ("insert", "update", "delete"):
+            connection.exec_driver_sql(
+                f"DROP TRIGGER IF EXISTS task_changes_{operation}")
+
+
+class TaskChangesPruned(db.Model):
+    '''Highest seq the change feed was pruned up to, one row once pruned
+
+    A client that last synced below it may have missed deletions.
+    '''
+    __tablename__ = "task_changes_pruned"
+
+    seq = db.Column(db.Integer, primary_key=True)
+
+
+class NotBeforeToday(validate.Validator):
+    '''validate.Range(min=today()) with the date looked up per call'''
+    error = "Must be greater than or equal to {min}."
+
+    def __call__(self, value):
+        current = today()
+        if value < current:
+            raise ValidationError(self.error.format(min=current))
+        return value
+
+
+class EqualsToday(validate.Validator):
+    '''validate.Equal(today()) with the date looked up per call'''
+    error = "Must be equal to {other}."
+
+    def __call__(self, value):
+        current = today()
+        if value != current:
+            raise ValidationError(self.error.format(other=current))
+        return value
+
+
+class ChoiceSet(validate.OneOf):
+    '''validate.OneOf testing membership in a frozenset, same messages'''
+
+    def __init__(self, choices, **kwargs):
+        super().__init__(choices, **kwargs)
+        self.choice_set = frozenset(choices)
+
+    def __call__(self, value):
+        try:
+            if value in self.choice_set:
+                return value
+        except TypeError:  # unhashable
+            pass
+        raise ValidationError(self._format_error(value))
+
+
+def _fast_string(value):
+    if value.__class__ is not str:
+        raise TypeError(value)
+    return value
+
+
+def _fast_integer(value):
+    if value.__class__ is not int:
+        raise TypeError(value)
+    return value
+
+
+def _fast_date(value):
+    # Only the YYYY-MM-DD form, anything looser is left to marshmallow
+    if value.__class__ is not str or len(value) != 10 or \
+            not value.isascii() or value[4] != "-" or value[7] != "-":
+        raise ValueError(value)
+    return date.fromisoformat(value)
+
+
+# Field types the fast load path knows, by exact class
+FAST_LOADERS = {String: _fast_string, Integer: _fast_integer, Date: _fast_date}
 
 
 class TaskSchema(ma.SQLAlchemyAutoSchema):
+    '''Task schema with a fast path for well-formed bodies
+
+    load() first checks the body against a list of (key, converter,
+    validators, default) entries built once from the load fields. A body
+    that passes every check is the one case where marshmallow's result is
+    known, so it is built directly. Anything else, including every invalid
+    body, goes through the regular marshmallow load and gets its usual
+    error messages.
+    '''
     name = String(required=True, validate=validate.Length(min=2, max=50))
-    priority = String(validate=validate.OneOf(['High', 'Medium', 'Low']),
+    priority = String(validate=ChoiceSet(['High', 'Medium', 'Low']),
                       load_default='Medium')
-    due_on = Date(validate=validate.Range(min=datetime.now().date()))
-    status = String(validate=validate.OneOf(['Completed', 'In Progress',
-                                            'Pending']), load_default='Pending')
-    created_on = Date(validate=validate.Equal(datetime.now().date()))
+    due_on = Date(validate=NotBeforeToday())
+    status = String(validate=ChoiceSet(['Completed', 'In Progress',
+                                        'Pending']), load_default='Pending')
+    created_on = Date(validate=EqualsToday())
 
     class Meta:
         model = Task
         # exclude = ['id']
+        exclude = ['priority_rank', 'status_rank', 'updated_on', 'version']
         load_instance = True
         sqla_session = db.session
 
+    def __init__(self, *args, fast_load=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fast_fields = self._compile_fast_load() if fast_load else None
+
+    def _compile_fast_load(self):
+        fast_fields = []
+        for name, field in self.load_fields.items():
+            loader = FAST_LOADERS.get(type(field))
+            if loader is None or callable(field.load_default):
+                return None
+            fast_fields.append((field.data_key or name, field.attribute or name,
+                                loader, tuple(field.validators),
+                                field.required, field.load_default,
+                                field.allow_none))
+        self._fast_keys = frozenset(key for key, *_ in fast_fields)
+        return fast_fields
+
+    def _fast_load_one(self, data, partial):
+        '''Loaded dict of a well-formed body, None to fall back'''
+        if data.__class__ is not dict or not self._fast_keys.issuperset(data):
+            return None
+        values = {}
+        try:
+            for key, attribute, loader, validators, required, default, \
+                    allow_none in self._fast_fields:
+                if key in data:
+                    value = data[key]
+                    if value is None and allow_none:
+                        # Not validated, as in marshmallow
+                        values[attribute] = None
+                        continue
+                    value = loader(value)
+                    for validator in validators:
+                        validator(value)
+                elif partial or (default is missing and not required):
+                    continue
+                elif required:
+                    return None
+                else:
+                    value = default
+                values[attribute] = value
+        except (TypeError, ValueError, ValidationError):
+            return None
+        return values
+
+    def load(self, data, *, many=None, partial=None, instance=None,
+             **kwargs):
+        if self._fast_fields is None or kwargs:
+            return super().load(data, many=many, partial=partial,
+                                instance=instance, **kwargs)
+        loaded = self._fast_load(data, self.many if many is None else many,
+                                 self.partial if partial is None else partial)
+        self.instance = instance
+        try:
+            if loaded is None:
+                # Skips the load_instance mixin's load(), which only adds a
+                # package metadata lookup costing more than the load itself
+                return Schema.load(self, data, many=many, partial=partial)
+            if not self._load_instance:
+                return loaded
+            if isinstance(loaded, list):
+                return [self.make_instance(values) for values in loaded]
+            return self.make_instance(loaded)
+        finally:
+            self.instance = None
+
+    def _fast_load(self, data, many, partial):
+        if partial not in (None, False, True):
+            return None
+        if not many:
+            return self._fast_load_one(data, partial)
+        if data.__class__ is not list:
+            return None
+        loaded = [self._fast_load_one(item, partial) for item in data]
+        return None if None in loaded else loaded
+
 
 task_schema = TaskSchema()
 tasks_schema = TaskSchema(many=True)
+# Plain-dict loader for batch endpoints, avoids building a Task per item
+bulk_tasks_schema = TaskSchema(many=True, load_instance=False)
+# Validates a single body into a plain dict, no session or Task instance
+task_dict_schema = TaskSchema(load_instance=False)
@@ -0,0 +1,467 @@
+import base64
+import binascii
+import json
+import operator
+import weakref
+from datetime import datetime, timedelta
+from functools import lru_cache
+from sqlalchemy import (and_, bindparam, case, func, literal_column, or_,
+                        select, union_all, update)
+from sqlalchemy.sql.elements import UnaryExpression
+from sqlalchemy.sql.operators import custom_op
+from sqlalchemy.sql.util import ClauseAdapter
+from task_models import (PRIORITY_RANKS, STATUS_RANKS, UNKNOWN_RANK, Task,
+                         TaskArchive, TaskChange, TaskCount, task_fts)
+
+
+MAX_PAGE_SIZE = 1000
+SORT_FIELDS = ['id', 'name', 'priority', 'due_on', 'status', 'created_on']
+# Exact match filters, a comma separated list matches any of its values
+VALUE_FILTERS = ['priority', 'status']
+# Inclusive date range filters: argument -> (column, comparison)
+RANGE_FILTERS = {
+    'due_after': ('due_on', operator.ge),
+    'due_before': ('due_on', operator.le),
+    'created_after': ('created_on', operator.ge),
+    'created_before': ('created_on', operator.le),
+}
+# Arguments of the listing that narrow it down, as opposed to ordering it
+FILTER_ARGS = ['search', 'priority', 'due_on', 'status', *RANGE_FILTERS]
+# Every argument GET /api/tasks reads, others do not change the response
+LISTING_ARGS = ['sort', *FILTER_ARGS, 'include_archived', 'fields',
+                'limit', 'cursor', 'stream']
+# Trigram tokens are three characters long, shorter terms cannot use them
+MIN_INDEXED_SEARCH_LENGTH = 3
+# Due date buckets of GET /api/tasks/stats, counted for open tasks only
+DUE_BUCKETS = ['overdue', 'today', 'this_week', 'later', 'none']
+DONE_STATUS = 'Completed'
+# Upper bound on how long GET /api/tasks/changes?wait= holds a request
+MAX_CHANGES_WAIT = 30
+
+# Listing statements kept by query shape, see prepare_tasks_query. The
+# filter, sort, cursor and field combinations a client can ask for run
+# into the thousands, the least recently used ones are dropped.
+MAX_CACHED_STATEMENTS = 256
+
+_schema_objects = weakref.WeakKeyDictionary()
+
+
+class InvalidQueryArgument(ValueError):
+    '''Raised when a query string argument cannot be turned into SQL'''
+
+    def __init__(self, error, event, details=None):
+        super().__init__(error)
+        self.error = error
+        self.event = event
+        self.details = details
+
+
+def sort_expression(sort_on):
+    '''Return the SQL expression the listing is ordered by'''
+    if sort_on == "priority":
+        return Task.priority_rank
+    if sort_on == "status":
+        return Task.status_rank
+    return getattr(Task, sort_on or "id")
+
+
+def sort_value(task, sort_on):
+    '''Return the value of sort_expression for an already loaded task'''
+    if sort_on == "priority":
+        return PRIORITY_RANKS.get(task.priority, UNKNOWN_RANK)
+    if sort_on == "status":
+        return STATUS_RANKS.get(task.status, UNKNOWN_RANK)
+    return getattr(task, sort_on or "id")
+
+
+def encode_cursor(task, sort_on):
+    '''Build the opaque cursor pointing just past task'''
+    value = sort_value(task, sort_on)
+    if hasattr(value, "isoformat"):
+        value = value.isoformat()
+    raw = json.dumps([sort_on, value, task.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sort_on):
+    '''Turn a cursor back into the (sort value, id) pair it points past'''
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, value, last_id = json.loads(
+            base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidQueryArgument("Invalid cursor", "invalid_cursor",
+                                   "cursor is malformed")
+
+    if cursor_sort != sort_on:
+        raise InvalidQueryArgument("Invalid cursor", "invalid_cursor",
+                                   "cursor was issued for a different sort")
+    if not isinstance(last_id, int):
+        raise InvalidQueryArgument("Invalid cursor", "invalid_cursor",
+                                   "cursor is malformed")
+    if value is not None and sort_on in ("due_on", "created_on"):
+        try:
+            value = datetime.strptime(value, "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            raise InvalidQueryArgument("Invalid cursor", "invalid_cursor",
+                                       "cursor is malformed")
+    return value, last_id
+
+
+def keyset_condition(sort_on, value, last_id):
+    '''WHERE clause selecting rows ordered after (value, last_id)'''
+    if not sort_on or sort_on == "id":
+        return Task.id > last_id
+
+    expression = sort_expression(sort_on)
+    if value is None:
+        # SQLite sorts NULLs first, so everything non-NULL comes after
+        return or_(and_(expression.is_(None), Task.id > last_id),
+                   expression.is_not(None))
+    # The leading >= keeps this a range scan on the sort column's index
+    return and_(expression >= value,
+                or_(expression > value, Task.id > last_id))
+
+
+def parse_limit(raw_limit):
+    '''Validate the page size requested through ?limit='''
+    try:
+        limit = int(raw_limit)
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidQueryArgument(
+            "Invalid limit", "invalid_limit",
+            f"limit must be an integer between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+
+def parse_date(raw_date):
+    '''Validate a yyyy-mm-dd date given to a date filter'''
+    try:
+        return datetime.strptime(raw_date, "%Y-%m-%d").date()
+    except ValueError as err:
+        raise InvalidQueryArgument("Invalid date format",
+                                   "invalid_date_entered", str(err))
+
+
+def parse_flag(raw_flag):
+    '''Whether a boolean query string argument is set'''
+    return raw_flag is not None and raw_flag.lower() in ("1", "true", "yes")
+
+
+def parse_since(raw_since):
+    '''Validate the change sequence number requested through ?since='''
+    try:
+        since = int(raw_since)
+    except ValueError:
+        since = -1
+    if since < 0:
+        raise InvalidQueryArgument("Invalid since", "invalid_since",
+                                   "since must be a non-negative integer")
+    return since
+
+
+def parse_wait(raw_wait):
+    '''Validate the long-poll timeout requested through ?wait='''
+    try:
+        wait = float(raw_wait)
+    except ValueError:
+        wait = -1
+    if not 0 <= wait <= MAX_CHANGES_WAIT:
+        raise InvalidQueryArgument(
+            "Invalid wait", "invalid_wait",
+            f"wait must be a number of seconds between 0 and "
+            f"{MAX_CHANGES_WAIT}")
+    return wait
+
+
+def search_index_available(session):
+    '''Whether the task_fts index exists in the session's database'''
+    return schema_object_exists(session.get_bind(), "task_fts")
+
+
+def stats_summary_available(session):
+    '''Whether the trigger maintained task_counts table exists'''
+    return schema_object_exists(session.get_bind(), "task_counts")
+
+
+def schema_object_exists(engine, name):
+    '''Whether a table, index or trigger exists, cached per engine'''
+    known = _schema_objects.setdefault(engine, {})
+    exists = known.get(name)
+    if exists is None:
+        exists = False
+        if engine.dialect.name == "sqlite":
+            with engine.connect() as connection:
+                exists = connection.exec_driver_sql(
+                    "SELECT 1 FROM sqlite_master WHERE name = ?", (name,)
+                ).first() is not None
+        known[name] = exists
+    return exists
+
+
+def search_phrase(search_term):
+    '''The search term as an FTS5 phrase, matched as a substring'''
+    return '"' + search_term.replace('"', '""') + '"'
+
+
+def search_condition(phrase):
+    '''FTS5 MATCH for a substring search on the trigram index'''
+    return literal_column("task_fts").op("MATCH")(phrase)
+
+
+def prepare_tasks_query(args, search_index=False, columns=None, limit=None,
+                        merge=False):
+    '''Turn the GET /api/tasks arguments into a statement and parameters
+
+    Returns the statement, its parameters and the sort key it is ordered
+    by (None for id), which is what cursors for this query have to be
+    encoded with. Argument values only ever become bind parameters, so
+    requests with the same filters, sort and cursor kind share one
+    statement, built on first use and kept while it is among the
+    MAX_CACHED_STATEMENTS most recently used. Reusing the object also
+    reuses its SQLAlchemy cache key, which costs more than building the
+    select.
+    columns selects those instead of Task and limit adds a LIMIT, with
+    a limit the columns cursors are built from are added if missing.
+    With search_index the search term is looked up in task_fts and an
+    unsorted, unpaginated search is ordered by relevance.
+    include_archived lists task_archive too, see all_tasks. merge is for
+    results merged from several databases (task_shards.py): the sort
+    columns are always selected and there is no relevance order, whose
+    scores are per database.
+    '''
+    params = {}
+    archived = parse_flag(args.get("include_archived"))
+    search = None
+    search_term = args.get("search")
+    # task_fts only covers the task table, archived names need the scan
+    if search_term and search_index and not archived and \
+            len(search_term) >= MIN_INDEXED_SEARCH_LENGTH:
+        search = "index"
+        params["search"] = search_phrase(search_term)
+    elif search_term:
+        search = "like"
+        params["search"] = f"%{search_term}%"
+
+    # Parameters are not named after the columns, an UPDATE's SET ones are
+    filters = []
+    for key in VALUE_FILTERS:
+        values = [value.strip() for value in args.get(key, "").split(",")
+                  if value.strip()]
+        if len(values) == 1:
+            params[f"filter_{key}"] = values[0]
+            filters.append((key, "eq"))
+        elif values:
+            params[f"filter_{key}"] = values
+            filters.append((key, "in"))
+
+    if args.get("due_on"):
+        params["filter_due_on"] = parse_date(args.get("due_on"))
+        filters.append(("due_on", "eq"))
+
+    for key in RANGE_FILTERS:
+        if args.get(key):
+            params[f"filter_{key}"] = parse_date(args.get(key))
+            filters.append((key, "range"))
+
+    sort_on = args.get("sort")
+    if sort_on and sort_on not in SORT_FIELDS:
+        raise InvalidQueryArgument(
+            "Invalid sort field", "invalid_sort_field",
+            f"sort field needs to be in {SORT_FIELDS}")
+    # Sorting on a column pinned by an equality filter is sorting on a
+    # constant, ordering by id alone keeps the plan on the filter's index
+    if sort_on == "id" or (sort_on, "eq") in filters:
+        sort_on = None
+
+    cursor = None
+    if args.get("cursor"):
+        value, params["last_id"] = decode_cursor(args.get("cursor"), sort_on)
+        cursor = "id"
+        if sort_on:
+            # NULLs sort first, past a NULL the condition has another shape
+            cursor = "null" if value is None else "value"
+            params["cursor_value"] = value
+
+    ranked = search == "index" and not cursor and not args.get("limit") \
+        and not merge
+    if limit is not None:
+        params["limit"] = limit
+    if columns and (limit is not None or merge):
+        columns = _with_cursor_columns(columns, sort_on)
+
+    shape = (search, tuple(filters), sort_on, cursor, ranked,
+             tuple(columns) if columns else None, limit is not None,
+             archived)
+    return _build_tasks_statement(*shape), params, sort_on
+
+
+def _with_cursor_columns(columns, sort_on):
+    # The next page's cursor and the merge order are read from the rows,
+    # even when the requested fields leave out their id or sort column
+    selected = {column.key for column in columns}
+    missing = [getattr(Task, key) for key in ("id", sort_on)
+               if key and key not in selected]
+    return [*columns, *missing] if missing else columns
+
+
+def all_tasks():
+    '''task and task_archive as a single subquery with task's columns'''
+    names = [column.name for column in Task.__table__.columns]
+    archive = TaskArchive.__table__
+    return union_all(select(Task.__table__),
+                     select(*[archive.c[name] for name in names])
+                     ).subquery("all_tasks")
+
+
+@lru_cache(maxsize=MAX_CACHED_STATEMENTS)
+def _build_tasks_statement(search, filters, sort_on, cursor, ranked, columns,
+                           limited, archived):
+    if archived and not columns:
+        # Task entities cannot come from the union, plain rows can
+        columns = list(Task.__table__.columns)
+    query = select(*columns) if columns else select(Task)
+
+    if search == "index":
+        query = query.join(task_fts, task_fts.c.rowid == Task.id) \
+            .where(search_condition(bindparam("search")))
+    elif search == "like":
+        query = query.where(Task.name.ilike(bindparam("search")))
+
+    # SQLite cannot read several values of an index in another column's
+    # order, an IN list searched on its index needs a temp B-tree to sort
+    # the rows. Unless another filter narrows them down, walking the sort
+    # order and checking the few priorities or statuses is cheaper and
+    # stops at the page limit. The no-op unary + hides the column's index.
+    in_lists_only = all(kind == "in" for _, kind in filters)
+    for key, kind in filters:
+        value = bindparam(f"filter_{key}", expanding=kind == "in")
+        if kind == "range":
+            column, compare = RANGE_FILTERS[key]
+            query = query.where(compare(getattr(Task, column), value))
+        elif kind == "in":
+            column = getattr(Task, key)
+            if in_lists_only:
+                column = UnaryExpression(column, operator=custom_op("+"))
+            query = query.where(column.in_(value))
+        else:
+            query = query.where(getattr(Task, key) == value)
+
+    if cursor:
+        value = bindparam("cursor_value") if cursor == "value" else None
+        query = query.where(
+            keyset_condition(sort_on, value, bindparam("last_id")))
+
+    if sort_on:
+        query = query.order_by(sort_expression(sort_on), Task.id)
+    elif ranked:
+        query = query.order_by(task_fts.c.rank, Task.id)
+    else:
+        query = query.order_by(Task.id)
+
+    if limited:
+        query = query.limit(bindparam("limit"))
+    if archived:
+        # Same statement, with every task column read from the union
+        query = ClauseAdapter(all_tasks()).traverse(query)
+    return query
+
+
+def build_tasks_query(args, search_index=False):
+    '''Build the select for GET /api/tasks with the argument values bound
+
+    Returns the query and its sort key, see prepare_tasks_query. For
+    callers that go on to derive other statements from the query, the
+    listing itself executes the shared statement.
+    '''
+    statement, params, sort_on = prepare_tasks_query(args, search_index)
+    return statement.params(params), sort_on
+
+
+def build_update_query(args, values, search_index=False):
+    '''Build the set-based UPDATE for PATCH /api/tasks
+
+    The listing's filters select the rows, sorting and paging arguments
+    are ignored. At least one filter is required, a bare PATCH does not
+    rewrite every task.
+    '''
+    filters = {key: args[key] for key in FILTER_ARGS if args.get(key)}
+    if not filters:
+        raise InvalidQueryArgument(
+            "Missing filter", "missing_filter",
+            f"at least one of {FILTER_ARGS} is required")
+    query, _ = build_tasks_query(filters, search_index)
+    task_ids = query.with_only_columns(Task.id).order_by(None)
+    return update(Task).where(Task.id.in_(task_ids)).values(**values)
+
+
+def build_stats_query(today, summary=False):
+    '''Count tasks per status, priority and due date bucket
+
+    Reads the task_counts summary when summary is set, otherwise groups
+    the task table itself, which the (priority, status, due_on) index
+    covers. The week ends on Sunday.
+    '''
+    source = TaskCount if summary else Task
+    count = func.sum(TaskCount.task_count) if summary else func.count()
+    week_end = today + timedelta(days=6 - today.weekday())
+    due_bucket = case(
+        (source.due_on.is_(None), "none"),
+        (source.due_on < today, "overdue"),
+        (source.due_on == today, "today"),
+        (source.due_on <= week_end, "this_week"),
+        else_="later").label("due_bucket")
+    return select(source.status, source.priority, due_bucket,
+                  count.label("task_count")) \
+        .group_by(source.priority, source.status, due_bucket)
+
+
+def summarize_stats(rows):
+    '''Fold the rows of build_stats_query into the stats response'''
+    by_status = dict.fromkeys(STATUS_RANKS, 0)
+    by_priority = dict.fromkeys(PRIORITY_RANKS, 0)
+    by_due = dict.fromkeys(DUE_BUCKETS, 0)
+    total = 0
+    for status, priority, due_bucket, count in rows:
+        total += count
+        if status is not None:
+            by_status[status] = by_status.get(status, 0) + count
+        if priority is not None:
+            by_priority[priority] = by_priority.get(priority, 0) + count
+        if status != DONE_STATUS:
+            by_due[due_bucket] += count
+    return {"total": total, "by_status": by_status,
+            "by_priority": by_priority, "by_due": by_due}
+
+
+def build_changes_query(since, limit, columns):
+    '''Tasks changed after change sequence number since, oldest first
+
+    Yields the latest seq and task id of each changed task, the id of
+    its current row, NULL once it was deleted, and then columns of it.
+    '''
+    latest = select(func.max(TaskChange.seq).label("seq"),
+                    TaskChange.task_id) \
+        .where(TaskChange.seq > since) \
+        .group_by(TaskChange.task_id) \
+        .subquery()
+    return select(latest.c.seq, latest.c.task_id,
+                  Task.id.label("current_id"), *columns) \
+        .select_from(latest.outerjoin(Task, Task.id == latest.c.task_id)) \
+        .order_by(latest.c.seq) \
+        .limit(limit)
+
+
+def explain_query_plan(session, query):
+    '''Return the detail lines of SQLite's EXPLAIN QUERY PLAN for query'''
+    connection = session.connection()
+    # Expanding IN parameters are rendered one placeholder per value
+    compiled = query.compile(dialect=connection.dialect,
+                             compile_kwargs={"render_postcompile": True})
+    params = compiled.construct_params()
+    rows = connection.exec_driver_sql(
+        f"EXPLAIN QUERY PLAN {compiled}",
+        tuple(params[name] for name in compiled.positiontup))
+    return [row[-1] for row in rows]
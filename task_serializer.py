@@ -0,0 +1,187 @@
+import json
+from flask import current_app
+from marshmallow import fields
+from sqlalchemy import String, type_coerce
+from task_models import Task, task_schema
+from task_queries import InvalidQueryArgument
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder gives the same bytes
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # optional, MessagePack listings are not offered
+    msgpack = None
+
+JSON_MIMETYPE = "application/json"
+# {"fields": [...], "rows": [[...], ...]}, each key sent once
+COLUMNS_MIMETYPE = "application/vnd.tasks.columns+json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+MSGPACK_MIMETYPE = "application/msgpack"
+
+
+class RowSerializer:
+    '''Dumps plain row tuples exactly like a marshmallow schema would
+
+    The schema's dump fields are inspected once and compiled into a
+    single function building the output dict, so selecting
+    serializer.columns and passing the rows to dump() skips both ORM
+    hydration and marshmallow's per-field machinery. Rows may carry
+    extra trailing columns, they are ignored.
+    '''
+
+    def __init__(self, schema, model, keys=None):
+        self.schema = schema
+        self.model = model
+        self.keys = []
+        self.columns = []
+        self._subsets = {}
+        namespace = {}
+        items = []
+        for name, field in schema.dump_fields.items():
+            key = field.data_key or name
+            if keys is not None and key not in keys:
+                continue
+            position = len(self.columns)
+            column = getattr(model, field.attribute or name)
+            value = f"row[{position}]"
+            if isinstance(field, fields.Date) and \
+                    field.format in (None, "iso"):
+                # Read the stored ISO text as is instead of parsing it
+                # into a date only to format it back
+                column = type_coerce(column, String).label(column.key)
+                value = (f"({value} if {value} is None or "
+                         f"{value}.__class__ is str else {value}.isoformat())")
+            elif not isinstance(field, (fields.String, fields.Integer)):
+                namespace[f"_field_{position}"] = _field_serializer(field,
+                                                                    name)
+                value = f"_field_{position}({value})"
+            self.keys.append(key)
+            self.columns.append(column)
+            items.append((key, value))
+
+        source = (
+            "def dump_one(row):\n    return {"
+            + ", ".join(f"{key!r}: {value}" for key, value in items)
+            + "}\n\ndef dump_values(row):\n    return ["
+            + ", ".join(value for _, value in items) + "]\n")
+        exec(source, namespace)
+        self.dump_one = namespace["dump_one"]
+        self.dump_values = namespace["dump_values"]
+
+    def dump(self, rows):
+        dump_one = self.dump_one
+        return [dump_one(row) for row in rows]
+
+    def dump_columns(self, rows):
+        '''Columnar form, the keys once and a list of values per row'''
+        dump_values = self.dump_values
+        return {"fields": self.keys,
+                "rows": [dump_values(row) for row in rows]}
+
+    def only(self, keys):
+        '''Serializer for a subset of the output keys, in schema order'''
+        keys = frozenset(keys)
+        subset = self._subsets.get(keys)
+        if subset is None:
+            unknown = keys.difference(self.keys)
+            if unknown:
+                raise ValueError(f"unknown fields {sorted(unknown)}")
+            subset = self._subsets[keys] = RowSerializer(
+                self.schema, self.model, keys)
+        return subset
+
+
+def _field_serializer(field, name):
+    def convert(value):
+        if value is None:
+            return None
+        return field._serialize(value, name, None)
+    return convert
+
+
+def json_encoder(compact=None):
+    '''Function encoding data to the same bytes jsonify would produce'''
+    provider = current_app.json
+    if compact is None:
+        compact = provider.compact
+    if compact is None:
+        compact = not current_app.debug
+    sort_keys = provider.sort_keys
+    ensure_ascii = provider.ensure_ascii
+    dump_args = {"separators": (",", ":")} if compact else {"indent": 2}
+
+    def encode(data):
+        if orjson is not None and compact and sort_keys:
+            body = orjson.dumps(data, option=orjson.OPT_SORT_KEYS |
+                                orjson.OPT_APPEND_NEWLINE)
+            # orjson never escapes non-ASCII, so only pure ASCII output is
+            # guaranteed identical to the ensure_ascii stdlib encoder
+            if body.isascii() or not ensure_ascii:
+                return body
+        return (json.dumps(data, sort_keys=sort_keys,
+                           ensure_ascii=ensure_ascii,
+                           **dump_args) + "\n").encode()
+    return encode
+
+
+def to_json_bytes(data):
+    '''Encode data to the same bytes jsonify would produce'''
+    return json_encoder()(data)
+
+
+def to_json_lines(items):
+    '''Newline delimited JSON, one line per item'''
+    # Compact even in debug mode, indented output would span lines
+    return b"".join(map(json_encoder(compact=True), items))
+
+
+def json_response(data, status=200):
+    return current_app.response_class(to_json_bytes(data), status=status,
+                                      mimetype="application/json")
+
+
+def listing_mimetypes():
+    '''Formats GET /api/tasks can answer with, preferred first'''
+    mimetypes = [JSON_MIMETYPE, COLUMNS_MIMETYPE, NDJSON_MIMETYPE]
+    if msgpack is not None:
+        mimetypes.append(MSGPACK_MIMETYPE)
+    return mimetypes
+
+
+def negotiate_listing(accept):
+    '''Listing format for a parsed Accept header, None if none fits'''
+    if not accept:
+        return JSON_MIMETYPE
+    return accept.best_match(listing_mimetypes())
+
+
+def listing_serializer(raw_fields):
+    '''Serializer for a ?fields= list, all fields when it is missing'''
+    if raw_fields is None:
+        return task_serializer
+    keys = [key.strip() for key in raw_fields.split(",") if key.strip()]
+    try:
+        if not keys:
+            raise ValueError("no fields")
+        return task_serializer.only(keys)
+    except ValueError:
+        raise InvalidQueryArgument(
+            "Invalid fields", "invalid_fields",
+            f"fields must be a comma separated list of "
+            f"{sorted(task_serializer.keys)}")
+
+
+def encode_listing(serializer, rows, mimetype):
+    '''Body of a task listing in one of the listing_mimetypes()'''
+    if mimetype == COLUMNS_MIMETYPE:
+        return to_json_bytes(serializer.dump_columns(rows))
+    if mimetype == NDJSON_MIMETYPE:
+        return to_json_lines(serializer.dump(rows))
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(serializer.dump(rows))
+    return to_json_bytes(serializer.dump(rows))
+
+
+task_serializer = RowSerializer(task_schema, Task)
@@ -0,0 +1,188 @@
+'''Tasks split across several SQLite databases, each with its own writer
+
+SQLite lets one connection write to a database file at a time, so a
+single task.db caps write throughput however many workers there are.
+With TASK_SHARDS set to a list of database URIs, each task lives in
+exactly one of them:
+
+- a new task goes to the shard its name hashes to, so two creates of the
+  same name meet at that shard's unique name index;
+- the shard allocates its id, shard i of n hands out i + 1, i + 1 + n,
+  i + 1 + 2n, ... Ids are unique across shards and name their shard, so
+  reading, replacing or deleting a task by id touches one database;
+- a listing runs the same statement on every shard in a thread pool and
+  merges the sorted results, see TaskShards.list_tasks.
+
+A task keeps its shard when renamed, so creates and renames also look
+for the name in the other shards. A rename racing a create of the same
+name in another shard can get past that check. The shards cannot be
+reordered or added to once they hold tasks, both the name hash and the
+ids depend on their number and order.
+
+Only listing, creating, reading, replacing and deleting tasks are
+served from shards, the other /api/tasks endpoints answer 501 and the
+import, export and archive commands refuse to run. Create the tables
+with `flask tasks create-shards`.
+'''
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+from sqlalchemy import (column, create_engine, delete, func, insert, select,
+                        table, update)
+from sqlalchemy.exc import IntegrityError
+
+from config import db, register_sqlite_pragmas
+from task_models import Task
+from task_queries import schema_object_exists, sort_value
+
+# Where AUTOINCREMENT keeps the largest id a table ever had
+sqlite_sequence = table("sqlite_sequence", column("name"), column("seq"))
+
+
+class TaskNameTaken(Exception):
+    '''A create or rename used the name of a task in any shard'''
+
+
+class TaskShards:
+    '''The shard engines and which of them a task belongs to'''
+
+    def __init__(self, engines):
+        self.engines = engines
+        self._executor = ThreadPoolExecutor(max_workers=len(engines),
+                                            thread_name_prefix="task-shard")
+
+    def shard_for_name(self, name):
+        # crc32, unlike hash(), is the same in every worker process
+        return zlib.crc32(name.encode()) % len(self.engines)
+
+    def shard_for_id(self, task_id):
+        return (task_id - 1) % len(self.engines)
+
+    def next_id(self, index):
+        '''SQL for the next id of shard index
+
+        Evaluated by the INSERT itself, which holds the shard's write
+        lock, so concurrent creates in one shard cannot get the same id.
+        sqlite_sequence only grows, deleted ids are not handed out again.
+        '''
+        count = len(self.engines)
+        last = select(sqlite_sequence.c.seq) \
+            .where(sqlite_sequence.c.name == Task.__tablename__) \
+            .scalar_subquery()
+        return func.coalesce(last, index + 1 - count) + count
+
+    def fan_out(self, work, engines=None):
+        '''work(connection) on each shard in parallel, results in order'''
+        engines = self.engines if engines is None else engines
+        if len(engines) == 1:
+            return [_run(work, engines[0])]
+        return list(self._executor.map(partial(_run, work), engines))
+
+    def list_tasks(self, statement, params, sort_on, limit=None):
+        '''Rows of a listing statement from all shards, in its order
+
+        The statement comes from prepare_tasks_query(merge=True), so each
+        shard returns at most limit rows ordered by sort value and id,
+        with those columns selected. The first limit rows of their k-way
+        merge are the first limit rows of the whole listing.
+        '''
+        results = self.fan_out(
+            lambda connection: connection.execute(statement, params).all())
+        return list(islice(heapq.merge(*results, key=merge_key(sort_on)),
+                           limit))
+
+    def execute(self, task_id, statement):
+        '''Run a read of one task on its shard, the rows are buffered'''
+        engine = self.engines[self.shard_for_id(task_id)]
+        with engine.connect() as connection:
+            return connection.execute(statement).freeze()()
+
+    def insert(self, values, columns):
+        '''Create a task in the shard of its name, returns its columns'''
+        index = self.shard_for_name(values["name"])
+        # The shard allocates the id
+        values = {key: value for key, value in values.items()
+                  if key != "id"}
+        statement = insert(Task).values(id=self.next_id(index), **values) \
+            .returning(*columns)
+        return self._write(index, values["name"], statement).one()
+
+    def update(self, task_id, values, columns):
+        '''Update a task in its shard, None when it does not exist'''
+        # The id names the task's shard, it cannot change
+        values = {key: value for key, value in values.items()
+                  if key != "id"}
+        statement = update(Task).where(Task.id == task_id) \
+            .values(**values).returning(*columns)
+        return self._write(self.shard_for_id(task_id), values.get("name"),
+                           statement).first()
+
+    def delete(self, task_id):
+        '''Delete a task, returns whether it existed'''
+        statement = delete(Task).where(Task.id == task_id) \
+            .returning(Task.id)
+        return self._write(self.shard_for_id(task_id), None,
+                           statement).first() is not None
+
+    def search_index_available(self):
+        return schema_object_exists(self.engines[0], "task_fts")
+
+    def create_all(self):
+        '''Create the tables, indexes and triggers missing in any shard'''
+        for engine in self.engines:
+            db.metadata.create_all(engine)
+
+    def _write(self, index, name, statement):
+        try:
+            with self.engines[index].begin() as connection:
+                if name is not None and self._name_taken(name, index):
+                    raise TaskNameTaken(name)
+                return connection.execute(statement).freeze()()
+        except IntegrityError:
+            # The unique name index of the shard written to
+            raise TaskNameTaken(name)
+
+    def _name_taken(self, name, index):
+        others = self.engines[:index] + self.engines[index + 1:]
+        if not others:
+            return False
+        query = select(Task.id).where(Task.name == name).limit(1)
+        return any(self.fan_out(
+            lambda connection: connection.scalar(query) is not None,
+            others))
+
+
+def _run(work, engine):
+    with engine.connect() as connection:
+        return work(connection)
+
+
+def merge_key(sort_on):
+    '''Sort key of listing rows matching ORDER BY sort_expression, id'''
+    def key(row):
+        value = sort_value(row, sort_on)
+        # SQLite sorts NULLs first
+        return (value is not None, value, row.id)
+    return key
+
+
+def init_app(app):
+    '''Route task storage through the shards when TASK_SHARDS is set
+
+    The engines get the options and pragmas of the main database. Like
+    READ_DATABASE_URI, relative SQLite paths are relative to the working
+    directory.
+    '''
+    uris = app.config["TASK_SHARDS"]
+    if not uris:
+        return
+    engines = []
+    for uri in uris:
+        engine = create_engine(
+            uri, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        register_sqlite_pragmas(engine, app.config["SQLITE_PRAGMAS"])
+        engines.append(engine)
+    app.extensions["task_shards"] = TaskShards(engines)
@@ -0,0 +1,183 @@
+'''Group commit of task writes from one background thread
+
+Each commit of a SQLite database waits for the journal to reach the
+disk, so committing every create on its own caps writes at one fsync
+each. With WRITE_BATCHING_ENABLED, POST /api/tasks and PUT
+/api/tasks/<id> validate on the request thread and queue their write.
+A single writer thread runs the queued writes in one transaction, up to
+WRITE_BATCH_SIZE of them or whatever arrived WRITE_BATCH_DELAY seconds
+after the first, and commits once. Every write runs in its own
+savepoint, a duplicate name fails that write alone. The requests wait
+on a Future for their own row, which is only resolved once the batch is
+committed, so responses are the same as without batching. A request
+gives up after WRITE_TIMEOUT seconds, its write is then skipped unless
+the writer has already started it.
+
+Batches form inside one process, so it pays off with a threaded server
+(or many connections per worker) and a durable synchronous setting.
+Needs a database file, the in-memory test database has one connection
+for every thread. Not used with TASK_SHARDS.
+'''
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as ResultTimeout
+
+from sqlalchemy import insert, update
+
+from config import db
+from task_models import Task
+
+_STOP = object()
+
+
+class TaskWriterError(RuntimeError):
+    '''The writer is closed or did not get to a write in time'''
+
+
+class BatchWriter:
+    '''Runs queued writes on one thread, committing them in batches'''
+
+    def __init__(self, engine, batch_size=256, max_delay=0.002,
+                 timeout=10.0):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.written = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name="task-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, work, *args):
+        '''Queue work(connection, *args), returns a Future of its result'''
+        if not self._thread.is_alive():
+            raise TaskWriterError("task writer is closed")
+        future = Future()
+        self.queue.put((work, args, future))
+        return future
+
+    def insert(self, values, columns):
+        '''Create a task, returns its columns once committed'''
+        return self._result(self.submit(_insert_task, values, columns))
+
+    def update(self, task_id, values, columns):
+        '''Update a task, None when it does not exist'''
+        return self._result(self.submit(_update_task, task_id, values,
+                                        columns))
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+        # Submitted while the thread was stopping
+        self._fail_queued()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "batches": self.batches
+        }
+
+    def _result(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except ResultTimeout:
+            # Skipped if the writer has not picked it up yet
+            future.cancel()
+            raise TaskWriterError("task write timed out") from None
+
+    def _fail_queued(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP and \
+                    item[2].set_running_or_notify_cancel():
+                item[2].set_exception(
+                    TaskWriterError("task writer is closed"))
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                batch = []
+                deadline = time.monotonic() + self.max_delay
+                while item is not _STOP:
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self.queue.get(
+                            timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+
+                if batch:
+                    self._commit(batch)
+                if item is _STOP:
+                    return
+        finally:
+            # Stopped or crashed, nothing queued would ever be answered
+            self._fail_queued()
+
+    def _commit(self, batch):
+        # Writes whose request timed out are dropped
+        batch = [item for item in batch
+                 if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            with self.engine.connect() as connection, connection.begin():
+                # The write lock for the whole batch, before any read
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+                for work, args, future in batch:
+                    try:
+                        with connection.begin_nested():
+                            outcomes.append((future, work(connection, *args),
+                                             None))
+                    except Exception as err:
+                        outcomes.append((future, None, err))
+        except Exception as err:
+            # Nothing was committed, every write of the batch failed
+            for _, _, future in batch:
+                future.set_exception(err)
+            return
+
+        self.written += sum(error is None for _, _, error in outcomes)
+        self.batches += 1
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def _insert_task(connection, values, columns):
+    return connection.execute(
+        insert(Task).values(**values).returning(*columns)).one()
+
+
+def _update_task(connection, task_id, values, columns):
+    return connection.execute(
+        update(Task).where(Task.id == task_id).values(**values)
+        .returning(*columns)).first()
+
+
+def init_app(app):
+    '''Start the writer thread when WRITE_BATCHING_ENABLED is set'''
+    if not app.config["WRITE_BATCHING_ENABLED"] or \
+            "task_shards" in app.extensions:
+        return
+    with app.app_context():
+        engine = db.engine
+    app.extensions["task_writer"] = BatchWriter(
+        engine, app.config["WRITE_BATCH_SIZE"],
+        app.config["WRITE_BATCH_DELAY"], app.config["WRITE_TIMEOUT"])
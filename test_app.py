@@ -1,7 +1,29 @@
+import asyncio
+import itertools
 import pytest
 import json
+import logging
+import pstats
+import threading
+import time
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MultiDict
+from datetime import date, datetime, timedelta
+import routes
+import task_models
+import task_queries
+import task_serializer as task_serializer_module
+from flask import jsonify
+from marshmallow import ValidationError
+from sqlalchemy import create_engine, event, func, insert, select
 from config import create_app, db
-from task_models import task_schema
+from task_models import (Task, TaskCount, TaskSchema, task_schema,
+                         tasks_schema)
+from task_cache import FileGenerationCounter, ResponseCache, cache_key
+from task_logging import BatchingFileHandler, JsonFormatter
+from task_queries import (build_stats_query, build_tasks_query,
+                          explain_query_plan, prepare_tasks_query)
+from task_serializer import task_serializer, to_json_bytes
 
 
 @pytest.fixture()
@@ -98,6 +120,127 @@ def test_create_task_no_name(client):
     assert response.status_code == 400
 
 
+def test_create_duplicate_task_is_one_insert(client):
+    client.post('/api/tasks', json={"name": "Only once"})
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    response = client.post('/api/tasks', json={"name": "Only once"})
+    event.remove(db.engine, "before_cursor_execute", record)
+
+    assert response.status_code == 406
+    assert response.get_json()["error"] == "Task already exists"
+    assert [s.split()[0] for s in statements] == ["INSERT"]
+
+    second = client.post('/api/tasks', json={"name": "Second"}).get_json()
+    response = client.put(f'/api/tasks/{second["id"]}',
+                          json={"name": "Only once"})
+    assert response.status_code == 406
+
+
+def test_patch_task_is_one_update(client):
+    created = client.post('/api/tasks', json={"name": "Flip me"})
+    task_id = created.get_json()["id"]
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    response = client.patch(f'/api/tasks/{task_id}',
+                            json={"status": "Completed"})
+    event.remove(db.engine, "before_cursor_execute", record)
+
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "Completed"
+    assert response.get_json()["name"] == "Flip me"
+    assert response.headers["ETag"] != created.headers["ETag"]
+    assert [s.split()[0] for s in statements] == ["UPDATE"]
+
+    response = client.patch(f'/api/tasks/{task_id}',
+                            json={"status": "Done"})
+    assert response.status_code == 400
+    response = client.patch(f'/api/tasks/{task_id}', json={})
+    assert response.status_code == 400
+    response = client.patch('/api/tasks/999', json={"status": "Pending"})
+    assert response.status_code == 404
+
+
+def test_patch_task_if_match(client):
+    created = client.post('/api/tasks', json={"name": "Contended"})
+    task_id = created.get_json()["id"]
+    stale_etag = created.headers["ETag"]
+
+    response = client.patch(f'/api/tasks/{task_id}',
+                            json={"priority": "High"},
+                            headers={"If-Match": stale_etag})
+    assert response.status_code == 200
+
+    response = client.patch(f'/api/tasks/{task_id}',
+                            json={"priority": "Low"},
+                            headers={"If-Match": stale_etag})
+    assert response.status_code == 412
+    assert client.get(f'/api/tasks/{task_id}').get_json()["priority"] == \
+        "High"
+
+    response = client.patch(f'/api/tasks/{task_id}',
+                            json={"priority": "Low"}, headers={"If-Match": "*"})
+    assert response.status_code == 200
+
+
+def test_patch_tasks_by_filter(client):
+    client.post('/api/tasks/bulk', json=[
+        {"name": "Queued one"}, {"name": "Queued two"},
+        {"name": "Already running", "status": "In Progress"}])
+
+    response = client.patch('/api/tasks?status=Pending',
+                            json={"status": "In Progress"})
+    assert response.status_code == 200
+    assert response.get_json() == {"updated": 2}
+    assert len(client.get('/api/tasks?status=In Progress').get_json()) == 3
+
+    response = client.patch('/api/tasks?sort=name', json={"status": "Pending"})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Missing filter"
+
+
+def test_upsert_task_by_name(client):
+    response = client.put('/api/tasks/by-name/Weekly report',
+                          json={"priority": "High", "due_on": "2099-08-01"})
+    assert response.status_code == 201
+    created = response.get_json()
+    assert created["name"] == "Weekly report"
+
+    response = client.put('/api/tasks/by-name/Weekly report',
+                          json={"status": "Completed"})
+    assert response.status_code == 200
+    updated = response.get_json()
+    assert updated["id"] == created["id"]
+    assert updated["status"] == "Completed"
+    assert updated["priority"] == "Medium"
+    assert updated["due_on"] is None
+    assert updated["created_on"] == created["created_on"]
+    assert response.headers["ETag"] == \
+        client.get(f'/api/tasks/{created["id"]}').headers["ETag"]
+    assert client.get('/api/tasks/changes').get_json()["last_seq"] == 2
+
+    response = client.put('/api/tasks/by-name/Weekly report',
+                          json={"due_on": "2099-08-01"})
+    response = client.put('/api/tasks/by-name/Weekly report', json={})
+    assert response.status_code == 200
+    assert response.get_json()["due_on"] is None
+    assert response.get_json()["status"] == "Pending"
+
+    response = client.put('/api/tasks/by-name/Weekly report',
+                          json={"name": "Monthly report"})
+    assert response.status_code == 400
+    response = client.put('/api/tasks/by-name/x', json={})
+    assert response.status_code == 400
+
+
 def test_get_task_by_search(client):
     data = {
         "name": "Find this task with search",
@@ -247,9 +390,1329 @@ def test_create_app_development():
     app = create_app()
     assert app is not None
     assert app.config['SQLALCHEMY_DATABASE_URI'] == 'sqlite:///task.db'
+    # flask tasks commands write the same file from another process
+    assert isinstance(app.extensions["task_generation"],
+                      FileGenerationCounter)
 
 
 def test_blueprint_registration():
     app = create_app('testing')
     blueprint_names = [bp.name for bp in app.blueprints.values()]
     assert 'api' in blueprint_names
+
+
+def _seed_tasks(count):
+    today = datetime.now().date()
+    priorities = ["Low", "Medium", "High"]
+    for i in range(count):
+        task = task_schema.load({
+            "name": f"Task {i:03d}",
+            "priority": priorities[i % 3],
+            "due_on": (today + timedelta(days=i % 4)).isoformat()
+        })
+        db.session.add(task)
+    db.session.commit()
+
+
+def test_keyset_pagination_walks_all_pages(client):
+    _seed_tasks(10)
+    expected = client.get('/api/tasks?sort=priority').get_json()
+
+    seen = []
+    url = '/api/tasks?sort=priority&limit=4'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page) <= 4
+        seen.extend(page)
+        cursor = response.headers.get('X-Next-Cursor')
+        url = (f'/api/tasks?sort=priority&limit=4&cursor={cursor}'
+               if cursor else None)
+
+    assert seen == expected
+
+
+def test_keyset_pagination_on_date_sort(client):
+    _seed_tasks(7)
+    first = client.get('/api/tasks?sort=due_on&limit=5')
+    cursor = first.headers['X-Next-Cursor']
+    second = client.get(f'/api/tasks?sort=due_on&limit=5&cursor={cursor}')
+    assert 'X-Next-Cursor' not in second.headers
+    ids = [task['id'] for task in first.get_json() + second.get_json()]
+    assert sorted(ids) == list(range(1, 8))
+
+
+def test_cursor_from_other_sort_rejected(client):
+    _seed_tasks(3)
+    cursor = client.get('/api/tasks?sort=name&limit=1'
+                        ).headers['X-Next-Cursor']
+    response = client.get(f'/api/tasks?sort=due_on&cursor={cursor}')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "Invalid cursor"
+
+
+def test_invalid_limit(client):
+    response = client.get('/api/tasks?limit=0')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "Invalid limit"
+
+
+def test_streamed_tasks_match_buffered(client):
+    _seed_tasks(5)
+    buffered = client.get('/api/tasks?sort=status').get_json()
+    response = client.get('/api/tasks?sort=status&stream=true')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.get_json() == buffered
+
+
+def test_sparse_fieldsets(client):
+    _seed_tasks(5)
+    response = client.get('/api/tasks?fields=id, name')
+    assert response.get_json()[0] == {"id": 1, "name": "Task 000"}
+
+    # The cursor needs id and due_on, which are selected but not sent
+    names, cursor = [], ""
+    while cursor is not None:
+        page = client.get(f'/api/tasks?fields=name&sort=due_on&limit=2'
+                          f'&cursor={cursor}')
+        assert all(list(task) == ["name"] for task in page.get_json())
+        names += [task["name"] for task in page.get_json()]
+        cursor = page.headers.get("X-Next-Cursor")
+    full = client.get('/api/tasks?sort=due_on').get_json()
+    assert names == [task["name"] for task in full]
+
+    response = client.get('/api/tasks?fields=name,secret')
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid fields"
+
+
+def test_listing_formats_by_accept(client):
+    _seed_tasks(3)
+    tasks = client.get('/api/tasks?fields=id,status').get_json()
+
+    response = client.get('/api/tasks?fields=id,status', headers={
+        "Accept": "application/vnd.tasks.columns+json"})
+    assert response.content_type == "application/vnd.tasks.columns+json"
+    columns = json.loads(response.get_data())
+    assert [dict(zip(columns["fields"], row))
+            for row in columns["rows"]] == tasks
+    assert "Accept" in response.headers["Vary"]
+
+    for stream in ("false", "true"):
+        response = client.get(f'/api/tasks?fields=id,status&stream={stream}',
+                              headers={"Accept": "application/x-ndjson"})
+        assert response.content_type == "application/x-ndjson"
+        lines = response.get_data().splitlines()
+        assert [json.loads(line) for line in lines] == tasks
+
+    etags = {client.get('/api/tasks', headers={"Accept": accept}).headers[
+        "ETag"] for accept in ("application/json", "application/x-ndjson")}
+    assert len(etags) == 2
+
+    response = client.get('/api/tasks', headers={"Accept": "text/csv"})
+    assert response.status_code == 406
+
+
+def test_msgpack_listing(client):
+    msgpack = pytest.importorskip("msgpack")
+    _seed_tasks(3)
+    response = client.get('/api/tasks',
+                          headers={"Accept": "application/msgpack"})
+    assert response.content_type == "application/msgpack"
+    assert msgpack.unpackb(response.get_data()) == \
+        client.get('/api/tasks').get_json()
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_large_responses_are_compressed(client, encoding):
+    if encoding == "br":
+        brotli = pytest.importorskip("brotli")
+        decompress = brotli.decompress
+    else:
+        import gzip
+        decompress = gzip.decompress
+    _seed_tasks(30)
+    plain = client.get('/api/tasks')
+    assert "Content-Encoding" not in plain.headers
+
+    response = client.get('/api/tasks', headers={"Accept-Encoding": encoding})
+    assert response.headers["Content-Encoding"] == encoding
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert decompress(response.get_data()) == plain.get_data()
+    assert response.headers["ETag"] == "W/" + plain.headers["ETag"]
+    response = client.get('/api/tasks', headers={
+        "Accept-Encoding": encoding,
+        "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+    # Small bodies are not worth it
+    response = client.get('/api/tasks/1', headers={"Accept-Encoding": encoding})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_bulk_create_reports_per_item_results(client):
+    _seed_tasks(1)
+    future = (datetime.now().date() + timedelta(days=3)).isoformat()
+    data = [
+        {"name": "Bulk one", "due_on": future},
+        {"name": "Task 000"},
+        {"name": "x"},
+        {"name": "Bulk two", "priority": "High"},
+        {"name": "Bulk one"}
+    ]
+    response = client.post('/api/tasks/bulk', data=json.dumps(data),
+                           content_type='application/json')
+    assert response.status_code == 207
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == [201, 406, 400,
+                                                         201, 406]
+    assert 'name' in results[2]['details']
+
+    assert client.get(f"/api/tasks/{results[0]['id']}").get_json()[
+        'name'] == "Bulk one"
+    created = client.get(f"/api/tasks/{results[3]['id']}").get_json()
+    assert created['name'] == "Bulk two"
+    assert created['priority'] == "High"
+    assert created['status'] == "Pending"
+
+
+def test_bulk_update_tasks(client):
+    _seed_tasks(3)
+    data = [
+        {"id": 1, "status": "Completed"},
+        {"id": 2, "name": "Task 002"},
+        {"id": 99, "status": "Completed"},
+        {"status": "Completed"},
+        {"id": 3, "priority": "Urgent"}
+    ]
+    response = client.patch('/api/tasks/bulk', data=json.dumps(data),
+                            content_type='application/json')
+    assert response.status_code == 207
+    statuses = [result['status']
+                for result in response.get_json()['results']]
+    assert statuses == [200, 406, 404, 400, 400]
+    assert client.get('/api/tasks/1').get_json()['status'] == "Completed"
+
+
+def test_bulk_delete_tasks(client):
+    _seed_tasks(3)
+    response = client.delete('/api/tasks/bulk', data=json.dumps([1, 3]),
+                             content_type='application/json')
+    assert response.status_code == 200
+    assert response.get_json()['succeeded'] == 2
+    remaining = client.get('/api/tasks').get_json()
+    assert [task['id'] for task in remaining] == [2]
+
+
+def test_bulk_requires_array(client):
+    response = client.post('/api/tasks/bulk', data=json.dumps({"a": 1}),
+                           content_type='application/json')
+    assert response.status_code == 400
+
+
+def _schema_objects():
+    return set(db.session.execute(db.text(
+        "SELECT type, name FROM sqlite_master "
+        "WHERE type IN ('index', 'trigger')")).all())
+
+
+@pytest.mark.parametrize("file_name,fast", [("tasks.ndjson", False),
+                                            ("tasks.csv", True)])
+def test_tasks_cli_export_import_round_trip(client, tmp_path, file_name,
+                                            fast):
+    _seed_tasks(6)
+    db.session.add(Task(name="Old and undated", priority="Low",
+                        status="Completed",
+                        created_on=datetime(2020, 1, 2).date()))
+    db.session.commit()
+    expected = client.get('/api/tasks').get_json()
+    stats = client.get('/api/tasks/stats').get_json()
+    schema_objects = _schema_objects()
+    runner = client.application.test_cli_runner()
+    path = str(tmp_path / file_name)
+
+    result = runner.invoke(args=["tasks", "export", path])
+    assert result.exit_code == 0, result.output
+    db.session.execute(db.delete(Task))
+    db.session.commit()
+    args = ["tasks", "import", path, "--batch-size", "3"]
+    result = runner.invoke(args=args + (["--fast"] if fast else []))
+    assert result.exit_code == 0, result.output
+
+    assert client.get('/api/tasks').get_json() == expected
+    assert client.get('/api/tasks/stats').get_json() == stats
+    assert [task["name"] for task in
+            client.get('/api/tasks?search=undated').get_json()] == \
+        ["Old and undated"]
+    # --fast drops indexes and triggers, all of them must be back
+    assert _schema_objects() == schema_objects
+
+
+def test_tasks_cli_import_reports_rejected_rows(client):
+    client.post('/api/tasks', json={"name": "Existing"})
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(args=["tasks", "import", "-"], input="\n".join([
+        '{"name": "New one", "due_on": "2001-02-03"}',
+        '{"name": "x", "priority": "Urgent"}',
+        '{not json',
+        '{"name": "Existing"}',
+    ]))
+    assert result.exit_code == 1
+    assert 'line 2: {"name": ["Length must be between 2 and 50."], ' \
+        '"priority": ["Must be one of: High, Medium, Low."]}' in result.output
+    assert "line 3: " in result.output
+    assert "Imported 1 tasks, rejected 2 invalid, skipped 1" in result.output
+    assert client.get('/api/tasks/stats').get_json()["total"] == 2
+
+
+def test_archive_moves_old_completed_tasks(client):
+    old = datetime(2020, 1, 1).date()
+    db.session.add_all([
+        Task(name="Open and old", status="Pending", priority="High",
+             created_on=old, updated_on=old),
+        Task(name="Done and recent", status="Pending", priority="Low",
+             created_on=old, updated_on=old),
+        Task(name="Done and old", status="Completed", priority="Medium",
+             created_on=old, updated_on=old),
+        Task(name="Also done and old", status="Completed", priority="High",
+             created_on=old, updated_on=old),
+    ])
+    db.session.commit()
+    # Created long ago, completed today
+    response = client.patch('/api/tasks/2', json={"status": "Completed"})
+    assert response.status_code == 200
+    everything = client.get('/api/tasks?sort=priority').get_json()
+
+    result = client.application.test_cli_runner().invoke(
+        args=["tasks", "archive", "--older-than", "30", "--batch-size", "1"])
+    assert result.exit_code == 0, result.output
+    assert "Archived 2 tasks" in result.output
+
+    hot = client.get('/api/tasks').get_json()
+    assert [task["name"] for task in hot] == ["Open and old",
+                                             "Done and recent"]
+    assert client.get('/api/tasks/stats').get_json()["total"] == 2
+    assert client.get('/api/tasks?sort=priority&include_archived=true'
+                      ).get_json() == everything
+    # Pages and filters run over both tables
+    seen = []
+    url = '/api/tasks?include_archived=1&sort=priority&limit=3'
+    while url:
+        response = client.get(url)
+        seen.extend(response.get_json())
+        cursor = response.headers.get("X-Next-Cursor")
+        url = cursor and f'/api/tasks?include_archived=1&sort=priority' \
+                         f'&limit=3&cursor={cursor}'
+    assert seen == everything
+    response = client.get('/api/tasks?include_archived=true&search=old'
+                          '&status=Completed&fields=name')
+    assert response.get_json() == [{"name": "Done and old"},
+                                   {"name": "Also done and old"}]
+
+    # The archived ids include the highest one, new tasks must not reuse it
+    created = client.post('/api/tasks', json={"name": "Brand new"})
+    assert created.get_json()["id"] == 5
+
+
+def _log_record(message):
+    record = logging.LogRecord("test", logging.INFO, __file__, 0,
+                               message, None, None)
+    record.entry = {"event": message}
+    return record
+
+
+def test_batching_log_handler_writes_json_lines(tmp_path):
+    log_file = tmp_path / "logs.json"
+    handler = BatchingFileHandler(str(log_file), batch_size=2)
+    handler.setFormatter(JsonFormatter())
+    for i in range(5):
+        handler.emit(_log_record(f"event {i}"))
+    handler.flush()
+    handler.close()
+
+    lines = log_file.read_text().splitlines()
+    assert [json.loads(line)["event"] for line in lines] == [
+        f"event {i}" for i in range(5)]
+    assert handler.stats()["written"] == 5
+
+
+def test_structured_log_message_is_the_event_name():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    routes.api_logger.logger.addHandler(handler)
+    try:
+        routes.api_logger.info("task_created", task_id=7)
+    finally:
+        routes.api_logger.logger.removeHandler(handler)
+
+    record, = records
+    assert logging.Formatter("%(levelname)s %(message)s").format(
+        record) == "INFO task_created"
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["event"] == "task_created"
+    assert entry["task_id"] == 7
+
+
+def test_batching_log_handler_drops_when_full(tmp_path):
+    release = threading.Event()
+
+    class SlowFormatter(JsonFormatter):
+        def format(self, record):
+            release.wait(5)
+            return super().format(record)
+
+    handler = BatchingFileHandler(str(tmp_path / "logs.json"),
+                                  max_queue_size=2, batch_size=1)
+    handler.setFormatter(SlowFormatter())
+    handler.emit(_log_record("picked up by writer"))
+    while handler.queue.qsize():
+        time.sleep(0.01)
+    for i in range(3):
+        handler.emit(_log_record(f"queued {i}"))
+    release.set()
+    handler.close()
+
+    stats = handler.stats()
+    assert stats["dropped"] == 1
+    assert stats["written"] == 3
+
+
+def test_streamed_response_size_logged_after_send(client, monkeypatch):
+    _seed_tasks(3)
+    completed = []
+
+    def record(event, **kwargs):
+        if event == "request_completed":
+            completed.append(kwargs)
+
+    monkeypatch.setattr(routes.api_logger, "info", record)
+    response = client.get('/api/tasks?stream=true')
+    body = response.get_data()
+    response.close()
+
+    assert len(completed) == 1
+    assert completed[0]["response_size"] == len(body)
+    assert completed[0]["request_id"]
+
+
+def test_create_app_production_applies_pragmas(tmp_path, monkeypatch):
+    db_uri = f"sqlite:///{tmp_path / 'prod.db'}"
+    monkeypatch.setenv("FLASK_SQLALCHEMY_DATABASE_URI", db_uri)
+    monkeypatch.setenv("FLASK_LOG_QUEUE_ENABLED", "false")
+    monkeypatch.setenv("FLASK_GENERATION_COUNTER_FILE",
+                       str(tmp_path / "generation"))
+    app = create_app('production')
+
+    with app.app_context():
+        db.create_all()
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql(
+                "PRAGMA journal_mode").scalar() == "wal"
+            assert connection.exec_driver_sql(
+                "PRAGMA busy_timeout").scalar() == 5000
+        with app.extensions["read_engine"].connect() as connection:
+            assert connection.exec_driver_sql(
+                "PRAGMA query_only").scalar() == 1
+
+    with app.test_client() as client:
+        data = {"name": "Production task"}
+        response = client.post('/api/tasks', data=json.dumps(data),
+                               content_type='application/json')
+        assert response.status_code == 201
+        response = client.get('/api/tasks')
+        assert response.get_json()[0]['name'] == "Production task"
+
+
+# Equality filters GET /api/tasks is indexed for, with every sort
+INDEXED_FILTERS = {"status": "Pending", "priority": "High",
+                   "due_on": "2030-01-01"}
+INDEXED_QUERY_SHAPES = [
+    "&".join([*(f"{key}={INDEXED_FILTERS[key]}" for key in keys),
+              *([f"sort={sort}"] if sort else [])])
+    for count in range(len(INDEXED_FILTERS) + 1)
+    for keys in itertools.combinations(INDEXED_FILTERS, count)
+    for sort in ["", *task_queries.SORT_FIELDS]
+]
+
+
+@pytest.mark.parametrize("query_string", INDEXED_QUERY_SHAPES)
+def test_query_plan_uses_index(client, query_string):
+    query, _ = build_tasks_query(MultiDict(parse_qsl(query_string)))
+    plan = explain_query_plan(db.session, query)
+    assert not any("TEMP B-TREE" in line for line in plan), plan
+    # In id order the table itself is read in rowid order
+    if query_string not in ("", "sort=id"):
+        assert any("USING INDEX" in line for line in plan), plan
+
+
+# Range and multi-value filters, served by a range scan or index probes
+RANGE_QUERY_PLANS = {
+    "due_after=2030-01-01&sort=due_on":
+        "SEARCH task USING INDEX ix_task_due_on (due_on>?)",
+    "due_after=2030-01-01&due_before=2030-01-07":
+        "SEARCH task USING INDEX ix_task_due_on (due_on>? AND due_on<?)",
+    "status=Pending&due_after=2030-01-01&due_before=2030-01-07&sort=due_on":
+        "SEARCH task USING INDEX ix_task_status_due_on "
+        "(status=? AND due_on>? AND due_on<?)",
+    "priority=High,Medium&due_after=2030-01-01":
+        "SEARCH task USING INDEX ix_task_priority_due_on "
+        "(priority=? AND due_on>?)",
+    "created_after=2030-01-01&created_before=2030-01-31":
+        "SEARCH task USING INDEX ix_task_created_on "
+        "(created_on>? AND created_on<?)",
+}
+
+
+@pytest.mark.parametrize("query_string", RANGE_QUERY_PLANS)
+def test_range_and_multi_value_filters_use_index(client, query_string):
+    query, _ = build_tasks_query(MultiDict(parse_qsl(query_string)))
+    plan = explain_query_plan(db.session, query)
+    assert plan[0] == RANGE_QUERY_PLANS[query_string], plan
+
+
+# Lists without another filter walk the sort order, no temp B-tree
+VALUE_LIST_QUERY_PLANS = {
+    "status=Pending,In Progress": "SCAN task",
+    "status=Pending,In Progress&sort=name":
+        "SCAN task USING INDEX ix_task_name",
+    "priority=High,Medium&sort=priority":
+        "SCAN task USING INDEX ix_task_priority_rank",
+    "priority=High,Medium&status=Pending,Completed&sort=due_on":
+        "SCAN task USING INDEX ix_task_due_on",
+}
+
+
+@pytest.mark.parametrize("query_string", VALUE_LIST_QUERY_PLANS)
+def test_value_lists_keep_the_sort_order(client, query_string):
+    query, _ = build_tasks_query(MultiDict(parse_qsl(query_string)))
+    plan = explain_query_plan(db.session, query)
+    assert plan == [VALUE_LIST_QUERY_PLANS[query_string]]
+
+
+def test_range_and_multi_value_filters(client):
+    _seed_tasks(8)
+    today = datetime.now().date()
+
+    def names(query_string):
+        response = client.get(f'/api/tasks?{query_string}')
+        if response.status_code == 404:
+            return []
+        return [task['name'] for task in response.get_json()]
+
+    # Bounds are inclusive, due dates cycle through today + 0..3 days
+    window = (f"due_after={today + timedelta(days=1)}"
+              f"&due_before={today + timedelta(days=2)}")
+    assert names(window) == ["Task 001", "Task 002", "Task 005", "Task 006"]
+    assert names(f"{window}&priority=Low,High&sort=priority") == \
+        ["Task 006", "Task 002", "Task 005"]
+    assert names(f"created_after={today}&created_before={today}") == \
+        [f"Task {i:03d}" for i in range(8)]
+    assert names(f"created_before={today - timedelta(days=1)}") == []
+
+    response = client.get('/api/tasks?due_after=next-week')
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid date format"
+
+
+def test_keyset_page_query_is_index_range_scan(client):
+    _seed_tasks(4)
+    cursor = client.get('/api/tasks?status=Pending&sort=due_on&limit=2'
+                        ).headers['X-Next-Cursor']
+    args = MultiDict({"status": "Pending", "sort": "due_on",
+                      "cursor": cursor})
+    query, _ = build_tasks_query(args)
+    plan = explain_query_plan(db.session, query)
+    assert plan == ["SEARCH task USING INDEX ix_task_status_due_on "
+                    "(status=? AND due_on>?)"]
+
+
+def test_search_uses_full_text_index(client):
+    for name in ["Write the quarterly report", "Report bug upstream",
+                 "Water the plants"]:
+        db.session.add(task_schema.load({"name": name}))
+    db.session.commit()
+
+    response = client.get('/api/tasks?search=REPORT')
+    assert response.status_code == 200
+    names = {task['name'] for task in response.get_json()}
+    assert names == {"Write the quarterly report", "Report bug upstream"}
+
+    query, _ = build_tasks_query(MultiDict({"search": "report"}),
+                                 search_index=True)
+    plan = " ".join(explain_query_plan(db.session, query))
+    assert "VIRTUAL TABLE INDEX" in plan
+
+
+def test_search_index_follows_updates_and_deletes(client):
+    _seed_tasks(2)
+    client.put('/api/tasks/1', data=json.dumps({"name": "Renamed task"}),
+               content_type='application/json')
+    client.delete('/api/tasks/2')
+    assert client.get('/api/tasks?search=Task 00').status_code == 404
+    response = client.get('/api/tasks?search=renamed')
+    assert [task['id'] for task in response.get_json()] == [1]
+
+
+def test_short_search_falls_back_to_like(client):
+    _seed_tasks(2)
+    response = client.get('/api/tasks?search=01')
+    assert [task['name'] for task in response.get_json()] == ["Task 001"]
+
+
+def test_listing_statement_is_shared_across_values(client):
+    _seed_tasks(4)
+    first, first_params, _ = prepare_tasks_query(
+        MultiDict({"status": "Pending", "sort": "name"}), limit=2)
+    second, second_params, _ = prepare_tasks_query(
+        MultiDict({"status": "Completed", "sort": "name"}), limit=5)
+    assert first is second
+    assert first_params != second_params
+
+    other, _, _ = prepare_tasks_query(
+        MultiDict({"priority": "High", "sort": "name"}), limit=2)
+    assert other is not first
+
+    page = client.get('/api/tasks?sort=name&limit=2')
+    cursor = page.headers["X-Next-Cursor"]
+    rest = client.get(f'/api/tasks?sort=name&limit=2&cursor={cursor}')
+    assert [task["name"] for task in page.get_json() + rest.get_json()] == \
+        ["Task 000", "Task 001", "Task 002", "Task 003"]
+
+
+def test_listing_statements_are_bounded(client):
+    dates = itertools.product(["", "2030-01-01"],
+                              repeat=len(task_queries.RANGE_FILTERS))
+    for bounds, status, sort, limit in itertools.product(
+            dates, ["", "Pending", "Pending,Completed"],
+            task_queries.SORT_FIELDS, [None, 10]):
+        args = MultiDict({"status": status, "sort": sort,
+                          **dict(zip(task_queries.RANGE_FILTERS, bounds))})
+        prepare_tasks_query(args, limit=limit)
+
+    cached = task_queries._build_tasks_statement.cache_info().currsize
+    assert cached == task_queries.MAX_CACHED_STATEMENTS
+
+
+@pytest.fixture()
+def cached_client():
+    test_app = create_app(config_type='testing')
+    test_app.extensions["response_cache"] = ResponseCache(
+        test_app.extensions["task_generation"], max_entries=2)
+
+    with test_app.test_client() as client:
+        with test_app.app_context():
+            db.create_all()
+
+            yield client
+
+            db.session.remove()
+            db.drop_all()
+
+
+def test_response_cache_hits_and_invalidates_on_write(cached_client):
+    _seed_tasks(2)
+    first = cached_client.get('/api/tasks?sort=name')
+    second = cached_client.get('/api/tasks?sort=name')
+    assert second.get_data() == first.get_data()
+
+    cached_client.post('/api/tasks', data=json.dumps({"name": "Fresh"}),
+                       content_type='application/json')
+    third = cached_client.get('/api/tasks?sort=name')
+    assert len(third.get_json()) == 3
+
+    stats = cached_client.get('/api/cache/stats').get_json()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+
+def test_response_cache_evicts_least_recently_used(cached_client):
+    _seed_tasks(2)
+    for query_string in ["sort=name", "sort=id", "sort=due_on"]:
+        cached_client.get(f'/api/tasks?{query_string}')
+    stats = cached_client.get('/api/cache/stats').get_json()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+
+
+def test_response_cache_evicts_to_stay_under_max_bytes(cached_client):
+    cache = cached_client.application.extensions["response_cache"]
+    _seed_tasks(2)
+    size = len(cached_client.get('/api/tasks?sort=name').get_data())
+    cache.max_bytes = size + 1
+    cached_client.get('/api/tasks?sort=id')
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == size
+
+    cache.max_bytes = size - 1
+    cached_client.get('/api/tasks?sort=due_on')
+    assert cache.stats()["entries"] == 1
+
+
+def test_cache_key_ignores_argument_order_and_empty_values():
+    assert cache_key(MultiDict([("sort", "name"), ("status", "Pending")])) \
+        == cache_key(MultiDict([("status", "Pending"), ("priority", ""),
+                                ("sort", "name")]))
+
+
+def test_cache_key_ignores_arguments_the_listing_does_not_read():
+    assert cache_key(MultiDict([("sort", "name"), ("bust", "1")])) == \
+        cache_key(MultiDict([("sort", "name"), ("bust", "2")]))
+
+
+def test_file_generation_counter_is_shared(tmp_path):
+    path = str(tmp_path / "generation")
+    worker_a = FileGenerationCounter(path)
+    worker_b = FileGenerationCounter(path)
+    before = worker_b.current()
+    worker_a.bump()
+    assert worker_b.current() > before
+
+
+def test_task_etag_and_conditional_get(client):
+    _seed_tasks(1)
+    response = client.get('/api/tasks/1')
+    etag = response.headers['ETag']
+    assert client.get('/api/tasks/1',
+                      headers={'If-None-Match': etag}).status_code == 304
+
+    updated = client.put('/api/tasks/1', data=json.dumps({"name": "Moved"}),
+                         content_type='application/json')
+    assert updated.headers['ETag'] != etag
+    response = client.get('/api/tasks/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] == updated.headers['ETag']
+
+
+def test_collection_etag_changes_on_write(client):
+    _seed_tasks(2)
+    etag = client.get('/api/tasks?sort=name').headers['ETag']
+    assert client.get('/api/tasks?sort=name').headers['ETag'] == etag
+    assert client.get('/api/tasks?sort=due_on').headers['ETag'] != etag
+    response = client.get('/api/tasks?sort=name',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    client.delete('/api/tasks/1')
+    response = client.get('/api/tasks?sort=name',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 1
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_row_serializer_matches_marshmallow(client, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(task_serializer_module, "orjson", None)
+    _seed_tasks(3)
+    db.session.add(task_schema.load({"name": "Café über \"quotes\""}))
+    db.session.commit()
+
+    tasks = db.session.execute(select(Task).order_by(Task.id)).scalars().all()
+    rows = db.session.execute(
+        select(*task_serializer.columns).order_by(Task.id)).all()
+    assert task_serializer.dump(rows) == tasks_schema.dump(tasks)
+    assert to_json_bytes(task_serializer.dump(rows)) == \
+        jsonify(tasks_schema.dump(tasks)).get_data()
+    assert client.get('/api/tasks').get_data() == \
+        jsonify(tasks_schema.dump(tasks)).get_data()
+
+
+LOAD_PAYLOADS = [
+    {"name": "Plain"},
+    {"name": "Full", "priority": "High", "status": "Completed",
+     "due_on": "2099-02-03", "id": 4},
+    {"status": "Pending"},
+    {},
+    {"name": "x", "priority": "Urgent", "due_on": "2000-01-01",
+     "created_on": "2000-01-01", "id": "a", "unknown": 1},
+    {"name": None, "priority": None, "status": None, "due_on": None},
+    {"name": b"bytes", "id": "5", "due_on": "2099-1-1"},
+    {"name": "Odd types", "id": True, "priority": ["High"]},
+    {"name": "Float id", "id": 5.0, "due_on": "2099-02-03T00:00:00"},
+    [],
+    "text",
+    None,
+]
+
+
+@pytest.mark.parametrize("partial", [None, True])
+def test_fast_schema_load_matches_marshmallow(client, partial):
+    fast = TaskSchema(load_instance=False)
+    slow = TaskSchema(load_instance=False, fast_load=False)
+
+    def load(schema, data):
+        try:
+            return schema.load(data, partial=partial)
+        except ValidationError as err:
+            return err.messages, err.valid_data
+
+    for payload in LOAD_PAYLOADS:
+        assert load(fast, payload) == load(slow, payload), payload
+    assert load(TaskSchema(many=True, load_instance=False),
+                LOAD_PAYLOADS[:2]) == \
+        load(TaskSchema(many=True, load_instance=False, fast_load=False),
+             LOAD_PAYLOADS[:2])
+
+
+def test_date_validation_rolls_over_at_midnight(client, monkeypatch):
+    # One process across midnight, nothing may keep the start-up date
+    day = datetime(2099, 3, 1).date()
+    monkeypatch.setattr(task_models, "today", lambda: day)
+    response = client.post('/api/tasks', json={"name": "Due today",
+                                               "due_on": "2099-03-01"})
+    assert response.status_code == 201
+    assert response.get_json()["created_on"] == "2099-03-01"
+
+    day = datetime(2099, 3, 2).date()
+    response = client.post('/api/tasks', json={"name": "Due yesterday",
+                                               "due_on": "2099-03-01"})
+    assert response.status_code == 400
+    assert response.get_json()["details"] == {
+        "due_on": ["Must be greater than or equal to 2099-03-02."]}
+    response = client.post('/api/tasks', json={"name": "Created yesterday",
+                                               "created_on": "2099-03-01"})
+    assert response.get_json()["details"] == {
+        "created_on": ["Must be equal to 2099-03-02."]}
+    response = client.post('/api/tasks', json={"name": "Next day"})
+    assert response.get_json()["created_on"] == "2099-03-02"
+
+
+def test_metrics_endpoint_reports_actions_and_phases(client):
+    _seed_tasks(3)
+    client.get('/api/tasks')
+    client.post('/api/tasks', json={"name": "Metrics task"})
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    body = response.get_data(as_text=True)
+    assert 'task_api_request_duration_seconds_count{action="get_tasks"} 1' \
+        in body
+    assert 'task_api_requests_total{action="create_task",status="201"} 1' \
+        in body
+    for phase in ("db_query", "hydration", "serialization", "logging"):
+        assert f'action="get_tasks",phase="{phase}"' in body
+    assert 'action="create_task",phase="validation"' in body
+    assert 'task_api_db_queries_per_request_bucket{action="get_tasks",' \
+        'le="1"} 1' in body
+
+
+def test_metrics_endpoint_reports_log_queue_counters(client, monkeypatch,
+                                                    tmp_path):
+    body = client.get('/metrics').get_data(as_text=True)
+    assert "task_api_log_records_dropped_total" not in body
+
+    handler = BatchingFileHandler(str(tmp_path / "logs.json"))
+    monkeypatch.setattr(routes.api_logger, "handler", handler)
+    handler.dropped, handler.backpressure = 3, 5
+    body = client.get('/metrics').get_data(as_text=True)
+    handler.close()
+    assert "# TYPE task_api_log_records_dropped_total counter" in body
+    assert "\ntask_api_log_records_dropped_total 3\n" in body
+    assert "\ntask_api_log_backpressure_total 5\n" in body
+    assert "\ntask_api_log_queue_records 0\n" in body
+
+
+def test_failed_statements_leave_no_query_timing_behind(client):
+    for _ in range(3):
+        client.post('/api/tasks', json={"name": "Duplicate"})
+
+    # The failed INSERTs of the duplicates timed nothing on the connection
+    with db.engine.connect() as connection:
+        assert not connection.info.get("query_start_time")
+    response = client.get('/metrics')
+    assert 'task_api_requests_total{action="create_task",status="406"} 2' \
+        in response.get_data(as_text=True)
+
+
+def test_profiler_dumps_stats_for_flagged_request(client, tmp_path):
+    client.application.config.update(PROFILING_ENABLED=True,
+                                      PROFILE_DIR=str(tmp_path))
+    _seed_tasks(2)
+
+    assert 'X-Profile-Id' not in client.get('/api/tasks').headers
+    response = client.get('/api/tasks', headers={"X-Profile": "1"})
+    profile_id = response.headers['X-Profile-Id']
+
+    stats = pstats.Stats(str(tmp_path / f"{profile_id}.prof"))
+    assert stats.total_calls > 0
+
+
+async def _asgi_request(asgi_app, method, path, body=None, headers=()):
+    '''Drive an ASGI app through one request, returns (status, headers, body)'''
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path,
+             "query_string": query.encode(),
+             "headers": [(name.lower().encode(), value.encode())
+                         for name, value in headers]}
+    messages = [{"type": "http.request",
+                 "body": json.dumps(body).encode() if body is not None
+                 else b""}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    response_headers = {name.decode(): value.decode()
+                        for name, value in sent[0]["headers"]}
+    return sent[0]["status"], response_headers, sent[1]["body"]
+
+
+def test_asgi_app_serves_same_contract(tmp_path, monkeypatch):
+    pytest.importorskip("aiosqlite")
+    from task_asgi import TaskAsgiApp
+
+    monkeypatch.setenv("FLASK_SQLALCHEMY_DATABASE_URI",
+                       f"sqlite:///{tmp_path / 'asgi.db'}")
+    monkeypatch.setenv("FLASK_LOG_QUEUE_ENABLED", "false")
+    monkeypatch.setenv("FLASK_RESPONSE_CACHE_ENABLED", "false")
+    monkeypatch.setenv("FLASK_GENERATION_COUNTER_FILE",
+                       str(tmp_path / "generation"))
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        _seed_tasks(5)
+    client = app.test_client()
+
+    async def scenario(asgi_app):
+        for path in ('/api/tasks?sort=priority', '/api/tasks?limit=2',
+                     '/api/tasks?search=ask 00', '/api/tasks/2',
+                     '/api/tasks?sort=bogus', '/api/tasks/99'):
+            expected = client.get(path)
+            status, headers, body = await _asgi_request(asgi_app, "GET",
+                                                        path)
+            assert status == expected.status_code
+            assert body == expected.get_data()
+            assert headers.get("etag") == expected.headers.get("ETag")
+            assert headers.get("x-next-cursor") == \
+                expected.headers.get("X-Next-Cursor")
+
+        etag = client.get('/api/tasks/2').headers["ETag"]
+        status, _, body = await _asgi_request(
+            asgi_app, "GET", '/api/tasks/2', headers=[("If-None-Match", etag)])
+        assert (status, body) == (304, b"")
+
+        status, _, body = await _asgi_request(asgi_app, "POST", '/api/tasks',
+                                              {"name": "Async task"})
+        assert status == 201
+        created = json.loads(body)
+        assert client.get(f'/api/tasks/{created["id"]}').get_json() == created
+        status, _, _ = await _asgi_request(asgi_app, "POST", '/api/tasks',
+                                           {"name": "Async task"})
+        assert status == 406
+
+        status, _, body = await _asgi_request(
+            asgi_app, "PUT", f'/api/tasks/{created["id"]}',
+            {"name": "Async task", "status": "Completed"})
+        assert status == 200
+        assert json.loads(body)["status"] == "Completed"
+        expected = client.put('/api/tasks/1', json={"priority": "Urgent"})
+        status, _, body = await _asgi_request(asgi_app, "PUT", '/api/tasks/1',
+                                              {"priority": "Urgent"})
+        assert (status, body) == (400, expected.get_data())
+
+        status, _, _ = await _asgi_request(asgi_app, "DELETE",
+                                           f'/api/tasks/{created["id"]}')
+        assert status == 200
+        assert client.get(f'/api/tasks/{created["id"]}').status_code == 404
+
+    async def run():
+        asgi_app = TaskAsgiApp(app)
+        try:
+            await scenario(asgi_app)
+        finally:
+            await asgi_app.dispose()
+
+    asyncio.run(run())
+
+
+def _sharded_app(tmp_path, monkeypatch, count):
+    monkeypatch.setenv("FLASK_SQLALCHEMY_DATABASE_URI",
+                       f"sqlite:///{tmp_path / 'task.db'}")
+    monkeypatch.setenv("FLASK_TASK_SHARDS", json.dumps(
+        [f"sqlite:///{tmp_path / f'shard{index}.db'}"
+         for index in range(count)]))
+    monkeypatch.setenv("FLASK_LOG_QUEUE_ENABLED", "false")
+    monkeypatch.setenv("FLASK_RESPONSE_CACHE_ENABLED", "false")
+    monkeypatch.setenv("FLASK_GENERATION_COUNTER_FILE",
+                       str(tmp_path / "generation"))
+    app = create_app('production')
+    result = app.test_cli_runner().invoke(args=["tasks", "create-shards"])
+    assert result.exit_code == 0, result.output
+    return app
+
+
+def test_task_commands_refuse_to_run_on_shards(tmp_path, monkeypatch):
+    app = _sharded_app(tmp_path, monkeypatch, 2)
+    runner = app.test_cli_runner()
+    for args in (["import", "-"], ["export"], ["archive"],
+                 ["prune-changes"]):
+        result = runner.invoke(args=["tasks", *args], input="")
+        assert result.exit_code == 2
+        assert "Not available with TASK_SHARDS" in result.output
+
+
+def test_asgi_app_refuses_to_run_on_shards(tmp_path, monkeypatch):
+    from task_asgi import TaskAsgiApp
+    app = _sharded_app(tmp_path, monkeypatch, 2)
+    with pytest.raises(RuntimeError, match="TASK_SHARDS"):
+        TaskAsgiApp(app)
+
+
+def test_sharded_listing_matches_single_database(tmp_path, monkeypatch):
+    app = _sharded_app(tmp_path, monkeypatch, 3)
+    client = app.test_client()
+    shards = app.extensions["task_shards"]
+    today = datetime.now().date()
+    for i in range(30):
+        task = {"name": f"{'ABCabc'[i % 6]} task {i:02d}",
+                "priority": ["Low", "Medium", "High"][i % 3],
+                "status": ["Pending", "In Progress", "Completed"][i % 4 % 3]}
+        if i % 5:
+            task["due_on"] = (today + timedelta(days=i % 7)).isoformat()
+        response = client.post('/api/tasks', json=task)
+        assert response.status_code == 201
+        created = response.get_json()
+        assert shards.shard_for_id(created["id"]) == \
+            shards.shard_for_name(task["name"])
+    tasks = client.get('/api/tasks').get_json()
+    assert len({task["id"] for task in tasks}) == 30
+    assert len({shards.shard_for_id(task["id"]) for task in tasks}) == 3
+
+    # The same rows in one database must list in the same order
+    single = create_app('testing')
+    with single.app_context():
+        db.create_all()
+        db.session.execute(insert(Task), [
+            {**task, "due_on": task["due_on"] and date.fromisoformat(
+                task["due_on"]),
+             "created_on": date.fromisoformat(task["created_on"])}
+            for task in tasks])
+        db.session.commit()
+        single_client = single.test_client()
+        for path in ['/api/tasks?sort=priority', '/api/tasks?sort=status',
+                     '/api/tasks?sort=due_on&fields=id,name',
+                     '/api/tasks?sort=name&status=Pending,Completed',
+                     '/api/tasks?search=task 1&sort=created_on',
+                     '/api/tasks?sort=priority&limit=7',
+                     '/api/tasks?sort=due_on&limit=4&due_after='
+                     f'{today.isoformat()}']:
+            while path:
+                expected = single_client.get(path)
+                response = client.get(path)
+                assert response.status_code == expected.status_code
+                assert response.get_data() == expected.get_data()
+                cursor = expected.headers.get("X-Next-Cursor")
+                assert response.headers.get("X-Next-Cursor") == cursor
+                path = cursor and f"{path.split('&cursor=')[0]}" \
+                    f"&cursor={cursor}"
+        db.drop_all()
+
+
+def test_sharded_writes_route_by_id(tmp_path, monkeypatch):
+    app = _sharded_app(tmp_path, monkeypatch, 2)
+    client = app.test_client()
+    shards = app.extensions["task_shards"]
+    names = ["First", "Second", "Third", "Fourth"]
+    ids = {name: client.post('/api/tasks', json={"name": name})
+           .get_json()["id"] for name in names}
+    assert client.post('/api/tasks', json={"name": "Third"}).status_code \
+        == 406
+
+    # A rename is checked against the names in the other shard too
+    first = ids["First"]
+    other = next(name for name in names
+                 if shards.shard_for_id(ids[name]) !=
+                 shards.shard_for_id(first))
+    assert client.put(f'/api/tasks/{first}',
+                      json={"name": other}).status_code == 406
+    response = client.put(f'/api/tasks/{first}',
+                          json={"name": "Renamed", "status": "Completed"})
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "Completed"
+    assert client.get(f'/api/tasks/{first}').get_json()["name"] == "Renamed"
+    etag = response.headers["ETag"]
+    assert client.get(f'/api/tasks/{first}',
+                      headers={"If-None-Match": etag}).status_code == 304
+
+    assert client.delete(f'/api/tasks/{first}').status_code == 200
+    assert client.get(f'/api/tasks/{first}').status_code == 404
+    assert client.put(f'/api/tasks/{first}',
+                      json={"name": "Gone"}).status_code == 404
+    assert client.delete(f'/api/tasks/{first}').status_code == 404
+    # Ids of deleted tasks are not handed out again
+    response = client.post('/api/tasks', json={"name": "First"})
+    assert response.get_json()["id"] not in ids.values()
+
+    response = client.get('/api/tasks/stats')
+    assert response.status_code == 501
+    assert client.post('/api/tasks/bulk', json=[{"name": "Bulk"}]) \
+        .status_code == 501
+
+
+def test_write_batching_commits_concurrent_writes_together(tmp_path,
+                                                          monkeypatch):
+    monkeypatch.setenv("FLASK_SQLALCHEMY_DATABASE_URI",
+                       f"sqlite:///{tmp_path / 'task.db'}")
+    monkeypatch.setenv("FLASK_WRITE_BATCHING_ENABLED", "true")
+    monkeypatch.setenv("FLASK_WRITE_BATCH_DELAY", "0.05")
+    monkeypatch.setenv("FLASK_LOG_QUEUE_ENABLED", "false")
+    monkeypatch.setenv("FLASK_RESPONSE_CACHE_ENABLED", "false")
+    monkeypatch.setenv("FLASK_GENERATION_COUNTER_FILE",
+                       str(tmp_path / "generation"))
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+    writer = app.extensions["task_writer"]
+
+    names = [f"Burst {i}" for i in range(20)] + ["Burst 3", "Burst 7"]
+    barrier = threading.Barrier(len(names))
+    responses = [None] * len(names)
+
+    def create(index):
+        client = app.test_client()
+        barrier.wait()
+        responses[index] = client.post('/api/tasks',
+                                       json={"name": names[index]})
+
+    threads = [threading.Thread(target=create, args=(index,))
+               for index in range(len(names))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(response.status_code for response in responses) == \
+        [201] * 20 + [406] * 2
+    created = [response.get_json() for response in responses
+               if response.status_code == 201]
+    assert len({task["id"] for task in created}) == 20
+    assert writer.stats()["written"] == 20
+    assert writer.stats()["batches"] < 22
+
+    client = app.test_client()
+    first, second = created[0]["id"], created[1]["id"]
+    response = client.put(f'/api/tasks/{first}',
+                          json={"name": "Renamed", "status": "Completed"})
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "Completed"
+    assert response.headers["ETag"] == f'"{first}-2"'
+    assert client.get(f'/api/tasks/{first}').get_json()["name"] == "Renamed"
+    assert client.put(f'/api/tasks/{second}',
+                      json={"name": "Renamed"}).status_code == 406
+    assert client.put('/api/tasks/999', json={"name": "Gone"}) \
+        .status_code == 404
+    writer.close()
+
+
+def test_write_batching_never_leaves_a_request_waiting(tmp_path):
+    from task_writer import BatchWriter, TaskWriterError
+    engine = create_engine(f"sqlite:///{tmp_path / 'task.db'}")
+    db.metadata.create_all(engine)
+    writer = BatchWriter(engine, max_delay=0, timeout=0.2)
+    started, release = threading.Event(), threading.Event()
+    ran = []
+
+    def blocking(connection):
+        started.set()
+        release.wait(5)
+
+    writer.submit(blocking)
+    started.wait(5)
+    # Not picked up in time, the request gives up and the write is skipped
+    with pytest.raises(TaskWriterError, match="timed out"):
+        writer.insert({"name": "Late task"}, [Task.id])
+
+    closing = threading.Thread(target=writer.close)
+    closing.start()
+    while writer.queue.qsize() < 2:
+        time.sleep(0.01)
+    # Queued behind the stop, failed instead of waiting forever
+    after_stop = writer.submit(ran.append, "after stop")
+    release.set()
+    closing.join()
+    with pytest.raises(TaskWriterError, match="closed"):
+        after_stop.result(timeout=1)
+    assert ran == []
+    assert writer.stats()["written"] == 1
+    with engine.connect() as connection:
+        assert connection.scalar(select(func.count(Task.id))) == 0
+    with pytest.raises(TaskWriterError, match="closed"):
+        writer.submit(ran.append, "closed")
+    engine.dispose()
+
+
+def test_task_stats_counts_and_due_buckets(client):
+    today = datetime.now().date()
+    week_end = today + timedelta(days=6 - today.weekday())
+    tasks = [
+        {"name": "Due today", "status": "Pending", "due_on": today},
+        {"name": "No due date", "priority": "High", "status": "Pending"},
+        {"name": "Done today", "status": "Completed", "due_on": today},
+        {"name": "Far away", "priority": "Low", "status": "In Progress",
+         "due_on": today + timedelta(days=30)},
+        {"name": "Overdue", "status": "Pending",
+         "due_on": today - timedelta(days=2)},
+    ]
+    if week_end > today:
+        tasks.append({"name": "This week", "status": "Pending",
+                      "due_on": week_end})
+    db.session.execute(insert(Task), [{"priority": "Medium", **task}
+                                      for task in tasks])
+    db.session.commit()
+
+    response = client.get('/api/tasks/stats')
+    assert response.status_code == 200
+    stats = response.get_json()
+    assert stats["total"] == len(tasks)
+    assert stats["by_status"] == {"Pending": len(tasks) - 2,
+                                  "In Progress": 1, "Completed": 1}
+    assert stats["by_priority"] == {"Low": 1, "Medium": len(tasks) - 2,
+                                    "High": 1}
+    assert stats["by_due"] == {"overdue": 1, "today": 1,
+                               "this_week": int(week_end > today),
+                               "later": 1, "none": 1}
+
+    client.application.config["STATS_SUMMARY_ENABLED"] = False
+    assert client.get('/api/tasks/stats').get_json() == stats
+
+
+def test_task_stats_query_plans(client):
+    today = datetime.now().date()
+    plan = explain_query_plan(db.session, build_stats_query(today))
+    assert plan[0] == ("SCAN task USING COVERING INDEX "
+                       "ix_task_priority_status_due_on")
+    plan = explain_query_plan(db.session,
+                              build_stats_query(today, summary=True))
+    assert plan[0].startswith("SCAN task_counts")
+
+
+def test_task_counts_follow_writes(client):
+    _seed_tasks(6)
+    client.put('/api/tasks/1', json={"name": "Task 000",
+                                     "status": "Completed"})
+    client.delete('/api/tasks/2')
+    client.patch('/api/tasks/bulk', json=[{"id": 3, "priority": "Low"}])
+
+    by_group = select(Task.status, Task.priority, Task.due_on,
+                      func.count()).group_by(Task.status, Task.priority,
+                                             Task.due_on)
+    counts = select(TaskCount.status, TaskCount.priority, TaskCount.due_on,
+                    TaskCount.task_count)
+    assert sorted(db.session.execute(counts).all()) == \
+        sorted(db.session.execute(by_group).all())
+
+
+def test_task_stats_etag_changes_on_write(client):
+    _seed_tasks(2)
+    etag = client.get('/api/tasks/stats').headers['ETag']
+    assert client.get('/api/tasks/stats',
+                      headers={"If-None-Match": etag}).status_code == 304
+    client.delete('/api/tasks/1')
+    assert client.get('/api/tasks/stats',
+                      headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_task_stats_buckets_follow_the_patched_clock(client, monkeypatch):
+    client.post('/api/tasks', json={"name": "Due on the 3rd",
+                                    "due_on": "2099-03-03"})
+    monkeypatch.setattr(task_models, "today",
+                        lambda: datetime(2099, 3, 5).date())
+    response = client.get('/api/tasks/stats')
+    assert response.get_json()["by_due"]["overdue"] == 1
+    assert client.get('/api/tasks/stats', headers={
+        "If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    monkeypatch.setattr(task_models, "today",
+                        lambda: datetime(2099, 3, 6).date())
+    assert client.get('/api/tasks/stats', headers={
+        "If-None-Match": response.headers["ETag"]}).status_code == 200
+
+
+def test_change_feed_returns_latest_state_and_tombstones(client):
+    _seed_tasks(3)
+    start = client.get('/api/tasks/changes').get_json()
+    assert [change["id"] for change in start["changes"]] == [1, 2, 3]
+
+    client.put('/api/tasks/1', json={"name": "Renamed"})
+    client.put('/api/tasks/1', json={"name": "Renamed again"})
+    client.delete('/api/tasks/2')
+    response = client.get(f'/api/tasks/changes?since={start["last_seq"]}')
+    feed = response.get_json()
+    assert [(change["id"], change["deleted"]) for change in feed["changes"]] \
+        == [(1, False), (2, True)]
+    assert feed["changes"][0]["task"] == client.get('/api/tasks/1').get_json()
+    assert feed["last_seq"] == feed["changes"][-1]["seq"]
+
+    page = client.get(f'/api/tasks/changes?since={start["last_seq"]}&limit=1')
+    assert len(page.get_json()["changes"]) == 1
+    assert client.get('/api/tasks/changes?since=-1').status_code == 400
+
+
+def test_pruned_change_feed_still_syncs_every_task(client):
+    _seed_tasks(3)
+    client.put('/api/tasks/1', json={"name": "Renamed"})
+    client.delete('/api/tasks/2')
+    client.put('/api/tasks/3', json={"name": "Renamed three"})
+    last_seq = client.get('/api/tasks/changes').get_json()["last_seq"]
+    assert last_seq == 6
+
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(args=["tasks", "prune-changes", "--keep", "1"])
+    assert result.exit_code == 0, result.output
+    assert "Pruned 4 changes" in result.output
+    rows = db.session.execute(select(task_models.TaskChange.seq)).scalars()
+    assert list(rows) == [4, 6]
+
+    feed = client.get('/api/tasks/changes').get_json()
+    assert [(change["id"], change["task"]["name"])
+            for change in feed["changes"]] == [(1, "Renamed"),
+                                               (3, "Renamed three")]
+    response = client.get('/api/tasks/changes?since=3')
+    assert response.status_code == 410
+    response = client.get('/api/tasks/changes',
+                          headers={"Accept": "text/event-stream",
+                                   "Last-Event-ID": "4"})
+    assert response.status_code == 410
+    assert client.get('/api/tasks/changes?since=5').get_json()[
+        "last_seq"] == 6
+    # Keeping more than before does not bring deletions back
+    result = runner.invoke(args=["tasks", "prune-changes", "--keep", "10"])
+    assert "Pruned 0 changes" in result.output
+    assert client.get('/api/tasks/changes?since=4').status_code == 410
+
+
+def test_change_feed_long_poll_wakes_on_write(client):
+    last_seq = client.get('/api/tasks/changes').get_json()["last_seq"]
+    writer = threading.Timer(0.2, client.application.test_client().post,
+                             args=('/api/tasks',),
+                             kwargs={"json": {"name": "Late task"}})
+    writer.start()
+    started = time.monotonic()
+    feed = client.get(f'/api/tasks/changes?since={last_seq}&wait=5') \
+        .get_json()
+    writer.join()
+    assert time.monotonic() - started < 5
+    assert [change["task"]["name"] for change in feed["changes"]] == \
+        ["Late task"]
+
+
+def test_change_feed_server_sent_events(client):
+    _seed_tasks(2)
+    response = client.get('/api/tasks/changes?wait=0',
+                          headers={"Accept": "text/event-stream",
+                                   "Last-Event-ID": "1"})
+    assert response.mimetype == "text/event-stream"
+    events = [event for event in response.get_data(as_text=True)
+              .split("\n\n") if event.startswith("id:")]
+    assert len(events) == 1
+    assert events[0].startswith("id: 2\nevent: change\ndata: ")
+    assert json.loads(events[0].split("data: ", 1)[1])["id"] == 2